@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# coding: UTF-8
+
+"""Comparison of record and tunnel layer throughput across interpreters.
+
+layers.py is run under each interpreter, and the MB/s of its
+benchmarks are printed side by side, with the fastest interpreter of
+each row marked by "*". Interpreters which are not installed are
+skipped.
+
+Since JIT compilers need time to warm up, the full workload should be
+used for meaningful numbers.
+
+Usage:
+    bench_interp.py [-q] [-i interpreter]... [-s size]... [-o output.json]
+
+Options:
+    -i, --interpreter   command of an interpreter to benchmark, may be
+                        given several times (default: python2.7,
+                        python3, pypy and pypy3)
+    -s, --size          payload size to benchmark, may be given several
+                        times (default: 64 bytes, 4 KiB and 64 KiB)
+    -q, --quick         use smaller workloads
+    -o, --output        write results of all interpreters to file
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import time
+import getopt
+import platform
+import subprocess
+
+from os import path
+
+LAYERS = path.join(path.dirname(path.abspath(__file__)), 'layers.py')
+INTERPRETERS = ['python2.7', 'python3', 'pypy', 'pypy3']
+SIZES = [64, 4096, 65536]
+UNIT = 'MB/s'
+
+def run_layers(interpreter, sizes, quick):
+    """run_layers(interpreter, sizes, quick) --> dict or None
+
+    Return the result of layers.py, or None if the interpreter cannot
+    be run.
+    """
+    args = [interpreter, LAYERS]
+    for size in sizes:
+        args += ['-s', str(size)]
+    if quick:
+        args.append('-q')
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(args, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print("skip {0}: {1}".format(interpreter, e), file=sys.stderr)
+        return None
+    return json.loads(output.decode('utf-8'))
+
+def table(runs):
+    """table(runs) --> list of str
+
+    runs is a list of (interpreter, result) pairs.
+    """
+    rows = []
+    values = {}
+    for interpreter, result in runs:
+        for r in result['results']:
+            if r['unit'] != UNIT:
+                continue
+            row = (r['benchmark'].split()[0], r['params']['size'])
+            if row not in values:
+                rows.append(row)
+                values[row] = {}
+            values[row][interpreter] = r['value']
+    names = [interpreter for interpreter, result in runs]
+    width = max([10] + [len(name) + 2 for name in names])
+    lines = ["{0:12} {1:>7} ".format("benchmark", "size") +
+             "".join(name.rjust(width) for name in names) +
+             "  (" + UNIT + ")"]
+    for row in rows:
+        best = max(values[row].values())
+        cells = []
+        for name in names:
+            value = values[row].get(name)
+            if value is None:
+                cells.append("-".rjust(width))
+                continue
+            mark = "*" if value == best and len(names) > 1 else " "
+            cells.append("{0:.2f}{1}".format(value, mark).rjust(width))
+        lines.append("{0:12} {1:>7} ".format(*row) + "".join(cells))
+    return lines
+
+def usage():
+    print(__doc__, file=sys.stderr)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hi:s:qo:",
+                ["help", "interpreter=", "size=", "quick", "output="])
+    except getopt.GetoptError as e:
+        print(str(e), file=sys.stderr)
+        usage()
+        sys.exit(2)
+
+    interpreters = []
+    sizes = []
+    quick = False
+    output = None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-i", "--interpreter"):
+            interpreters.append(a)
+        elif o in ("-s", "--size"):
+            sizes.append(int(a))
+        elif o in ("-q", "--quick"):
+            quick = True
+        elif o in ("-o", "--output"):
+            output = a
+        else:
+            assert False, "unhandled option"
+
+    runs = []
+    for interpreter in interpreters or INTERPRETERS:
+        print("running layers.py with " + interpreter, file=sys.stderr)
+        result = run_layers(interpreter, sizes or SIZES, quick)
+        if result is not None:
+            runs.append((interpreter, result))
+    if not runs:
+        print("no interpreter can be run", file=sys.stderr)
+        sys.exit(1)
+    for line in table(runs):
+        print(line)
+
+    if output:
+        results = []
+        for interpreter, result in runs:
+            for r in result['results']:
+                r['params']['interpreter'] = interpreter
+                results.append(r)
+        with open(output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'time': time.time(),
+                    'platform': platform.platform(),
+                    'quick': quick,
+                    'interpreters': dict((interpreter, result['meta'])
+                        for interpreter, result in runs),
+                    },
+                'results': results,
+                }, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
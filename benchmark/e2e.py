@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# coding: UTF-8
+
+"""End-to-end benchmarks of usocks.
+
+A usocks server and client are started as subprocesses on localhost
+with the redirect frontend pointing to a target server running in this
+process. The target understands three commands sent as the first line
+of each stream:
+
+    SINK n      read n bytes and reply "OK"
+    SOURCE n    send n bytes
+    ECHO        echo everything back
+
+The following benchmarks are run for each backend:
+
+    upload          throughput of one stream sending to the target
+    download        throughput of one stream receiving from the target
+    latency         round trip time of small request/response pairs
+    setup           rate of establishing streams
+    concurrency     aggregate download throughput of parallel streams
+
+Results are written as JSON, and two results can be compared to catch
+performance regressions.
+
+Usage:
+    e2e.py [-q] [-b backend]... [-o output.json]
+    e2e.py -c baseline.json new.json [-t threshold]
+
+Options:
+    -b, --backend       backend to benchmark, may be given several
+                        times (default: plain_tcp and multi_tcp)
+    -q, --quick         use smaller workloads
+    -o, --output        write results to file instead of stdout
+    -c, --compare       compare two result files, exit with 1 if any
+                        result is worse than threshold
+    -t, --threshold     relative change considered as regression
+                        (default: 0.1)
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import socket
+import getopt
+import platform
+import tempfile
+import threading
+import subprocess
+
+from os import path
+
+SRC_DIR = path.join(path.dirname(path.abspath(__file__)), '..', 'src')
+BACKENDS = ['plain_tcp', 'multi_tcp']
+CHUNK = 65536
+GROUP_TIMEOUT = 1
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def wait_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+def recv_exactly(conn, size):
+    chunks = []
+    while size > 0:
+        data = conn.recv(min(size, CHUNK))
+        if not data:
+            raise EOFError()
+        chunks.append(data)
+        size -= len(data)
+    return b"".join(chunks)
+
+def recv_line(conn):
+    line = b""
+    while not line.endswith(b"\n"):
+        data = conn.recv(1)
+        if not data:
+            raise EOFError()
+        line += data
+    return line.strip()
+
+class Target(object):
+    """Target server with SINK, SOURCE and ECHO commands."""
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(512)
+        self.port = self.sock.getsockname()[1]
+        self.payload = os.urandom(CHUNK)
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            command = recv_line(conn).split()
+            if command[0] == b"SINK":
+                size = int(command[1])
+                while size > 0:
+                    data = conn.recv(min(size, CHUNK))
+                    if not data:
+                        break
+                    size -= len(data)
+                conn.sendall(b"OK\n")
+            elif command[0] == b"SOURCE":
+                size = int(command[1])
+                while size > 0:
+                    sent = conn.send(self.payload[:size])
+                    size -= sent
+            elif command[0] == b"ECHO":
+                while True:
+                    data = conn.recv(CHUNK)
+                    if not data:
+                        break
+                    conn.sendall(data)
+            recv_line(conn)
+        except (EOFError, socket.error):
+            pass
+        finally:
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+
+class Tunnel(object):
+    """Tunnel(backend, target_port) --> Tunnel object
+
+    Start usocks server and client as subprocesses.
+    """
+
+    def __init__(self, backend, target_port):
+        self.workdir = tempfile.mkdtemp(prefix='usocks-bench-')
+        self.port = free_port()
+        backend_port = free_port()
+        backend_config = {'type': backend,
+                'server': '127.0.0.1', 'port': backend_port}
+        if backend == 'multi_tcp':
+            backend_config['group_timeout'] = GROUP_TIMEOUT
+        config = {
+                'client': {
+                    'backend': backend_config, 'key': 'benchmark',
+                    'address': '127.0.0.1', 'port': self.port,
+                    },
+                'server': {
+                    'backend': backend_config, 'key': 'benchmark',
+                    'frontend': {'type': 'redirect',
+                        'server': '127.0.0.1', 'port': target_port},
+                    },
+                }
+        config_file = path.join(self.workdir, 'config.yaml')
+        # JSON is a subset of YAML
+        with open(config_file, 'w') as f:
+            json.dump(config, f)
+        log_file = path.join(self.workdir, 'server.log')
+        self.server = subprocess.Popen([sys.executable, 'server.py',
+            '-c', config_file, '-l', log_file], cwd=SRC_DIR)
+        wait_port(backend_port)
+        if backend == 'multi_tcp':
+            # the probe above starts a connection group for this address
+            # which has to expire before the client connects
+            time.sleep(GROUP_TIMEOUT + 0.5)
+        self.client = subprocess.Popen([sys.executable, 'client.py',
+            '-c', config_file], cwd=SRC_DIR)
+        wait_port(self.port)
+
+    def _stop(self, proc):
+        if proc.poll() is not None:
+            return
+        proc.send_signal(signal.SIGTERM)
+        deadline = time.time() + 5
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    def open(self, command):
+        conn = socket.create_connection(('127.0.0.1', self.port))
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.sendall(command + b"\n")
+        return conn
+
+    def close(self):
+        self._stop(self.client)
+        self._stop(self.server)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+def bench_upload(tunnel, size):
+    data = os.urandom(CHUNK)
+    start = time.time()
+    conn = tunnel.open("SINK {0}".format(size).encode('ascii'))
+    remaining = size
+    while remaining > 0:
+        conn.sendall(data[:remaining])
+        remaining -= min(remaining, len(data))
+    recv_line(conn)
+    elapsed = time.time() - start
+    conn.close()
+    return [('upload', {'size': size}, size / elapsed / 1e6, 'MB/s', True)]
+
+def bench_download(tunnel, size):
+    start = time.time()
+    conn = tunnel.open("SOURCE {0}".format(size).encode('ascii'))
+    recv_exactly(conn, size)
+    elapsed = time.time() - start
+    conn.close()
+    return [('download', {'size': size}, size / elapsed / 1e6, 'MB/s', True)]
+
+def bench_latency(tunnel, count, msg_size):
+    conn = tunnel.open(b"ECHO")
+    message = os.urandom(msg_size)
+    samples = []
+    for i in range(count):
+        start = time.time()
+        conn.sendall(message)
+        recv_exactly(conn, msg_size)
+        samples.append(time.time() - start)
+    conn.close()
+    params = {'count': count, 'msg_size': msg_size}
+    return [('latency_p{0}'.format(p), params,
+        percentile(samples, p) * 1000, 'ms', False) for p in (50, 90, 99)]
+
+def bench_setup(tunnel, count):
+    start = time.time()
+    for i in range(count):
+        conn = tunnel.open(b"ECHO")
+        conn.sendall(b"x")
+        recv_exactly(conn, 1)
+        conn.close()
+    elapsed = time.time() - start
+    return [('setup', {'count': count}, count / elapsed, 'streams/s', True)]
+
+def bench_concurrency(tunnel, streams, size):
+    errors = []
+    def download():
+        try:
+            conn = tunnel.open("SOURCE {0}".format(size).encode('ascii'))
+            recv_exactly(conn, size)
+            conn.close()
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=download) for i in range(streams)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    if errors:
+        raise errors[0]
+    params = {'streams': streams, 'size': size}
+    return [('concurrency', params,
+        streams * size / elapsed / 1e6, 'MB/s', True)]
+
+def run(backends, quick):
+    scale = 1 if quick else 8
+    target = Target()
+    results = []
+    try:
+        for backend in backends:
+            tunnel = Tunnel(backend, target.port)
+            try:
+                benches = [
+                        (bench_upload, (tunnel, scale * 4 * 2 ** 20)),
+                        (bench_download, (tunnel, scale * 4 * 2 ** 20)),
+                        (bench_latency, (tunnel, scale * 100, 64)),
+                        (bench_setup, (tunnel, scale * 50)),
+                        ]
+                for streams in (1, 4, 16, 64):
+                    benches.append((bench_concurrency,
+                        (tunnel, streams, scale * 2 ** 20 // streams)))
+                for func, args in benches:
+                    for name, params, value, unit, higher in func(*args):
+                        results.append({'backend': backend,
+                            'benchmark': name, 'params': params,
+                            'value': value, 'unit': unit,
+                            'higher_is_better': higher})
+                        print("{0:10} {1:12} {2:40} {3:10.3f} {4}".format(
+                            backend, name, json.dumps(params, sort_keys=True),
+                            value, unit), file=sys.stderr)
+            finally:
+                tunnel.close()
+    finally:
+        target.close()
+    return {
+            'meta': {
+                'time': time.time(),
+                'python': sys.version.split()[0],
+                'implementation': platform.python_implementation(),
+                'platform': platform.platform(),
+                'quick': quick,
+                },
+            'results': results,
+            }
+
+def _key(result):
+    return (result['backend'], result['benchmark'],
+            json.dumps(result['params'], sort_keys=True))
+
+def compare(baseline, current, threshold):
+    """compare(baseline, current, threshold) --> number of regressions"""
+    base = dict((_key(r), r) for r in baseline['results'])
+    regressions = 0
+    for result in current['results']:
+        old = base.get(_key(result))
+        if old is None or not old['value']:
+            continue
+        change = (result['value'] - old['value']) / old['value']
+        if not result['higher_is_better']:
+            change = -change
+        mark = ""
+        if change < -threshold:
+            mark = "REGRESSION"
+            regressions += 1
+        print("{0:10} {1:12} {2:40} {3:+8.1%} {4}".format(*(_key(result) +
+            (change, mark))))
+    return regressions
+
+def usage():
+    print(__doc__, file=sys.stderr)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hb:qo:ct:",
+                ["help", "backend=", "quick", "output=",
+                    "compare", "threshold="])
+    except getopt.GetoptError as e:
+        print(str(e), file=sys.stderr)
+        usage()
+        sys.exit(2)
+
+    backends = []
+    quick = False
+    output = None
+    comparing = False
+    threshold = 0.1
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-b", "--backend"):
+            backends.append(a)
+        elif o in ("-q", "--quick"):
+            quick = True
+        elif o in ("-o", "--output"):
+            output = a
+        elif o in ("-c", "--compare"):
+            comparing = True
+        elif o in ("-t", "--threshold"):
+            threshold = float(a)
+        else:
+            assert False, "unhandled option"
+
+    if comparing:
+        if len(args) != 2:
+            usage()
+            sys.exit(2)
+        with open(args[0]) as f:
+            baseline = json.load(f)
+        with open(args[1]) as f:
+            current = json.load(f)
+        sys.exit(1 if compare(baseline, current, threshold) else 0)
+
+    result = run(backends or BACKENDS, quick)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    else:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# coding: UTF-8
+
+"""Micro-benchmarks of the record and tunnel layers.
+
+Two record connections are connected back to back through the memory
+backend, so no network connection is involved. For each payload
+size, the following operations are measured separately:
+
+    send_packet     RecordConnection.send_packet
+    receive         RecordConnection.receive_packets, i.e. decryption,
+                    extraction and reassembly
+    extract         RecordConnection._extract_packets on data which
+                    has already been decrypted
+    tunnel          TunnelConnection._process_packet
+
+Each result reports records/s, MB/s of payload and, if tracemalloc is
+available, the peak of memory allocated per packet. Results use the
+same JSON format as e2e.py, so they can be compared with
+"e2e.py -c baseline.json new.json".
+
+Usage:
+    layers.py [-q] [-s size]... [-o output.json]
+
+Options:
+    -s, --size          payload size to benchmark, may be given several
+                        times (default: from 16 bytes up to 256 KiB)
+    -q, --quick         use smaller workloads
+    -o, --output        write results to file instead of stdout
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import time
+import getopt
+import platform
+
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)),
+                             '..', 'src'))
+
+import record
+import tunnel
+from backend import memory
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+SIZES = [16, 64, 256, 1024, 4096, 16384, 65535, 65536 * 2, 262144]
+# total payload processed for each size and operation
+WORKLOAD = 32 * 2 ** 20
+MIN_PACKETS = 100
+MAX_PACKETS = 50000
+# packets traced for measuring allocations
+ALLOC_PACKETS = 20
+# maximum bytes returned by one recv, similar to socket backends
+RECV_SIZE = 4096
+KEY = b"benchmark"
+
+def loopback_pair():
+    """loopback_pair() --> (RecordConnection, RecordConnection)"""
+    a, b = memory.pair(recv_size=RECV_SIZE)
+    return record.RecordConnection(KEY, a), record.RecordConnection(KEY, b)
+
+def drain(conn):
+    """Receive all pending packets of conn, and return the number."""
+    count = 0
+    while conn.backend.pending():
+        for packet in conn.receive_packets():
+            count += 1
+    return count
+
+def trace_peak(func, count):
+    """Return the mean peak of memory allocated by each call of func."""
+    if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+        return None
+    tracemalloc.start()
+    total = 0
+    try:
+        for i in range(count):
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            func()
+            total += tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return total / count
+
+def bench_send(size, packets):
+    sender, receiver = loopback_pair()
+    drain(receiver)
+    payload = os.urandom(size)
+    def send():
+        sender.send_packet(payload)
+        del receiver.backend.recv_buf[:]
+    records = sender.records_sent
+    start = time.time()
+    for i in range(packets):
+        send()
+    elapsed = time.time() - start
+    records = sender.records_sent - records
+    return elapsed, records, trace_peak(send, ALLOC_PACKETS)
+
+def _fill(size, packets):
+    sender, receiver = loopback_pair()
+    drain(receiver)
+    payload = os.urandom(size)
+    for i in range(packets):
+        sender.send_packet(payload)
+    return sender, receiver, payload
+
+def bench_receive(size, packets):
+    sender, receiver, payload = _fill(size, packets)
+    records = receiver.records_received
+    start = time.time()
+    count = drain(receiver)
+    elapsed = time.time() - start
+    assert count == packets
+    records = receiver.records_received - records
+    def receive():
+        sender.send_packet(payload)
+        drain(receiver)
+    return elapsed, records, trace_peak(receive, ALLOC_PACKETS)
+
+def bench_extract(size, packets):
+    sender, receiver, payload = _fill(size, packets)
+    records = receiver.records_received
+    backend = receiver.backend
+    elapsed = 0.0
+    count = 0
+    def extract():
+        receiver.cipher_buf += backend.recv()
+        receiver._update_buffer()
+        start = time.time()
+        found = len(list(receiver._extract_packets()))
+        return time.time() - start, found
+    while backend.pending():
+        spent, found = extract()
+        elapsed += spent
+        count += found
+    assert count == packets
+    records = receiver.records_received - records
+    def extract_one():
+        sender.send_packet(payload)
+        while backend.pending():
+            extract()
+    return elapsed, records, trace_peak(extract_one, ALLOC_PACKETS)
+
+def bench_tunnel(size, packets):
+    sender, receiver = loopback_pair()
+    conn = tunnel.TunnelConnection(receiver)
+    header = tunnel.header_format
+    syn = tunnel.StatusControl.syn | tunnel.StatusControl.dat
+    conn._process_packet(tunnel.struct.pack(header,
+        tunnel.VERSION_CODE, syn, 1))
+    packet = tunnel.struct.pack(header, tunnel.VERSION_CODE,
+            tunnel.StatusControl.dat, 1) + os.urandom(size)
+    process = conn._process_packet
+    start = time.time()
+    for i in range(packets):
+        process(packet)
+    elapsed = time.time() - start
+    return elapsed, packets, trace_peak(lambda: process(packet),
+                                        ALLOC_PACKETS)
+
+BENCHMARKS = [
+        ('send_packet', bench_send),
+        ('receive', bench_receive),
+        ('extract', bench_extract),
+        ('tunnel', bench_tunnel),
+        ]
+
+def run(sizes, quick):
+    workload = WORKLOAD // 8 if quick else WORKLOAD
+    results = []
+    for size in sizes:
+        packets = max(MIN_PACKETS, min(MAX_PACKETS, workload // size))
+        if quick:
+            packets = max(MIN_PACKETS // 4, packets // 8)
+        for name, func in BENCHMARKS:
+            elapsed, records, alloc = func(size, packets)
+            params = {'size': size, 'packets': packets}
+            values = [
+                    ('records/s', records / elapsed, True),
+                    ('MB/s', size * packets / elapsed / 1e6, True),
+                    ]
+            if alloc is not None:
+                values.append(('bytes/packet', alloc, False))
+            for unit, value, higher in values:
+                results.append({'backend': 'memory',
+                    'benchmark': name + ' ' + unit, 'params': params,
+                    'value': value, 'unit': unit,
+                    'higher_is_better': higher})
+            print("{0:12} {1:>7} {2:12.0f} records/s {3:9.2f} MB/s "
+                  "{4:>10} bytes/packet".format(name, size,
+                      records / elapsed, size * packets / elapsed / 1e6,
+                      "-" if alloc is None else int(alloc)),
+                  file=sys.stderr)
+    return {
+            'meta': {
+                'time': time.time(),
+                'python': sys.version.split()[0],
+                'implementation': platform.python_implementation(),
+                'platform': platform.platform(),
+                'quick': quick,
+                },
+            'results': results,
+            }
+
+def usage():
+    print(__doc__, file=sys.stderr)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hs:qo:",
+                ["help", "size=", "quick", "output="])
+    except getopt.GetoptError as e:
+        print(str(e), file=sys.stderr)
+        usage()
+        sys.exit(2)
+
+    sizes = []
+    quick = False
+    output = None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-s", "--size"):
+            sizes.append(int(a))
+        elif o in ("-q", "--quick"):
+            quick = True
+        elif o in ("-o", "--output"):
+            output = a
+        else:
+            assert False, "unhandled option"
+
+    result = run(sizes or SIZES, quick)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    else:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# coding: UTF-8
+
+"""Replay of captured tunnel packets.
+
+Packets of one direction of a capture file, see the capture module,
+are sent by a record connection and received by a tunnel connection
+through the memory backend, like layers.py, so that real traffic can
+be used to benchmark the record and tunnel layers repeatably. Each
+tunnel of the capture is replayed on its own pair of connections.
+
+By default packets are replayed as fast as possible, and packets/s
+and MB/s of bodies are reported. With -r, packets are sent at their
+original times, and the lag from those times until each packet is
+received is reported instead.
+
+Bodies which are not captured are replaced by zero bytes, and such
+packets are sent uncompressed. Packets of connections which the
+receiving side would have opened itself are accepted as if it had
+done so. Results use the same JSON format as e2e.py, so they can be
+compared with "e2e.py -c baseline.json new.json".
+
+Usage:
+    replay.py [-r] [-d direction] [-n repeat] [-o output.json] capture
+
+Options:
+    -d, --direction     direction of packets replayed, "sent" or
+                        "received" (default: sent)
+    -r, --realtime      keep the original timing of packets
+    -n, --repeat        number of times the capture is replayed at
+                        full speed (default: 1)
+    -o, --output        write results to file instead of stdout
+"""
+
+from __future__ import print_function, division
+
+import sys
+import json
+import time
+import getopt
+import platform
+
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)),
+                             '..', 'src'))
+
+import record
+import tunnel
+import capture
+from backend import memory
+from tunnel import StatusControl, ConnectionStatus
+
+DIRECTIONS = {'sent': capture.SENT, 'received': capture.RECEIVED}
+# maximum bytes returned by one recv, similar to socket backends
+RECV_SIZE = 4096
+KEY = b"replay"
+
+class Pipeline(object):
+    """Pipeline() --> Pipeline object
+
+    Record connection sending packets of one tunnel to a tunnel
+    connection, which negotiates any available codec.
+    """
+
+    def __init__(self):
+        a, b = memory.pair(recv_size=RECV_SIZE)
+        self.sender = record.RecordConnection(KEY, a)
+        self.receiver = tunnel.TunnelConnection(
+                record.RecordConnection(KEY, b), {})
+
+    def send(self, control, conn_id, size, body):
+        receiver = self.receiver
+        if body is None or receiver.compressor is None:
+            control &= ~StatusControl.cmp
+        if body is None:
+            body = b"\0" * size
+        states = receiver.conn_states
+        if conn_id != tunnel.control_conn_id and \
+                not (control & (StatusControl.syn | StatusControl.dgr)) \
+                and states.get(conn_id, ConnectionStatus.closed) == \
+                    ConnectionStatus.closed:
+            states[conn_id] = ConnectionStatus.connected
+        self.sender.send_packet(tunnel.struct.pack(tunnel.header_format,
+            tunnel.VERSION_CODE, control, conn_id) + body)
+
+    def drain(self):
+        """drain() --> None
+
+        Receive all packets sent, and discard the replies.
+        """
+        backend = self.receiver.record_conn.backend
+        while backend.pending():
+            for packet in self.receiver.receive_packets():
+                pass
+        del self.sender.backend.recv_buf[:]
+
+def load(filename, direction):
+    """load(filename, direction) --> (payloads, list of frames)"""
+    with open(filename, 'rb') as f:
+        payloads, frames = capture.read(f)
+        return payloads, [frame for frame in frames
+                          if frame[2] == direction]
+
+def replay(frames, realtime=False):
+    """replay(frames, realtime=False) --> (elapsed, list of lags)
+
+    Lags are only measured in realtime.
+    """
+    pipelines = {}
+    lags = []
+    start = time.time()
+    for when, number, _, control, conn_id, size, body in frames:
+        pipeline = pipelines.get(number)
+        if pipeline is None:
+            pipeline = pipelines[number] = Pipeline()
+        if realtime:
+            delay = start + when - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        pipeline.send(control, conn_id, size, body)
+        pipeline.drain()
+        if realtime:
+            lags.append(time.time() - start - when)
+    return time.time() - start, lags
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+def run(filename, direction, realtime, repeat):
+    payloads, frames = load(filename, DIRECTIONS[direction])
+    if not frames:
+        print("no packets to replay", file=sys.stderr)
+        sys.exit(1)
+    size = sum(frame[5] for frame in frames)
+    params = {'capture': path.basename(filename), 'direction': direction,
+              'packets': len(frames), 'payloads': payloads}
+    values = []
+    if realtime:
+        elapsed, lags = replay(frames, True)
+        for p in (50, 90, 99):
+            values.append(('lag p{0}'.format(p),
+                           percentile(lags, p) * 1000, 'ms', False))
+    else:
+        elapsed = 0.0
+        for i in range(repeat):
+            elapsed += replay(frames)[0]
+        values.append(('replay packets/s', len(frames) * repeat / elapsed,
+                       'packets/s', True))
+        values.append(('replay MB/s', size * repeat / elapsed / 1e6,
+                       'MB/s', True))
+    results = []
+    for name, value, unit, higher in values:
+        results.append({'backend': 'memory', 'benchmark': name,
+            'params': params, 'value': value, 'unit': unit,
+            'higher_is_better': higher})
+        print("{0:18} {1:12.2f} {2}".format(name, value, unit),
+              file=sys.stderr)
+    return {
+            'meta': {
+                'time': time.time(),
+                'python': sys.version.split()[0],
+                'implementation': platform.python_implementation(),
+                'platform': platform.platform(),
+                'realtime': realtime,
+                },
+            'results': results,
+            }
+
+def usage():
+    print(__doc__, file=sys.stderr)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hd:rn:o:",
+                ["help", "direction=", "realtime", "repeat=", "output="])
+    except getopt.GetoptError as e:
+        print(str(e), file=sys.stderr)
+        usage()
+        sys.exit(2)
+
+    direction = 'sent'
+    realtime = False
+    repeat = 1
+    output = None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-d", "--direction"):
+            direction = a
+        elif o in ("-r", "--realtime"):
+            realtime = True
+        elif o in ("-n", "--repeat"):
+            repeat = int(a)
+        elif o in ("-o", "--output"):
+            output = a
+        else:
+            assert False, "unhandled option"
+    if len(args) != 1 or direction not in DIRECTIONS:
+        usage()
+        sys.exit(2)
+
+    result = run(args[0], direction, realtime, repeat)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    else:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# coding: UTF-8
+
+"""Admission control of tunnels and streams on the server.
+
+New tunnels are rejected when there are too many tunnels in total or
+from the same client address, and new streams when a client address
+has too many of them. Both are also rejected while the event loop is
+overloaded, i.e. the smoothed time spent processing one iteration is
+above a threshold, so that established streams keep being served.
+"""
+
+# weight of new sample in loop lag estimation
+lag_alpha = 0.1
+
+class Admission(object):
+    """Admission(**opts) --> Admission object
+
+    Options:
+        max_tunnels             max number of tunnels
+        max_tunnels_per_ip      max number of tunnels from one address
+        max_streams_per_ip      max number of streams of one address
+        handshake_timeout       seconds for a new tunnel to send its
+                                first valid record
+        max_loop_lag            smoothed seconds of one loop iteration
+                                above which new tunnels and streams
+                                are shed
+
+    Limits which are not given are not enforced.
+    """
+
+    max_tunnels = None
+    max_tunnels_per_ip = None
+    max_streams_per_ip = None
+    handshake_timeout = None
+    max_loop_lag = None
+
+    def __init__(self, **opts):
+        if 'max_tunnels' in opts:
+            self.max_tunnels = opts['max_tunnels']
+        if 'max_tunnels_per_ip' in opts:
+            self.max_tunnels_per_ip = opts['max_tunnels_per_ip']
+        if 'max_streams_per_ip' in opts:
+            self.max_streams_per_ip = opts['max_streams_per_ip']
+        if 'handshake_timeout' in opts:
+            self.handshake_timeout = opts['handshake_timeout']
+        if 'max_loop_lag' in opts:
+            self.max_loop_lag = opts['max_loop_lag']
+        self.tunnels = 0
+        # dictionaries of addresses to numbers of tunnels and streams
+        self.ip_tunnels = {}
+        self.ip_streams = {}
+        self.loop_lag = 0.0
+
+    @property
+    def overloaded(self):
+        return self.max_loop_lag is not None and \
+                self.loop_lag > self.max_loop_lag
+
+    def update_lag(self, duration):
+        """update_lag(duration) --> None
+
+        Feed the time spent processing one loop iteration.
+        """
+        self.loop_lag += lag_alpha * (duration - self.loop_lag)
+
+    def admit_tunnel(self, address):
+        """admit_tunnel(address) --> str or None
+
+        Return the reason of rejection, or None and count the tunnel
+        if it is admitted.
+        """
+        if self.overloaded:
+            return 'overload'
+        if self.max_tunnels is not None and \
+                self.tunnels >= self.max_tunnels:
+            return 'max_tunnels'
+        count = self.ip_tunnels.get(address, 0)
+        if self.max_tunnels_per_ip is not None and \
+                count >= self.max_tunnels_per_ip:
+            return 'max_tunnels_per_ip'
+        self.add_tunnel(address)
+        return None
+
+    def add_tunnel(self, address):
+        """add_tunnel(address) --> None
+
+        Count a tunnel without checking the limits, which is used for
+        tunnels passed from another process.
+        """
+        self.tunnels += 1
+        self.ip_tunnels[address] = self.ip_tunnels.get(address, 0) + 1
+
+    def remove_tunnel(self, address):
+        self.tunnels -= 1
+        self.ip_tunnels[address] -= 1
+        if not self.ip_tunnels[address]:
+            del self.ip_tunnels[address]
+
+    def admit_stream(self, address):
+        """admit_stream(address) --> str or None
+
+        Return the reason of rejection, or None and count the stream
+        if it is admitted.
+        """
+        if self.overloaded:
+            return 'overload'
+        count = self.ip_streams.get(address, 0)
+        if self.max_streams_per_ip is not None and \
+                count >= self.max_streams_per_ip:
+            return 'max_streams_per_ip'
+        self.add_stream(address)
+        return None
+
+    def add_stream(self, address):
+        self.ip_streams[address] = self.ip_streams.get(address, 0) + 1
+
+    def remove_stream(self, address):
+        self.ip_streams[address] -= 1
+        if not self.ip_streams[address]:
+            del self.ip_streams[address]
@@ -1 +1,3 @@
 # coding: UTF-8
+
+class BackendUnavailableError(Exception): pass
@@ -0,0 +1,180 @@
+# coding: UTF-8
+
+"""In-memory backend.
+
+Data is exchanged between two ends through in-process buffers, so no
+real network connection is involved. It is useful for benchmarking and
+testing the upper layers without noise from kernel TCP.
+
+Each end owns a doorbell, a socket pair which becomes readable when
+there is something to receive, so the backend works with select like
+other backends. Sending never blocks, thus get_wlist always returns an
+empty list.
+
+Both ends must live in the same process. pair() creates two connected
+ends directly, while ServerBackend and ClientBackend find each other
+by name, so that a server and a client can be created from config in
+one process.
+"""
+
+import socket
+import errno
+
+DEFAULT_NAME = "default"
+
+# dictionary of names to listening ServerBackend objects
+_listeners = {}
+
+class Doorbell(object):
+
+    def __init__(self):
+        self.rsock, self.wsock = socket.socketpair()
+        self.rsock.setblocking(0)
+        self.wsock.setblocking(0)
+        self.rung = False
+
+    def ring(self):
+        if not self.rung:
+            self.rung = True
+            self.wsock.send(b"\0")
+
+    def clear(self):
+        if self.rung:
+            self.rung = False
+            self.rsock.recv(1)
+
+    def close(self):
+        self.rsock.close()
+        self.wsock.close()
+
+    def fileno(self):
+        return self.rsock.fileno()
+
+class MemoryBackend(object):
+    """MemoryBackend(recv_size=None) --> MemoryBackend object
+
+    recv_size limits the number of bytes returned by one recv, which
+    can be used to emulate a socket.
+    """
+
+    def __init__(self, recv_size=None):
+        self.recv_size = recv_size
+        self.recv_buf = []
+        self.doorbell = Doorbell()
+        self.peer = None
+        self.peer_closed = False
+        self.closed = False
+
+    def send(self, data=None, urgent=True):
+        if not data:
+            return True
+        if self.closed:
+            raise socket.error(errno.EBADF, "backend closed")
+        if not self.peer_closed:
+            self.peer.recv_buf.append(data)
+            self.peer.doorbell.ring()
+        return True
+
+    def recv(self):
+        self.doorbell.clear()
+        if not self.recv_buf:
+            return None if self.peer_closed else b""
+        data = b"".join(self.recv_buf)
+        if self.recv_size and len(data) > self.recv_size:
+            self.recv_buf = [data[self.recv_size:]]
+            self.doorbell.ring()
+            return data[:self.recv_size]
+        self.recv_buf = []
+        return data
+
+    def pending(self):
+        """pending() --> int
+
+        Number of bytes waiting for being received.
+        """
+        return sum(len(data) for data in self.recv_buf)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.doorbell.close()
+        if not self.peer_closed:
+            self.peer.peer_closed = True
+            self.peer.doorbell.ring()
+
+    def buffered(self):
+        return 0
+
+    def get_rlist(self):
+        return [self.doorbell.fileno()]
+
+    def get_wlist(self):
+        return []
+
+def pair(**opts):
+    """pair(**opts) --> (MemoryBackend, MemoryBackend)
+
+    Create two connected ends.
+
+    Options:
+        recv_size   max bytes returned by one recv
+    """
+    a = MemoryBackend(opts.get('recv_size'))
+    b = MemoryBackend(opts.get('recv_size'))
+    a.peer, b.peer = b, a
+    return a, b
+
+class ClientBackend(MemoryBackend):
+
+    name = DEFAULT_NAME
+
+    def __init__(self, **opts):
+        if 'name' in opts:
+            self.name = opts['name']
+        listener = _listeners.get(self.name)
+        if listener is None:
+            raise socket.error(errno.ECONNREFUSED,
+                    "no memory backend named " + self.name)
+        super(ClientBackend, self).__init__(opts.get('recv_size'))
+        instance = ServerInstance(self.name, opts.get('recv_size'))
+        self.peer, instance.peer = instance, self
+        listener.pending.append(instance)
+        listener.doorbell.ring()
+
+class ServerInstance(MemoryBackend):
+
+    def __init__(self, address, recv_size=None):
+        super(ServerInstance, self).__init__(recv_size)
+        self.address = address
+
+class ServerBackend(object):
+
+    name = DEFAULT_NAME
+
+    def __init__(self, **opts):
+        if 'name' in opts:
+            self.name = opts['name']
+        if self.name in _listeners:
+            raise socket.error(errno.EADDRINUSE,
+                    "memory backend named " + self.name + " exists")
+        _listeners[self.name] = self
+        self.doorbell = Doorbell()
+        self.pending = []
+
+    def accept(self):
+        """accept() --> list of ServerInstance
+
+        Accept all pending connections.
+        """
+        self.doorbell.clear()
+        instances, self.pending = self.pending, []
+        return instances
+
+    def close(self):
+        if _listeners.get(self.name) is self:
+            del _listeners[self.name]
+        self.doorbell.close()
+
+    def get_rlist(self):
+        return [self.doorbell.fileno()]
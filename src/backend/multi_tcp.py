@@ -2,24 +2,36 @@
 
 import errno
 import socket
+import struct
 
 from collections import defaultdict
 
+from util import create_listener, accept_all, read_buffer
+from util import start_connect, check_connected, set_notsent_lowat
+from util import DEFAULT_BACKLOG, DEFAULT_ACCEPT_BATCH
+from util import DEFAULT_READ_BUDGET, DEFAULT_CONNECT_TIMEOUT
+
+from . import BackendUnavailableError
+
 DEFAULT_PORT = 4194
 DEFAULT_BLOCKSIZE = 8192
 DEFAULT_NUMBER = 5
+DEFAULT_GROUP_TIMEOUT = 30
 BUFFER_SIZE = 4096
 
 class MultiTCPBackend(object):
     
     blocksize = DEFAULT_BLOCKSIZE
     number = DEFAULT_NUMBER
+    read_budget = DEFAULT_READ_BUDGET
 
     def __init__(self, **opts):
         if 'blocksize' in opts:
             self.blocksize = opts['blocksize']
         if 'number' in opts:
             self.number = opts['number']
+        if 'read_budget' in opts:
+            self.read_budget = opts['read_budget']
 
         self.send_bufs = [b"" for i in range(self.number)]
         self.cur_filling = 0
@@ -68,34 +80,43 @@ class MultiTCPBackend(object):
         return available
 
     def recv(self):
-        data = b""
-        while True:
+        # Blocks are read in turn until the connection of the current
+        # block has nothing left or the budget is used up.
+        budget = self.read_budget
+        view = read_buffer(budget)
+        total = 0
+        while total < budget:
             conn = self.conns[self.cur_recving]
+            size = min(self.remaining_bytes, budget - total)
             try:
-                packet = conn.recv(self.remaining_bytes)
+                n = conn.recv_into(view[total:], size)
             except socket.error as e:
-                if e.errno == errno.EAGAIN:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
                     break
                 raise
-            if packet == b"":
+            if not n:
+                if not total:
+                    return None
                 break
-            self.remaining_bytes -= len(packet)
-            data += packet
+            total += n
+            self.remaining_bytes -= n
             if self.remaining_bytes == 0:
                 self.cur_recving = (self.cur_recving + 1) % self.number
                 self.remaining_bytes = self.blocksize
-            else:
-                break
-        if data == b"":
-            data = None
-        return data
+        return view[:total].tobytes()
 
     def close(self):
+        # remaining data in the kernel buffers is sent in background
         for conn in self.conns:
-            conn.setblocking(1)
-            # TODO make close non-blocking
             conn.close()
 
+    def buffered(self):
+        """buffered() --> int
+
+        Number of bytes waiting for being sent.
+        """
+        return sum(len(buf) for buf in self.send_bufs)
+
     def get_rlist(self):
         return [self.conns[self.cur_recving].fileno()]
 
@@ -106,9 +127,19 @@ class MultiTCPBackend(object):
                 for i in range(self.number) if self.send_bufs[i]]
 
 class ClientBackend(MultiTCPBackend):
+    """ClientBackend(**opts) --> ClientBackend object
+
+    All connections are established concurrently in the event loop.
+    Each connection starts with one byte of its index, by which the
+    server orders them, as they may arrive in any order. Data sent
+    before they are established is buffered. If they are not established
+    within connect_timeout seconds, BackendUnavailableError is raised
+    from the timer, which requires timers of the loop to be given.
+    """
 
     server = "127.0.0.1"
     port = DEFAULT_PORT
+    connect_timeout = DEFAULT_CONNECT_TIMEOUT
 
     def __init__(self, **opts):
         super(ClientBackend, self).__init__(**opts)
@@ -117,13 +148,66 @@ class ClientBackend(MultiTCPBackend):
             self.server = opts['server']
         if 'port' in opts:
             self.port = opts['port']
+        if 'connect_timeout' in opts:
+            self.connect_timeout = opts['connect_timeout']
 
+        self.send_bufs = [struct.pack("!B", i) for i in range(self.number)]
         # initialize socket
-        self.conns = [socket.socket() for i in range(self.number)]
-        for conn in self.conns:
-            # TODO make connect non-blocking
-            conn.connect((self.server, self.port))
-            conn.setblocking(0)
+        self.conns = []
+        self.connect_timer = None
+        try:
+            for i in range(self.number):
+                conn = start_connect(self.server, self.port)
+                set_notsent_lowat(conn, opts.get('notsent_lowat'))
+                self.conns.append(conn)
+        except socket.error:
+            self.close()
+            raise
+        # connections which have not been established
+        self.connecting = list(self.conns)
+        timers = opts.get('timers')
+        if timers is not None and self.connect_timeout:
+            self.connect_timer = timers.schedule(self.connect_timeout,
+                    self._connect_expired)
+
+    def _connect_expired(self):
+        self.connect_timer = None
+        if self.connecting:
+            msg = "connecting to {0}:{1} timed out" \
+                    .format(self.server, self.port)
+            raise BackendUnavailableError(msg)
+
+    def _continue(self):
+        if self.connecting:
+            try:
+                self.connecting = [conn for conn in self.connecting
+                        if not check_connected(conn)]
+            except socket.error as e:
+                msg = "cannot connect to {0}:{1}: {2}" \
+                        .format(self.server, self.port, e)
+                raise BackendUnavailableError(msg)
+            if self.connecting:
+                return all(len(buf) < BUFFER_SIZE for buf in self.send_bufs)
+            if self.connect_timer:
+                self.connect_timer.cancel()
+                self.connect_timer = None
+        return super(ClientBackend, self)._continue()
+
+    def close(self):
+        if self.connect_timer:
+            self.connect_timer.cancel()
+            self.connect_timer = None
+        super(ClientBackend, self).close()
+
+    def get_rlist(self):
+        if self.connecting:
+            return []
+        return super(ClientBackend, self).get_rlist()
+
+    def get_wlist(self):
+        if self.connecting:
+            return [conn.fileno() for conn in self.connecting]
+        return super(ClientBackend, self).get_wlist()
 
 class ServerInstance(MultiTCPBackend):
 
@@ -134,16 +218,54 @@ class ServerInstance(MultiTCPBackend):
         self.address = address
         for conn in conns:
             conn.setblocking(0)
+            set_notsent_lowat(conn, opts.get('notsent_lowat'))
+
+    def dump(self, sockets):
+        """dump(sockets) --> dict
+
+        Return the state of this instance for upgrading, in which its
+        sockets are referred to by the indices in list sockets they
+        are appended to.
+        """
+        start = len(sockets)
+        sockets.extend(self.conns)
+        return {'conns': list(range(start, len(sockets))),
+                'address': self.address, 'send_bufs': self.send_bufs,
+                'cur_filling': self.cur_filling,
+                'filled_bytes': self.filled_bytes,
+                'cur_recving': self.cur_recving,
+                'remaining_bytes': self.remaining_bytes,
+                'is_urgent': self.is_urgent}
+
+    @classmethod
+    def restore(cls, state, sockets, **opts):
+        conns = [sockets[i] for i in state['conns']]
+        self = cls(conns, state['address'], **opts)
+        for name in ('send_bufs', 'cur_filling', 'filled_bytes',
+                'cur_recving', 'remaining_bytes', 'is_urgent'):
+            setattr(self, name, state[name])
+        return self
 
 class ServerBackend(object):
+    """ServerBackend(conn=None, **opts) --> ServerBackend object
+
+    If conn is given, it is used as the listening socket instead of
+    creating a new one.
+    """
 
     address = ""
     port = DEFAULT_PORT
     blocksize = DEFAULT_BLOCKSIZE
     number = DEFAULT_NUMBER
+    backlog = DEFAULT_BACKLOG
+    accept_batch = DEFAULT_ACCEPT_BATCH
+    reuseport = False
+    # seconds to wait for all connections of an instance
+    group_timeout = DEFAULT_GROUP_TIMEOUT
 
-    def __init__(self, **opts):
+    def __init__(self, conn=None, **opts):
         self.opts = opts
+        self.timers = opts.get('timers')
         if 'address' in opts:
             self.address = opts['address']
         if 'port' in opts:
@@ -152,30 +274,130 @@ class ServerBackend(object):
             self.blocksize = opts['blocksize']
         if 'number' in opts:
             self.number = opts['number']
+        if 'backlog' in opts:
+            self.backlog = opts['backlog']
+        if 'accept_batch' in opts:
+            self.accept_batch = opts['accept_batch']
+        if 'reuseport' in opts:
+            self.reuseport = opts['reuseport']
+        if 'group_timeout' in opts:
+            self.group_timeout = opts['group_timeout']
 
-        # initialize waiting list
-        self.connections = defaultdict(list)
+        # initialize waiting list, {address: {index: conn}}
+        self.connections = defaultdict(dict)
+        # connections whose index has not been read, {conn: address}
+        self.unidentified = {}
+        # expiry timers of waiting lists
+        self.expiry = {}
         # initialize socket
-        self.conn = socket.socket()
-        self.conn.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.conn.bind((self.address, self.port))
-        self.conn.listen(10)
+        if conn is None:
+            conn = create_listener(self.address, self.port,
+                    backlog=self.backlog, reuseport=self.reuseport)
+        self.conn = conn
 
     def accept(self):
-        conn, address = self.conn.accept()
-        address = address[0]
-        # collect connections
-        # TODO should expire after a while
-        self.connections[address].append(conn)
-        if len(self.connections[address]) < self.number:
-            return None
-        # create new instance
-        conns = self.connections[address]
-        del self.connections[address]
-        return ServerInstance(conns, address, **self.opts)
+        """accept() --> list of ServerInstance
+
+        Accept all pending connections up to accept_batch, read the
+        indices of connections, and return instances whose connections
+        have all arrived.
+        """
+        for conn, address in accept_all(self.conn, self.accept_batch):
+            conn.setblocking(0)
+            address = address[0]
+            self.unidentified[conn] = address
+            self._check_waiting(address)
+        instances = []
+        for conn, address in list(self.unidentified.items()):
+            try:
+                index = conn.recv(1)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+                index = b""
+            del self.unidentified[conn]
+            conns = self.connections[address]
+            index = struct.unpack("!B", index)[0] if index else None
+            if index is None or index >= self.number or index in conns:
+                conn.close()
+                self._check_waiting(address)
+                continue
+            # collect connections
+            conns[index] = conn
+            if len(conns) < self.number:
+                continue
+            # create new instance
+            del self.connections[address]
+            if address in self.expiry:
+                self.expiry.pop(address).cancel()
+            self._check_waiting(address)
+            instances.append(ServerInstance(
+                [conns[i] for i in range(self.number)], address,
+                **self.opts))
+        return instances
+
+    def _check_waiting(self, address):
+        # keep the expiry timer of address only while connections of
+        # it are waiting
+        waiting = self.connections.get(address) or \
+                address in self.unidentified.values()
+        if not waiting:
+            self.connections.pop(address, None)
+            if address in self.expiry:
+                self.expiry.pop(address).cancel()
+        elif address not in self.expiry and self.timers is not None:
+            self.expiry[address] = self.timers.schedule(
+                    self.group_timeout, self._expire, address)
+
+    def dump(self, sockets):
+        """dump(sockets) --> dict
+
+        Return the state of the listener and the connections waiting
+        for their groups for upgrading, see ServerInstance.dump().
+        """
+        sockets.append(self.conn)
+        state = {'conn': len(sockets) - 1, 'connections': {},
+                 'unidentified': []}
+        for address, conns in self.connections.items():
+            state['connections'][address] = indices = {}
+            for index, conn in conns.items():
+                indices[index] = len(sockets)
+                sockets.append(conn)
+        for conn, address in self.unidentified.items():
+            state['unidentified'].append((len(sockets), address))
+            sockets.append(conn)
+        return state
+
+    @classmethod
+    def restore(cls, state, sockets, **opts):
+        self = cls(sockets[state['conn']], **opts)
+        for address, indices in state['connections'].items():
+            self.connections[address] = dict((index, sockets[i])
+                    for index, i in indices.items())
+        for i, address in state['unidentified']:
+            self.unidentified[sockets[i]] = address
+        for address in set(self.connections) | \
+                set(self.unidentified.values()):
+            self._check_waiting(address)
+        return self
+
+    def restore_instance(self, state, sockets):
+        return ServerInstance.restore(state, sockets, **self.opts)
+
+    def _expire(self, address):
+        del self.expiry[address]
+        for conn in self.connections.pop(address, {}).values():
+            conn.close()
+        for conn, conn_address in list(self.unidentified.items()):
+            if conn_address == address:
+                del self.unidentified[conn]
+                conn.close()
 
     def close(self):
+        for timer in self.expiry.values():
+            timer.cancel()
         self.conn.close()
 
     def get_rlist(self):
-        return [self.conn.fileno()]
+        return [self.conn.fileno()] + \
+                [conn.fileno() for conn in self.unidentified]
@@ -0,0 +1,204 @@
+# coding: UTF-8
+
+"""Network emulation backend.
+
+This backend wraps another backend and emulates a slower network on
+outgoing data: each chunk passed to send is held back for the
+configured delay plus a random jitter, and a bandwidth cap is applied
+by serializing chunks at the given rate. Chunks are released to the
+inner backend by timers of the event loop, so delays are rounded up to
+the timer tick of the loop (see timer_tick in the sample config).
+
+Since only outgoing data is delayed, the same config on both sides
+adds twice the delay to the round trip time.
+
+Loss and reordering are only meaningful for backends which do not
+guarantee delivery and ordering, which are marked with a true
+"datagram" attribute. They are rejected for stream backends.
+
+Config:
+
+    backend:
+      type: netem
+      inner:            # config of the wrapped backend
+        type: plain_tcp
+        server: remotehost
+      delay: 0.05       # seconds
+      jitter: 0.01      # seconds
+      rate: 1000000     # bytes per second
+"""
+
+from __future__ import division
+
+import time
+import heapq
+import random
+import socket
+
+# bytes held back before the backend reports it is not ready
+DEFAULT_QUEUE_LIMIT = 65536
+
+def _import_inner(opts):
+    inner_opts = dict(opts['inner'])
+    package = 'backend.' + inner_opts.pop('type')
+    fromlist = ['ServerBackend', 'ClientBackend']
+    inner_opts['timers'] = opts.get('timers')
+    return __import__(package, fromlist=fromlist), inner_opts
+
+def _check(inner, timers, unreliable):
+    if unreliable and not getattr(inner, 'datagram', False):
+        raise ValueError("loss and reorder need a datagram backend")
+    if timers is None:
+        raise ValueError("netem backend needs timers of the loop")
+
+class NetemBackend(object):
+
+    delay = 0
+    jitter = 0
+    rate = None
+    loss = 0
+    reorder = 0
+    queue_limit = DEFAULT_QUEUE_LIMIT
+
+    def __init__(self, backend, **opts):
+        if 'delay' in opts:
+            self.delay = opts['delay']
+        if 'jitter' in opts:
+            self.jitter = opts['jitter']
+        if 'rate' in opts:
+            self.rate = opts['rate']
+        if 'loss' in opts:
+            self.loss = opts['loss']
+        if 'reorder' in opts:
+            self.reorder = opts['reorder']
+        if 'queue_limit' in opts:
+            self.queue_limit = opts['queue_limit']
+        self.timers = opts.get('timers')
+        try:
+            _check(backend, self.timers, self.loss or self.reorder)
+        except ValueError:
+            backend.close()
+            raise
+        self.inner = backend
+        self.random = random.Random(opts.get('seed'))
+        # heap of (release time, sequence, data, urgent)
+        self.queue = []
+        self.queued = 0
+        self.seq = 0
+        self.last_release = 0
+        self.link_free = 0
+        self.timer = None
+        # An always-writable socket is put into wlist after data is
+        # released, so that the loop calls send() to flush the inner
+        # backend and to learn we are ready again.
+        self.waker, self.waker_peer = socket.socketpair()
+        self.waking = False
+
+    def send(self, data=None, urgent=True):
+        if not data:
+            return self._continue()
+        if self.loss and self.random.random() < self.loss:
+            return
+        now = time.time()
+        release = now
+        if self.rate:
+            start = max(self.link_free, now)
+            self.link_free = start + len(data) / self.rate
+            release = self.link_free
+        release += self.delay
+        if self.jitter:
+            release += self.random.uniform(-self.jitter, self.jitter)
+        if not (self.reorder and self.random.random() < self.reorder):
+            # keep order of the stream
+            release = max(release, self.last_release)
+            self.last_release = release
+        heapq.heappush(self.queue, (release, self.seq, data, urgent))
+        self.seq += 1
+        self.queued += len(data)
+        self._schedule(now)
+
+    def _schedule(self, now):
+        if self.timer is None and self.queue:
+            delay = max(0, self.queue[0][0] - now)
+            self.timer = self.timers.schedule(delay, self._release)
+
+    def _release(self):
+        self.timer = None
+        now = time.time()
+        while self.queue and self.queue[0][0] <= now:
+            release, seq, data, urgent = heapq.heappop(self.queue)
+            self.queued -= len(data)
+            self.inner.send(data, urgent)
+            self.waking = True
+        self._schedule(now)
+
+    def _continue(self):
+        self.waking = False
+        ready = self.inner.send()
+        return ready and self.queued < self.queue_limit
+
+    def recv(self):
+        return self.inner.recv()
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        # hand over everything left without delay
+        while self.queue:
+            release, seq, data, urgent = heapq.heappop(self.queue)
+            self.inner.send(data, urgent)
+        self.queued = 0
+        self.waker.close()
+        self.waker_peer.close()
+        self.inner.close()
+
+    def buffered(self):
+        buffered = getattr(self.inner, 'buffered', None)
+        return self.queued + (buffered() if buffered else 0)
+
+    def get_rlist(self):
+        return self.inner.get_rlist()
+
+    def get_wlist(self):
+        wlist = list(self.inner.get_wlist() or [])
+        if self.waking:
+            wlist.append(self.waker.fileno())
+        return wlist
+
+class ClientBackend(NetemBackend):
+
+    def __init__(self, **opts):
+        module, inner_opts = _import_inner(opts)
+        backend = module.ClientBackend(**inner_opts)
+        super(ClientBackend, self).__init__(backend, **opts)
+
+class ServerInstance(NetemBackend):
+
+    def __init__(self, backend, **opts):
+        super(ServerInstance, self).__init__(backend, **opts)
+        self.address = backend.address
+
+class ServerBackend(object):
+
+    def __init__(self, **opts):
+        module, inner_opts = _import_inner(opts)
+        self.inner = module.ServerBackend(**inner_opts)
+        self.opts = opts
+        try:
+            _check(self.inner, opts.get('timers'),
+                   opts.get('loss') or opts.get('reorder'))
+        except ValueError:
+            self.inner.close()
+            raise
+
+    def accept(self):
+        """accept() --> list of ServerInstance"""
+        return [ServerInstance(instance, **self.opts)
+                for instance in self.inner.accept()]
+
+    def close(self):
+        self.inner.close()
+
+    def get_rlist(self):
+        return self.inner.get_rlist()
@@ -3,14 +3,24 @@
 import socket
 import errno
 
+from util import create_listener, create_unix_listener, accept_all, Reader
+from util import start_connect, start_connect_unix, check_connected
+from util import set_notsent_lowat
+from util import DEFAULT_BACKLOG, DEFAULT_ACCEPT_BATCH, DEFAULT_CONNECT_TIMEOUT
+
+from . import BackendUnavailableError
+
 DEFAULT_PORT = 4194
 BUFFER_SIZE = 16384
 
 class PlainTCPBackend(object):
-    
-    def __init__(self):
+
+    __slots__ = ('conn', 'send_buf', 'is_urgent', 'reader')
+
+    def __init__(self, **opts):
         self.send_buf = b""
         self.is_urgent = True
+        self.reader = Reader(**opts)
 
     def send(self, data=None, urgent=True):
         if not data:
@@ -37,16 +47,19 @@ class PlainTCPBackend(object):
         return len(self.send_buf) < BUFFER_SIZE
 
     def recv(self):
-        data = self.conn.recv(4096)
-        if data == b"":
-            data = None
-        return data
+        return self.reader.read(self.conn)
 
     def close(self):
-        self.conn.setblocking(1)
-        # TODO make close non-blocking
+        # remaining data in the kernel buffer is sent in background
         self.conn.close()
 
+    def buffered(self):
+        """buffered() --> int
+
+        Number of bytes waiting for being sent.
+        """
+        return len(self.send_buf)
+
     def get_rlist(self):
         return [self.conn.fileno()]
 
@@ -55,51 +68,181 @@ class PlainTCPBackend(object):
             return [self.conn.fileno()]
 
 class ClientBackend(PlainTCPBackend):
+    """ClientBackend(**opts) --> ClientBackend object
+
+    The connection is established in the event loop. Data sent before
+    it is established is buffered. If it is not established within
+    connect_timeout seconds, BackendUnavailableError is raised from
+    the timer, which requires timers of the loop to be given.
+
+    If unix is given, the Unix socket at that path is connected to
+    instead of server and port.
+    """
 
     server = "127.0.0.1"
     port = DEFAULT_PORT
+    unix = None
+    connect_timeout = DEFAULT_CONNECT_TIMEOUT
 
     def __init__(self, **opts):
-        super(ClientBackend, self).__init__()
+        super(ClientBackend, self).__init__(**opts)
         if 'server' in opts:
             self.server = opts['server']
         if 'port' in opts:
             self.port = opts['port']
+        if 'unix' in opts:
+            self.unix = opts['unix']
+        if 'connect_timeout' in opts:
+            self.connect_timeout = opts['connect_timeout']
         # initialize socket
-        self.conn = socket.create_connection((self.server, self.port))
-        self.conn.setblocking(0)
+        if self.unix:
+            self.target = self.unix
+            self.conn = start_connect_unix(self.unix)
+        else:
+            self.target = "{0}:{1}".format(self.server, self.port)
+            self.conn = start_connect(self.server, self.port)
+        set_notsent_lowat(self.conn, opts.get('notsent_lowat'))
+        self.connecting = True
+        self.connect_timer = None
+        timers = opts.get('timers')
+        if timers is not None and self.connect_timeout:
+            self.connect_timer = timers.schedule(self.connect_timeout,
+                    self._connect_expired)
+
+    def _connect_expired(self):
+        self.connect_timer = None
+        if self.connecting:
+            msg = "connecting to {0} timed out".format(self.target)
+            raise BackendUnavailableError(msg)
+
+    def _continue(self):
+        if self.connecting:
+            try:
+                self.connecting = not check_connected(self.conn)
+            except socket.error as e:
+                msg = "cannot connect to {0}: {1}".format(self.target, e)
+                raise BackendUnavailableError(msg)
+            if self.connecting:
+                return len(self.send_buf) < BUFFER_SIZE
+            if self.connect_timer:
+                self.connect_timer.cancel()
+                self.connect_timer = None
+        return super(ClientBackend, self)._continue()
+
+    def close(self):
+        if self.connect_timer:
+            self.connect_timer.cancel()
+            self.connect_timer = None
+        super(ClientBackend, self).close()
+
+    def get_rlist(self):
+        if self.connecting:
+            return []
+        return super(ClientBackend, self).get_rlist()
+
+    def get_wlist(self):
+        if self.connecting:
+            return [self.conn.fileno()]
+        return super(ClientBackend, self).get_wlist()
 
 class ServerInstance(PlainTCPBackend):
 
-    def __init__(self, conn, address):
-        super(ServerInstance, self).__init__()
+    __slots__ = ('address',)
+
+    def __init__(self, conn, address, **opts):
+        super(ServerInstance, self).__init__(**opts)
         self.conn = conn
         self.address = address
+        set_notsent_lowat(conn, opts.get('notsent_lowat'))
         self.conn.setblocking(0)
 
+    def dump(self, sockets):
+        """dump(sockets) --> dict
+
+        Return the state of this instance for upgrading, in which its
+        socket is referred to by the index in list sockets it is
+        appended to.
+        """
+        sockets.append(self.conn)
+        return {'conn': len(sockets) - 1, 'address': self.address,
+                'send_buf': self.send_buf, 'is_urgent': self.is_urgent}
+
+    @classmethod
+    def restore(cls, state, sockets, **opts):
+        self = cls(sockets[state['conn']], state['address'], **opts)
+        self.send_buf = state['send_buf']
+        self.is_urgent = state['is_urgent']
+        return self
+
 class ServerBackend(object):
+    """ServerBackend(conn=None, **opts) --> ServerBackend object
+
+    If conn is given, it is used as the listening socket instead of
+    creating a new one. If unix is given, the server listens on the
+    Unix socket at that path instead of address and port, and the path
+    stands for the address of the clients.
+    """
 
     address = ""
     port = DEFAULT_PORT
+    unix = None
+    backlog = DEFAULT_BACKLOG
+    accept_batch = DEFAULT_ACCEPT_BATCH
+    reuseport = False
 
-    def __init__(self, **opts):
+    def __init__(self, conn=None, **opts):
+        self.opts = opts
         if 'address' in opts:
             self.address = opts['address']
         if 'port' in opts:
             self.port = opts['port']
+        if 'unix' in opts:
+            self.unix = opts['unix']
+        if 'backlog' in opts:
+            self.backlog = opts['backlog']
+        if 'accept_batch' in opts:
+            self.accept_batch = opts['accept_batch']
+        if 'reuseport' in opts:
+            self.reuseport = opts['reuseport']
 
         # initialize socket
-        self.conn = socket.socket(socket.AF_INET6
-                if socket.has_ipv6 else socket.AF_INET)
-        self.conn.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.conn.bind((self.address, self.port))
-        self.conn.listen(10)
+        if conn is None and self.unix:
+            conn = create_unix_listener(self.unix, self.backlog)
+        elif conn is None:
+            conn = create_listener(self.address, self.port,
+                    socket.AF_INET6 if socket.has_ipv6 else socket.AF_INET,
+                    self.backlog, self.reuseport)
+        self.conn = conn
 
     def accept(self):
-        conn, address = self.conn.accept()
-        return ServerInstance(conn, address[0])
+        """accept() --> list of ServerInstance
+
+        Accept all pending connections up to accept_batch.
+        """
+        conns = accept_all(self.conn, self.accept_batch)
+        return [ServerInstance(conn,
+                    self.unix if self.unix else address[0], **self.opts)
+                for conn, address in conns]
+
+    def dump(self, sockets):
+        """dump(sockets) --> dict
+
+        Return the state of the listener for upgrading, see
+        ServerInstance.dump().
+        """
+        sockets.append(self.conn)
+        return {'conn': len(sockets) - 1}
+
+    @classmethod
+    def restore(cls, state, sockets, **opts):
+        return cls(sockets[state['conn']], **opts)
+
+    def restore_instance(self, state, sockets):
+        return ServerInstance.restore(state, sockets, **self.opts)
 
     def close(self):
+        # the file of a Unix socket is left, as the socket may have been
+        # passed to a new process, and it is replaced on the next start
         self.conn.close()
 
     def get_rlist(self):
@@ -0,0 +1,128 @@
+# coding: UTF-8
+
+"""Capture of tunnel packets for replaying.
+
+A capture file records the packets sent and received by tunnel layer
+connections, with the time they were sent or received, so that real
+traffic can be fed through the record and tunnel layers again by
+benchmark/replay.py.
+
+File Structure:
+
+    header      "USCAP", 8-bit version = 1, 8-bit flags
+    frames      repeated until the end of file
+
+    Flags       1 if bodies of all packets are captured
+
+    Each frame starts with the following header in network byte
+    order, followed by the body of the packet if it is captured:
+
+        time        double, seconds since the capture started
+        tunnel      32-bit number of the tunnel
+        direction   8-bit, 0 for sent and 1 for received
+        control     8-bit control bits of the packet
+        conn_id     16-bit Connection ID or Flow ID
+        size        32-bit size of the body
+
+    Bodies are taken as they are on the wire, i.e. after compression.
+    Bodies of the control channel are always captured, as they are
+    needed to negotiate compression again.
+"""
+
+import time
+import struct
+
+VERSION_CODE = 1
+SENT = 0
+RECEIVED = 1
+
+file_header_format = "!5sBB"
+file_header_size = struct.calcsize(file_header_format)
+frame_format = "!dIBBHI"
+frame_size = struct.calcsize(frame_format)
+magic = b"USCAP"
+payloads_flag = 1
+
+class CaptureFormatError(Exception): pass
+
+class Capture(object):
+    """Capture(**opts) --> Capture object
+
+    Options:
+        file        path of the capture file, which is overwritten
+        payloads    whether bodies of all packets are captured, which
+                    may contain sensitive data
+    """
+
+    payloads = False
+
+    def __init__(self, **opts):
+        if 'payloads' in opts:
+            self.payloads = opts['payloads']
+        self.file = open(opts['file'], 'wb')
+        self.file.write(struct.pack(file_header_format, magic,
+            VERSION_CODE, payloads_flag if self.payloads else 0))
+        self.start = time.time()
+
+    def tunnel(self, number):
+        """tunnel(number) --> TunnelCapture
+
+        Return the capture of the tunnel identified by number.
+        """
+        return TunnelCapture(self, number)
+
+    def write(self, number, direction, control, conn_id, data):
+        self.file.write(struct.pack(frame_format, time.time() - self.start,
+            number, direction, control, conn_id, len(data)))
+        if self.payloads or conn_id == 0:
+            self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+class TunnelCapture(object):
+    """TunnelCapture(capture, number) --> TunnelCapture object
+
+    Capture of the packets of one tunnel, see TunnelConnection.capture.
+    """
+
+    __slots__ = ('capture', 'number')
+
+    def __init__(self, capture, number):
+        self.capture = capture
+        self.number = number
+
+    def sent(self, control, conn_id, data):
+        self.capture.write(self.number, SENT, control, conn_id, data)
+
+    def received(self, control, conn_id, data):
+        self.capture.write(self.number, RECEIVED, control, conn_id, data)
+
+def read(f):
+    """read(f) --> (payloads, frames)
+
+    Read the capture in file object f opened in binary mode. frames
+    yields (time, tunnel, direction, control, conn_id, size, body),
+    in which body is None if it is not captured.
+    """
+    header = f.read(file_header_size)
+    if len(header) < file_header_size:
+        raise CaptureFormatError("capture file is truncated")
+    name, version, flags = struct.unpack(file_header_format, header)
+    if name != magic or version != VERSION_CODE:
+        raise CaptureFormatError("not a capture file of this version")
+    payloads = bool(flags & payloads_flag)
+    def frames():
+        while True:
+            header = f.read(frame_size)
+            if len(header) < frame_size:
+                # the end, or the last frame written when killed
+                return
+            frame = struct.unpack(frame_format, header)
+            body = None
+            if payloads or frame[4] == 0:
+                body = f.read(frame[5])
+                if len(body) < frame[5]:
+                    return
+            yield frame + (body,)
+    return payloads, frames()
@@ -3,7 +3,9 @@
 
 from __future__ import print_function, unicode_literals
 
+import os
 import sys
+import time
 import yaml
 import errno
 import struct
@@ -19,19 +21,37 @@ from itertools import chain
 import record
 import tunnel
 
-from util import ObjectSet
 from util import import_backend
-from util import get_select_list
-from record import RecordConnection
-from tunnel import StatusControl, TunnelConnection
+from util import get_select_list, SignalWaker
+from util import create_listener, create_unix_listener, accept_all, Reader
+from util import recv_datagrams, send_datagram
+from util import DEFAULT_BACKLOG, DEFAULT_ACCEPT_BATCH, DEFAULT_CLOSE_TIMEOUT
+from util import DEFAULT_FLOW_TIMEOUT
+from backend import BackendUnavailableError
+from timer import TimerWheel, DEFAULT_TICK
+from record import RecordConnection, Keepalive, CoverTraffic
+from profiling import Watchdog, ProfileToggle
+from tracing import Tracer
+from capture import Capture
+from compression import CompressionError
+from tunnel import StatusControl, TunnelConnection, NoIDAvailableError
+from tunnel import UnexpectedCompressionError
+from tunnel import max_target_size
 
 class Connection(object):
 
-    def __init__(self, conn, conn_id):
+    __slots__ = ('conn', 'conn_id', 'send_buf', 'last_active',
+            'idle_timer', 'reader', 'trace')
+
+    def __init__(self, conn, conn_id, reader=None):
         self.conn = conn
         self.conn_id = conn_id
         self.conn.setblocking(0)
         self.send_buf = b""
+        self.last_active = time.time()
+        self.idle_timer = None
+        self.reader = reader
+        self.trace = None
 
     def send(self, data=None):
         if data:
@@ -48,8 +68,10 @@ class Connection(object):
         if sent:
             self.send_buf = self.send_buf[sent:]
 
+    def recv(self):
+        return self.reader.read(self.conn)
+
     def close(self):
-        self.conn.setblocking(1)
         self.conn.close()
 
     def reset(self):
@@ -57,6 +79,9 @@ class Connection(object):
                 socket.SO_LINGER, struct.pack(b"ii", 1, 0))
         self.close()
 
+    def fileno(self):
+        return self.conn.fileno()
+
     def get_rlist(self):
         return [self.fileno()]
 
@@ -64,129 +89,404 @@ class Connection(object):
         if self.send_buf:
             return [self.fileno()]
 
-    def __getattr__(self, name):
-        return getattr(self.conn, name)
+class Flow(object):
+    """Flow(flow_id, address) --> Flow object
+
+    Datagram flow from a local UDP address.
+    """
+
+    __slots__ = ('flow_id', 'address', 'last_active', 'idle_timer')
+
+    def __init__(self, flow_id, address):
+        self.flow_id = flow_id
+        self.address = address
+        self.last_active = time.time()
+        self.idle_timer = None
 
 class TunnelClient(object):
 
     address = "localhost"
     port = 8000
+    # path of a Unix socket listened on instead of address and port
+    unix = None
+    backlog = DEFAULT_BACKLOG
+    accept_batch = DEFAULT_ACCEPT_BATCH
+    reuseport = False
+    # seconds after which idle connections are closed, None means never
+    idle_timeout = None
+    # options of keepalive, None means disabled
+    keepalive = None
+    # options of cover traffic, None means disabled
+    cover = None
+    # options of compression, None means disabled
+    compression = None
+    # options of tracing, None means disabled
+    tracing = None
+    # options of capturing packets of the tunnel, None means disabled
+    capture = None
+    # resolution of timers in seconds
+    timer_tick = DEFAULT_TICK
+    # seconds to wait for remaining data to be sent when exiting
+    close_timeout = DEFAULT_CLOSE_TIMEOUT
+    # options of local UDP port, None means disabled
+    udp = None
 
     def __init__(self, config):
-        self.local_conn = Connection(socket.socket(), -1)
+        if 'timer_tick' in config:
+            self.timer_tick = config['timer_tick']
+        self.timers = TimerWheel(self.timer_tick)
+        self.now = time.time()
         # read config
         if 'address' in config:
             self.address = config['address']
         if 'port' in config:
             self.port = config['port']
+        if 'unix' in config:
+            self.unix = config['unix']
+        if 'backlog' in config:
+            self.backlog = config['backlog']
+        if 'accept_batch' in config:
+            self.accept_batch = config['accept_batch']
+        if 'reuseport' in config:
+            self.reuseport = config['reuseport']
+        if 'idle_timeout' in config:
+            self.idle_timeout = config['idle_timeout']
+        if 'keepalive' in config:
+            self.keepalive = config['keepalive']
+        if 'cover' in config:
+            self.cover = config['cover']
+        if 'compression' in config:
+            self.compression = config['compression']
+        if 'tracing' in config:
+            self.tracing = config['tracing']
+        if 'capture' in config:
+            self.capture = config['capture']
+        if 'close_timeout' in config:
+            self.close_timeout = config['close_timeout']
+        if 'udp' in config:
+            self.udp = config['udp']
+        # options of readers of local connections
+        self.read_opts = dict((name, config[name]) for name in
+                ('read_size', 'max_read_size', 'read_budget')
+                if name in config)
         # initialize local port
-        self.local_conn.conn.setsockopt(
-                socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.local_conn.bind((self.address, self.port))
-        self.local_conn.listen(10)
+        listeners = config.get('listeners')
+        if listeners is None:
+            listeners = [{'address': self.address, 'port': self.port,
+                'unix': self.unix}]
+        # dictionary of listening connections to the names of their
+        # targets, None for the default one of the server
+        self.listeners = {}
+        self.unix_paths = []
+        for opts in listeners:
+            target = opts.get('target')
+            if target is not None:
+                target = target.encode('utf-8')
+                if len(target) > max_target_size:
+                    raise ValueError("name of target is too long")
+            if opts.get('unix'):
+                local_conn = create_unix_listener(opts['unix'],
+                        self.backlog)
+                self.unix_paths.append(opts['unix'])
+            else:
+                local_conn = create_listener(
+                        opts.get('address', self.address), opts['port'],
+                        backlog=self.backlog, reuseport=self.reuseport)
+            self.listeners[Connection(local_conn, -1)] = target
+        # listeners of named targets are not served until the server
+        # has confirmed that it supports targets
+        self.targets_ready = all(target is None
+                for target in self.listeners.values())
+        # initialize local UDP port, whose flows are dictionaries of
+        # source addresses and Flow IDs to Flow objects
+        self.udp_conn = None
+        self.flows = {}
+        self.flow_ids = {}
+        if self.udp is not None:
+            self.flow_timeout = self.udp.get('idle_timeout',
+                    DEFAULT_FLOW_TIMEOUT)
+            udp_conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_conn.bind((self.udp.get('address', self.address),
+                self.udp['port']))
+            self.udp_conn = Connection(udp_conn, -1)
         # initialize backend & record layer
         Backend = import_backend(config).ClientBackend
-        self.backend = Backend(**config['backend'])
+        self.backend = Backend(timers=self.timers, **config['backend'])
         self.record_conn = RecordConnection(config['key'], self.backend)
-        self.tunnel = TunnelConnection(self.record_conn)
+        self.tunnel = TunnelConnection(self.record_conn, self.compression)
+        self.capturer = None
+        if self.capture is not None:
+            self.capturer = Capture(**self.capture)
+            self.tunnel.capture = self.capturer.tunnel(0)
+        # features are needed by tracing and targets, see the tunnel
+        # module
+        self.tunnel.send_hello(features=self.tracing is not None or
+                not self.targets_ready)
+        # prove knowledge of the key at once, which is required by
+        # servers with a handshake deadline
+        self.record_conn.send_nodata()
+        self.dead = False
+        # loop instrumentation
+        profiling = config.get('profiling', {})
+        self.watchdog = None
+        if 'slow_threshold' in profiling:
+            self.watchdog = Watchdog(self._report_slow,
+                    profiling['slow_threshold'])
+        self.profile_toggle = ProfileToggle(profiling.get('profile_file'))
+        self.tracer = None
+        if self.tracing is not None:
+            self.tracer = Tracer('client', **self.tracing)
+        self.signal_waker = SignalWaker()
+        if self.keepalive is not None:
+            Keepalive(self.timers, self.record_conn,
+                    self._keepalive_dead, self._keepalive_slow,
+                    **self.keepalive)
+        if self.cover is not None:
+            CoverTraffic(self.timers, self.record_conn, **self.cover)
         # initialize connection dict
         self.conns = {}
 
     def run(self):
         self.running = True
         while self.running:
-            self._process()
+            try:
+                self._process()
+            except BackendUnavailableError as e:
+                logging.error("%s", e)
+                self.dead = True
+                self.running = False
         # close connections
-        self.local_conn.close()
-        for conn in self.conns.itervalues():
+        self.signal_waker.close()
+        for local_conn in self.listeners:
+            local_conn.close()
+        for unix in self.unix_paths:
+            if os.path.exists(unix):
+                os.unlink(unix)
+        if self.udp_conn:
+            self.udp_conn.close()
+        for conn in self.conns.values():
             conn.close()
-        self.record_conn.close()
-        while True:
+        self.tunnel.close()
+        deadline = time.time() + self.close_timeout
+        while not self.dead:
             wlist = self.record_conn.get_wlist()
-            if not wlist:
+            timeout = deadline - time.time()
+            if not wlist or timeout <= 0:
                 break
-            select.select([], wlist, [])
+            select.select([], wlist, [], timeout)
             self.record_conn.continue_sending()
         self.backend.close()
+        if self.tracer:
+            self.tracer.close()
+        if self.capturer:
+            self.capturer.close()
 
     def _process(self):
-        rlist, rdict = get_select_list('get_rlist', 
-                self.tunnel, self.local_conn,
-                self.conns.itervalues() if self.tunnel.available else [])
+        udp_conn = (self.udp_conn,) if self.udp_conn else ()
+        listeners = self.listeners
+        if not self.targets_ready:
+            listeners = [local_conn for local_conn, target
+                    in listeners.items() if target is None]
+        rlist, rdict = get_select_list('get_rlist',
+                (self._process_signal, (self.signal_waker,)),
+                (self._process_tunnel, (self.tunnel,)),
+                (self._process_listening, listeners),
+                (self._process_udp, udp_conn),
+                (self._process_connection, self.conns.values()
+                    if self.tunnel.available else ()))
         wlist, wdict = get_select_list('get_wlist',
-                self.tunnel, self.conns.itervalues())
+                (self._process_tunnel_sending, (self.tunnel,)),
+                (self._process_sending, self.conns.values()))
         try:
-            rlist, wlist, _ = select.select(rlist, wlist, [])
+            rlist, wlist, _ = select.select(rlist, wlist, [],
+                    self.timers.timeout())
         except select.error as e:
-            if e[0] == errno.EINTR:
+            if e.args[0] == errno.EINTR:
                 return
             raise
+        self.now = time.time()
+        watchdog = self.watchdog
+        if watchdog:
+            watchdog.begin()
+            watchdog.enter('timers')
+        self.timers.advance(self.now)
 
         for fileno in rlist:
-            conn = rdict[fileno]
-            if conn is self.tunnel:
-                self._process_tunnel()
-            elif conn is self.local_conn:
-                self._process_listening()
-            elif conn.conn_id in self.conns:
-                self._process_connection(conn)
-        written_conns = ObjectSet()
+            handler, conn = rdict[fileno]
+            if watchdog:
+                watchdog.enter('read', conn)
+            handler(conn)
+        written_conns = set()
         for fileno in wlist:
-            conn = wdict[fileno]
+            handler, conn = wdict[fileno]
             if conn in written_conns:
                 continue
             written_conns.add(conn)
-            self._process_sending(conn)
+            if watchdog:
+                watchdog.enter('write', conn)
+            handler(conn)
+        if watchdog:
+            watchdog.end()
 
-    def _process_tunnel(self):
+    def _process_signal(self, signal_waker):
+        signal_waker.clear()
+
+    def _report_slow(self, total, spans):
+        for duration, phase, conn in spans:
+            if conn is self.tunnel:
+                what = "tunnel"
+            elif conn is None or conn in self.listeners or \
+                    conn is self.signal_waker or conn is self.udp_conn:
+                what = "client"
+            else:
+                what = "connection {0}".format(conn.conn_id)
+            logging.warning("slow iteration took %.0fms, %.0fms in %s %s",
+                    total * 1000, duration * 1000, phase, what)
+
+    def _process_tunnel(self, tunnel):
         try:
             for conn_id, control, data in self.tunnel.receive_packets():
+                if control & StatusControl.dgr:
+                    self._process_datagram(conn_id, control, data)
+                    continue
                 if conn_id not in self.conns:
                     continue
                 conn = self.conns[conn_id]
                 if control & StatusControl.rst:
                     self._close_connection(conn_id, True)
                 if control & StatusControl.dat:
+                    conn.last_active = self.now
+                    if conn.trace is not None:
+                        conn.trace.mark('first_response')
                     conn.send(data)
                 if control & StatusControl.fin:
                     self._close_connection(conn_id)
         except record.ConnectionClosedException:
             self.running = False
+        except (CompressionError, UnexpectedCompressionError):
+            logging.error("invalid compressed data from server")
+            self.running = False
+        if not self.targets_ready and self.tunnel.features is not None:
+            self._check_targets()
 
-    def _process_listening(self):
-        conn, address = self.local_conn.accept()
-        conn_id = self.tunnel.new_connection()
-        conn = Connection(conn, conn_id)
-        self.conns[conn_id] = conn
+    def _check_targets(self):
+        self.targets_ready = True
+        if "target" in self.tunnel.features:
+            return
+        logging.error("server does not support targets, "
+                "their listeners are closed")
+        for local_conn, target in list(self.listeners.items()):
+            if target is not None:
+                local_conn.close()
+                del self.listeners[local_conn]
+
+    def _process_listening(self, local_conn):
+        target = self.listeners[local_conn]
+        for conn, address in accept_all(local_conn.conn, self.accept_batch):
+            conn_id = self.tunnel.new_connection(target)
+            conn = Connection(conn, conn_id, Reader(**self.read_opts))
+            if self.tracer:
+                conn.trace = self.tracer.sample()
+            self.conns[conn_id] = conn
+            if self.idle_timeout:
+                conn.idle_timer = self.timers.schedule(
+                        self.idle_timeout, self._check_idle, conn)
+            # send SYN along with the first data if it has arrived
+            if self.tunnel.available:
+                self._process_connection(conn)
 
     def _process_connection(self, conn):
         conn_id = conn.conn_id
+        # the connection may have been closed earlier in this iteration
+        if self.conns.get(conn_id) is not conn:
+            return
         try:
-            data = conn.recv(4096)
+            data = conn.recv()
         except socket.error as e:
             if e.errno == errno.ECONNRESET:
                 self.tunnel.reset_connection(conn_id)
                 self._close_connection(conn_id)
                 return
             raise
-        if not data:
+        if data is None:
             self.tunnel.close_connection(conn_id)
             self._close_connection(conn_id)
-        else:
-            self.tunnel.send_packet(conn_id, data)
+        elif data:
+            conn.last_active = self.now
+            trace = conn.trace
+            if trace is not None and trace.mark('first_read'):
+                self.tunnel.send_packet(conn_id, data, trace)
+            else:
+                self.tunnel.send_packet(conn_id, data)
+
+    def _process_datagram(self, flow_id, control, data):
+        flow = self.flow_ids.get(flow_id)
+        if flow is None or not (control & StatusControl.dat):
+            return
+        flow.last_active = self.now
+        send_datagram(self.udp_conn.conn, data, flow.address)
+
+    def _process_udp(self, udp_conn):
+        for data, address in recv_datagrams(udp_conn.conn):
+            flow = self.flows.get(address)
+            if flow is None:
+                try:
+                    flow_id = self.tunnel.new_flow()
+                except NoIDAvailableError:
+                    continue
+                flow = Flow(flow_id, address)
+                self.flows[address] = self.flow_ids[flow_id] = flow
+                flow.idle_timer = self.timers.schedule(
+                        self.flow_timeout, self._check_flow_idle, flow)
+            flow.last_active = self.now
+            self.tunnel.send_datagram(flow.flow_id, data)
+
+    def _check_flow_idle(self, flow):
+        idle = self.now - flow.last_active
+        if idle < self.flow_timeout:
+            flow.idle_timer = self.timers.schedule(
+                    self.flow_timeout - idle, self._check_flow_idle, flow)
+            return
+        del self.flows[flow.address]
+        del self.flow_ids[flow.flow_id]
+        self.tunnel.close_flow(flow.flow_id)
+
+    def _process_tunnel_sending(self, tunnel):
+        tunnel.continue_sending()
 
     def _process_sending(self, conn):
-        if conn is self.tunnel:
-            conn.continue_sending()
-        elif conn.conn_id in self.conns:
+        if self.conns.get(conn.conn_id) is conn:
             conn.send()
 
+    def _keepalive_dead(self):
+        logging.warning("server does not respond, exiting")
+        self.record_conn.closed = True
+        self.dead = True
+        self.running = False
+
+    def _keepalive_slow(self, srtt):
+        logging.warning("round trip time rises to %.0fms", srtt * 1000)
+
+    def _check_idle(self, conn):
+        idle = self.now - conn.last_active
+        if idle < self.idle_timeout:
+            conn.idle_timer = self.timers.schedule(
+                    self.idle_timeout - idle, self._check_idle, conn)
+            return
+        self.tunnel.close_connection(conn.conn_id)
+        self._close_connection(conn.conn_id)
+
     def _close_connection(self, conn_id, reset=False):
+        conn = self.conns.pop(conn_id)
+        if conn.idle_timer:
+            conn.idle_timer.cancel()
         if reset:
-            self.conns[conn_id].reset()
+            conn.reset()
         else:
-            self.conns[conn_id].close()
-        del self.conns[conn_id]
+            conn.close()
+        if conn.trace is not None:
+            conn.trace.mark('close')
+            self.tracer.finish(conn.trace)
 
 def usage():
     pass
@@ -196,7 +496,7 @@ def main():
         opts, args = getopt.getopt(sys.argv[1:], "hc:v",
                 ["help", "config=", "verbose"])
     except getopt.GetoptError as e:
-        print(str(err), file=sys.stderr)
+        print(str(e), file=sys.stderr)
         usage()
         sys.exit(2)
 
@@ -227,7 +527,7 @@ def main():
         else:
             print("cannot find config file", file=sys.stderr)
             sys.exit(2)
-    config = yaml.load(open(config_file, "r"))
+    config = yaml.safe_load(open(config_file, "r"))
     if 'client' not in config:
         print("cannot find client config", file=sys.stderr)
         sys.exit(1)
@@ -239,6 +539,7 @@ def main():
         client.running = False
     signal.signal(signal.SIGINT, handler)
     signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGUSR1, client.profile_toggle.toggle)
     # start client
     client.run()
 
@@ -0,0 +1,146 @@
+# coding: UTF-8
+
+"""Compression of tunnel packets.
+
+Data of each tunnel packet is compressed independently, so that no
+per-stream compressor state has to be kept. zlib is always available;
+lz4 is preferred when the lz4 module is installed.
+
+Compressor tracks how well the data of each stream compresses. Once a
+stream turns out to be incompressible (e.g. TLS or media), its data is
+sent as-is for a while before trying again, so CPU is only spent where
+it saves bandwidth.
+"""
+
+import zlib
+import struct
+
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+# max size of decompressed data of one packet
+MAX_SIZE = 1 << 22
+
+class CompressionError(Exception): pass
+
+class ZlibCodec(object):
+
+    name = "zlib"
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        decompressor = zlib.decompressobj()
+        try:
+            result = decompressor.decompress(data, MAX_SIZE)
+        except zlib.error:
+            raise CompressionError()
+        if decompressor.unconsumed_tail:
+            raise CompressionError()
+        return result
+
+class LZ4Codec(object):
+
+    name = "lz4"
+
+    def __init__(self, level=1):
+        pass
+
+    def compress(self, data):
+        return lz4_block.compress(data, store_size=True)
+
+    def decompress(self, data):
+        if len(data) < 4 or struct.unpack("<I", data[:4])[0] > MAX_SIZE:
+            raise CompressionError()
+        try:
+            return lz4_block.decompress(data)
+        except Exception:
+            raise CompressionError()
+
+# codecs in order of preference
+CODECS = [ZlibCodec]
+if lz4_block is not None:
+    CODECS.insert(0, LZ4Codec)
+
+def available():
+    """available() --> list of str
+
+    Names of available codecs in order of preference.
+    """
+    return [codec.name for codec in CODECS]
+
+class Compressor(object):
+    """Compressor(name, **opts) --> Compressor object
+
+    Options:
+        level       compression level of zlib
+        min_size    data shorter than it is never compressed
+        threshold   ratio of compressed size to original size above
+                    which a stream is considered incompressible
+        sample      bytes of a stream compressed before judging it
+        retry       bytes of an incompressible stream sent as-is
+                    before trying to compress it again
+    """
+
+    level = 1
+    min_size = 256
+    threshold = 0.9
+    sample = 16384
+    retry = 1 << 20
+
+    def __init__(self, name, **opts):
+        if 'level' in opts:
+            self.level = opts['level']
+        if 'min_size' in opts:
+            self.min_size = opts['min_size']
+        if 'threshold' in opts:
+            self.threshold = opts['threshold']
+        if 'sample' in opts:
+            self.sample = opts['sample']
+        if 'retry' in opts:
+            self.retry = opts['retry']
+        for codec in CODECS:
+            if codec.name == name:
+                self.codec = codec(self.level)
+                break
+        else:
+            raise ValueError("unknown codec: " + name)
+        # dictionary of Connection ID to a list of bytes compressed,
+        # size of them after compression, and bytes left to skip
+        self.streams = {}
+
+    def compress(self, conn_id, data):
+        """compress(conn_id, data) --> str or None
+
+        Return compressed data, or None if data should be sent as-is.
+        """
+        if len(data) < self.min_size:
+            return None
+        state = self.streams.get(conn_id)
+        if state is None:
+            state = self.streams[conn_id] = [0, 0, 0]
+        if state[2] > 0:
+            state[2] -= len(data)
+            return None
+        result = self.codec.compress(data)
+        state[0] += len(data)
+        state[1] += min(len(result), len(data))
+        if state[0] >= self.sample:
+            if state[1] > state[0] * self.threshold:
+                state[2] = self.retry
+            state[0] = state[1] = 0
+        if len(result) >= len(data):
+            return None
+        return result
+
+    def decompress(self, data):
+        return self.codec.decompress(data)
+
+    def forget(self, conn_id):
+        self.streams.pop(conn_id, None)
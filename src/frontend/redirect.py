@@ -3,30 +3,63 @@
 import errno
 import socket
 
+from util import Reader
+
 from . import FrontendUnavailableError
 
 class FrontendServer(object):
 
     server = "localhost"
     port = 80
+    # path of a Unix socket connected to instead of server and port
+    unix = None
+
+    __slots__ = ('conn', 'send_buf', 'reader')
 
     def __init__(self, **opts):
-        if 'server' in opts:
-            self.server = opts['server']
-        if 'port' in opts:
-            self.port = opts['port']
-        
+        server = opts.get('server', self.server)
+        port = opts.get('port', self.port)
+        unix = opts.get('unix', self.unix)
+
         # initialize socket
         try:
-            self.conn = socket.create_connection((self.server, self.port))
+            if unix:
+                target = unix
+                self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    self.conn.connect(unix)
+                except socket.error:
+                    self.conn.close()
+                    raise
+            else:
+                target = "{0}:{1}".format(server, port)
+                self.conn = socket.create_connection((server, port))
         except socket.error as e:
-            if e.errno == errno.ECONNREFUSED:
-                msg = "connection to {0}:{1} is refused" \
-                        .format(self.server, self.port)
+            if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                msg = "connection to {0} is refused".format(target)
                 raise FrontendUnavailableError(msg)
             raise
         self.conn.setblocking(0)
         self.send_buf = b""
+        self.reader = Reader(**opts)
+
+    def dump(self, sockets):
+        """dump(sockets) --> dict
+
+        Return the state of this frontend for upgrading, in which its
+        socket is referred to by the index in list sockets it is
+        appended to.
+        """
+        sockets.append(self.conn)
+        return {'conn': len(sockets) - 1, 'send_buf': self.send_buf}
+
+    @classmethod
+    def restore(cls, state, sockets, **opts):
+        self = cls.__new__(cls)
+        self.conn = sockets[state['conn']]
+        self.send_buf = state['send_buf']
+        self.reader = Reader(**opts)
+        return self
 
     def send(self, data=None):
         if data:
@@ -47,10 +80,7 @@ class FrontendServer(object):
             self.send_buf = self.send_buf[sent:]
 
     def recv(self):
-        data = self.conn.recv(4096)
-        if data == b"":
-            data = None
-        return data
+        return self.reader.read(self.conn)
 
     def close(self):
         self.conn.close()
@@ -0,0 +1,171 @@
+# coding: UTF-8
+
+"""Asynchronous hostname resolver with a TTL-bounded LRU cache.
+
+Lookups run in a small pool of worker threads so that a slow DNS
+answer never stalls the event loop. Results, including failures, are
+cached for a limited time, and concurrent lookups of the same name
+share one query.
+
+The event loop is notified through a Notifier, which is a pipe whose
+read end can be passed to select().
+"""
+
+import os
+import time
+import socket
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from collections import OrderedDict
+
+DEFAULT_THREADS = 4
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_TTL = 300
+DEFAULT_NEGATIVE_TTL = 30
+
+class Notifier(object):
+    """Notifier() --> Notifier object
+
+    Self-pipe which can be written from any thread and selected by
+    the event loop. It stays readable until clear() is called.
+    """
+
+    def __init__(self):
+        self._rfd, self._wfd = os.pipe()
+        self._lock = threading.Lock()
+        self._notified = False
+        self.closed = False
+
+    def notify(self):
+        with self._lock:
+            if self.closed or self._notified:
+                return
+            self._notified = True
+            os.write(self._wfd, b"\0")
+
+    def clear(self):
+        with self._lock:
+            if self.closed or not self._notified:
+                return
+            self._notified = False
+            os.read(self._rfd, 1)
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            os.close(self._rfd)
+            os.close(self._wfd)
+
+    def fileno(self):
+        return self._rfd
+
+class Resolver(object):
+    """Resolver(**opts) --> Resolver object
+
+    Options:
+        threads         number of worker threads
+        cache_size      max number of names kept in cache
+        ttl             seconds a successful answer is kept
+        negative_ttl    seconds a failed lookup is kept
+    """
+
+    threads = DEFAULT_THREADS
+    cache_size = DEFAULT_CACHE_SIZE
+    ttl = DEFAULT_TTL
+    negative_ttl = DEFAULT_NEGATIVE_TTL
+
+    def __init__(self, **opts):
+        if 'threads' in opts:
+            self.threads = opts['threads']
+        if 'cache_size' in opts:
+            self.cache_size = opts['cache_size']
+        if 'ttl' in opts:
+            self.ttl = opts['ttl']
+        if 'negative_ttl' in opts:
+            self.negative_ttl = opts['negative_ttl']
+
+        self._lock = threading.Lock()
+        # host -> (expire time, addresses or exception)
+        self._cache = OrderedDict()
+        # host -> list of callbacks waiting for the answer
+        self._pending = {}
+        self._queue = queue.Queue()
+        for i in range(self.threads):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+
+    def lookup(self, host):
+        """lookup(host) --> addresses, error, or None
+
+        Return the cached answer of host if there is a fresh one.
+        Addresses is a list of (family, ip) tuples. None is returned
+        when the answer is not known yet.
+        """
+        with self._lock:
+            entry = self._cache.pop(host, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                return None
+            self._cache[host] = entry
+            return entry[1]
+
+    def resolve(self, host, callback):
+        """resolve(host, callback) --> None
+
+        Resolve host in a worker thread, and call callback with the
+        answer in that thread. Callers should check lookup() first.
+        """
+        with self._lock:
+            if host in self._pending:
+                self._pending[host].append(callback)
+                return
+            self._pending[host] = [callback]
+        self._queue.put(host)
+
+    def _worker(self):
+        while True:
+            host = self._queue.get()
+            try:
+                infos = socket.getaddrinfo(
+                        host, None, 0, socket.SOCK_STREAM)
+                result = []
+                for family, _, _, _, sockaddr in infos:
+                    address = family, sockaddr[0]
+                    if address not in result:
+                        result.append(address)
+                expire = time.time() + self.ttl
+            except Exception as e:
+                # e.g. UnicodeError of an invalid name, which must not
+                # kill the worker and leave the callbacks waiting
+                result = e
+                expire = time.time() + self.negative_ttl
+            with self._lock:
+                self._cache.pop(host, None)
+                self._cache[host] = expire, result
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+                callbacks = self._pending.pop(host)
+            for callback in callbacks:
+                callback(result)
+
+_resolver = None
+
+def get_resolver(**opts):
+    """get_resolver(**opts) --> Resolver object
+
+    Return the resolver shared in this process, creating it with the
+    given options when it is called for the first time.
+    """
+    global _resolver
+    if _resolver is None:
+        _resolver = Resolver(**opts)
+    return _resolver
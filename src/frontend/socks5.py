@@ -0,0 +1,314 @@
+# coding: UTF-8
+
+"""SOCKS5 frontend.
+
+The handshake (RFC 1928, CONNECT command without authentication) is
+processed inside the event loop. Hostnames are resolved by the shared
+resolver in worker threads, and the destination is connected to in
+non-blocking mode, so that no stream can stall other tunnels.
+
+Data sent by the client before the reply to its request arrives is
+kept and forwarded as soon as the destination is connected.
+"""
+
+import errno
+import socket
+import struct
+
+from util import Reader
+
+from .resolver import Notifier, get_resolver
+
+SOCKS_VERSION = 5
+METHOD_NOAUTH = 0
+METHOD_UNACCEPTABLE = 0xff
+CMD_CONNECT = 1
+
+class AddressType(object):
+    ipv4    = 1
+    domain  = 3
+    ipv6    = 4
+
+class Reply(object):
+    succeeded           = 0
+    general_failure     = 1
+    network_unreachable = 3
+    host_unreachable    = 4
+    connection_refused  = 5
+    ttl_expired         = 6
+    command_unsupported = 7
+    address_unsupported = 8
+
+_errno_replies = {
+        errno.ECONNREFUSED: Reply.connection_refused,
+        errno.ENETUNREACH:  Reply.network_unreachable,
+        errno.EHOSTUNREACH: Reply.host_unreachable,
+        errno.ETIMEDOUT:    Reply.ttl_expired,
+        }
+
+class State(object):
+    greeting    = 0 # waiting for method selection message
+    request     = 1 # waiting for request
+    resolving   = 2 # waiting for the resolver
+    connecting  = 3 # connecting to the destination
+    connected   = 4 # relaying data
+    failed      = 5 # reply has been sent, stream should be closed
+
+class FrontendServer(object):
+
+    __slots__ = ('resolver', 'state', 'conn', 'in_buf', 'send_buf',
+            'reply_buf', 'notifier', 'answer', 'addresses', 'dst_port',
+            'last_error', 'reader')
+
+    def __init__(self, **opts):
+        self.resolver = get_resolver(**opts.get('resolver', {}))
+        self.state = State.greeting
+        self.conn = None
+        # handshake data received from the client
+        self.in_buf = b""
+        # data waiting for being sent to the destination
+        self.send_buf = b""
+        # data waiting for being returned to the client
+        self.reply_buf = b""
+        # the notifier is readable when there is something for recv()
+        self.notifier = Notifier()
+        self.answer = None
+        self.addresses = []
+        self.dst_port = 0
+        self.last_error = None
+        self.reader = Reader(**opts)
+
+    def dump(self, sockets):
+        """dump(sockets) --> dict or None
+
+        Return the state of this frontend for upgrading, see
+        redirect.FrontendServer.dump(). Only streams which have been
+        connected and replied can be passed, and None is returned for
+        others.
+        """
+        if self.state != State.connected or self.reply_buf:
+            return None
+        sockets.append(self.conn)
+        return {'conn': len(sockets) - 1, 'send_buf': self.send_buf}
+
+    @classmethod
+    def restore(cls, state, sockets, **opts):
+        self = cls(**opts)
+        self.notifier.close()
+        self.state = State.connected
+        self.conn = sockets[state['conn']]
+        self.send_buf = state['send_buf']
+        return self
+
+    def send(self, data=None):
+        if data:
+            if self.state == State.greeting or \
+                    self.state == State.request:
+                self.in_buf += data
+                self._handshake()
+            elif self.state != State.failed:
+                self.send_buf += data
+        elif self.state == State.connecting:
+            # only called when the socket is writable
+            self._check_connected()
+        if self.state == State.connected:
+            self._continue()
+
+    def _continue(self):
+        if not self.send_buf:
+            return
+        try:
+            sent = self.conn.send(self.send_buf)
+        except socket.error as e:
+            if e.errno == errno.EWOULDBLOCK:
+                sent = 0
+            else:
+                raise
+        if sent:
+            self.send_buf = self.send_buf[sent:]
+
+    def recv(self):
+        if self.state != State.failed:
+            # clear before checking so that no notification is lost
+            self.notifier.clear()
+        if self.state == State.resolving and self.answer is not None:
+            self._process_answer(self.answer)
+        if self.reply_buf:
+            data = self.reply_buf
+            self.reply_buf = b""
+            if self.state == State.connected:
+                # no more replies, release the pipe
+                self.notifier.close()
+            return data
+        if self.state == State.failed:
+            return None
+        if self.state != State.connected:
+            return b""
+        return self.reader.read(self.conn)
+
+    def _handshake(self):
+        if self.state == State.greeting:
+            if len(self.in_buf) < 2:
+                return
+            ver, nmethods = struct.unpack("!BB", self.in_buf[:2])
+            if ver != SOCKS_VERSION:
+                self._fail()
+                return
+            if len(self.in_buf) < 2 + nmethods:
+                return
+            methods = struct.unpack("!" + "B" * nmethods,
+                    self.in_buf[2:2 + nmethods])
+            self.in_buf = self.in_buf[2 + nmethods:]
+            if METHOD_NOAUTH not in methods:
+                self._reply(struct.pack("!BB",
+                    SOCKS_VERSION, METHOD_UNACCEPTABLE))
+                self._fail()
+                return
+            self._reply(struct.pack("!BB", SOCKS_VERSION, METHOD_NOAUTH))
+            self.state = State.request
+
+        if self.state == State.request:
+            if len(self.in_buf) < 5:
+                return
+            ver, cmd, _, atyp, length = \
+                    struct.unpack("!BBBBB", self.in_buf[:5])
+            if ver != SOCKS_VERSION:
+                self._fail()
+                return
+            if atyp == AddressType.ipv4:
+                addr_end = 4 + 4
+            elif atyp == AddressType.ipv6:
+                addr_end = 4 + 16
+            elif atyp == AddressType.domain:
+                addr_end = 5 + length
+            else:
+                self._fail(Reply.address_unsupported)
+                return
+            if len(self.in_buf) < addr_end + 2:
+                return
+            if cmd != CMD_CONNECT:
+                self._fail(Reply.command_unsupported)
+                return
+            addr = self.in_buf[4:addr_end]
+            self.dst_port, = struct.unpack("!H",
+                    self.in_buf[addr_end:addr_end + 2])
+            # anything following the request is early data
+            self.send_buf = self.in_buf[addr_end + 2:]
+            self.in_buf = b""
+
+            if atyp == AddressType.ipv4:
+                self.addresses = [(socket.AF_INET, socket.inet_ntoa(addr))]
+                self._connect_next()
+            elif atyp == AddressType.ipv6:
+                self.addresses = [(socket.AF_INET6,
+                    socket.inet_ntop(socket.AF_INET6, addr))]
+                self._connect_next()
+            else:
+                try:
+                    host = addr[1:].decode('idna')
+                except UnicodeError:
+                    self._fail(Reply.general_failure)
+                    return
+                answer = self.resolver.lookup(host)
+                if answer is not None:
+                    self._process_answer(answer)
+                else:
+                    self.state = State.resolving
+                    self.resolver.resolve(host, self._resolved)
+
+    def _resolved(self, answer):
+        # called in worker thread of resolver
+        self.answer = answer
+        self.notifier.notify()
+
+    def _process_answer(self, answer):
+        if isinstance(answer, Exception):
+            self._fail(Reply.host_unreachable)
+            return
+        self.addresses = list(answer)
+        self._connect_next()
+
+    def _connect_next(self):
+        while self.addresses:
+            family, ip = self.addresses.pop(0)
+            if family == socket.AF_INET6:
+                address = ip, self.dst_port, 0, 0
+            else:
+                address = ip, self.dst_port
+            conn = socket.socket(family, socket.SOCK_STREAM)
+            conn.setblocking(0)
+            err = conn.connect_ex(address)
+            if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                self.conn = conn
+                self.state = State.connecting
+                return
+            conn.close()
+            self.last_error = err
+        self._fail(_errno_replies.get(self.last_error,
+            Reply.general_failure))
+
+    def _check_connected(self):
+        err = self.conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if not err:
+            try:
+                bound = self.conn.getsockname()
+                self.conn.getpeername()
+            except socket.error as e:
+                if e.errno != errno.ENOTCONN:
+                    raise
+                return
+            self.state = State.connected
+            self._reply(self._pack_reply(Reply.succeeded, bound))
+            return
+        self.conn.close()
+        self.conn = None
+        self.last_error = err
+        self._connect_next()
+
+    def _pack_reply(self, code, bound=None):
+        if bound is None:
+            return struct.pack("!BBBB4sH", SOCKS_VERSION, code, 0,
+                    AddressType.ipv4, b"\0" * 4, 0)
+        if len(bound) > 2:
+            return struct.pack("!BBBB16sH", SOCKS_VERSION, code, 0,
+                    AddressType.ipv6,
+                    socket.inet_pton(socket.AF_INET6, bound[0]), bound[1])
+        return struct.pack("!BBBB4sH", SOCKS_VERSION, code, 0,
+                AddressType.ipv4, socket.inet_aton(bound[0]), bound[1])
+
+    def _reply(self, data):
+        self.reply_buf += data
+        self.notifier.notify()
+
+    def _fail(self, code=None):
+        if code is not None:
+            self._reply(self._pack_reply(code))
+        self.state = State.failed
+        self.notifier.notify()
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def close(self):
+        self.notifier.close()
+        if self.conn:
+            self.conn.close()
+
+    def reset(self):
+        if self.conn:
+            self.conn.setsockopt(socket.SOL_SOCKET,
+                    socket.SO_LINGER, b"\1\0\0\0\0\0\0\0")
+        self.close()
+
+    def get_rlist(self):
+        rlist = []
+        if not self.notifier.closed:
+            rlist.append(self.notifier.fileno())
+        if self.state == State.connected:
+            rlist.append(self.conn.fileno())
+        return rlist
+
+    def get_wlist(self):
+        if self.state == State.connecting or \
+                (self.state == State.connected and self.send_buf):
+            return [self.conn.fileno()]
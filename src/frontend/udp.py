@@ -0,0 +1,75 @@
+# coding: UTF-8
+
+"""UDP frontend.
+
+Each datagram flow of a tunnel gets its own UDP socket connected to
+the target, so replies are told apart by the socket they arrive on,
+which makes the sockets the NAT table of the server.
+"""
+
+import socket
+
+from util import recv_datagrams, send_datagram
+
+class DatagramFrontend(object):
+    """DatagramFrontend(**opts) --> DatagramFrontend object
+
+    Options:
+        server          address of the target
+        port            port of the target
+        idle_timeout    seconds after which an idle flow is discarded
+    """
+
+    server = "localhost"
+    port = 53
+
+    __slots__ = ('conn',)
+
+    def __init__(self, **opts):
+        server = opts.get('server', self.server)
+        port = opts.get('port', self.port)
+
+        # initialize socket
+        family, socktype, proto, _, sockaddr = socket.getaddrinfo(
+                server, port, 0, socket.SOCK_DGRAM)[0]
+        self.conn = socket.socket(family, socktype, proto)
+        self.conn.setblocking(0)
+        try:
+            self.conn.connect(sockaddr)
+        except socket.error:
+            self.conn.close()
+            raise
+
+    def dump(self, sockets):
+        """dump(sockets) --> dict
+
+        Return the state of this frontend for upgrading, in which its
+        socket is referred to by the index in list sockets it is
+        appended to.
+        """
+        sockets.append(self.conn)
+        return {'conn': len(sockets) - 1}
+
+    @classmethod
+    def restore(cls, state, sockets, **opts):
+        self = cls.__new__(cls)
+        self.conn = sockets[state['conn']]
+        return self
+
+    def send(self, data):
+        """send(data) --> bool
+
+        Send a datagram to the target. It is dropped and False is
+        returned if it cannot be sent at once.
+        """
+        return send_datagram(self.conn, data)
+
+    def recv(self):
+        """recv() --> list of bytes"""
+        return [data for data, address in recv_datagrams(self.conn)]
+
+    def close(self):
+        self.conn.close()
+
+    def get_rlist(self):
+        return [self.conn.fileno()]
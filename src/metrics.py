@@ -0,0 +1,243 @@
+# coding: UTF-8
+
+"""Metrics collection and the local stats endpoint.
+
+Metrics are kept in a Registry and rendered in Prometheus text
+exposition format. Counters, gauges and histograms are plain objects
+updated in place, so they are cheap enough to stay enabled. Values
+which already exist in other objects (e.g. byte counters of record
+connections) can be exported through Callback metrics, which are only
+evaluated when the endpoint is scraped.
+
+StatsServer serves the rendered metrics over HTTP on a TCP port or a
+Unix socket, and is driven by the event loop like other connections.
+"""
+
+import os
+import errno
+import socket
+import numbers
+
+from util import create_listener, create_unix_listener, accept_all
+
+MAX_REQUEST_SIZE = 8192
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    items = ('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\')
+                .replace('"', '\\"').replace('\n', '\\n'))
+             for k, v in sorted(labels.items()))
+    return "{" + ",".join(items) + "}"
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric(object):
+
+    type = 'untyped'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+
+    def samples(self):
+        """samples() --> iterator of (name, labels, value)"""
+        return iter(())
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def __init__(self, name, help):
+        super(Counter, self).__init__(name, help)
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, None, self.value
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def __init__(self, name, help):
+        super(Gauge, self).__init__(name, help)
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield self.name, None, self.value
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = sorted(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield self.name + "_bucket", {'le': _format_value(bound)}, total
+        yield self.name + "_bucket", {'le': "+Inf"}, self.count
+        yield self.name + "_sum", None, self.sum
+        yield self.name + "_count", None, self.count
+
+class Callback(Metric):
+    """Callback(name, help, type, func) --> Callback object
+
+    func is called at scrape time, and should return either a number
+    or an iterable of (labels, value).
+    """
+
+    def __init__(self, name, help, type, func):
+        super(Callback, self).__init__(name, help)
+        self.type = type
+        self.func = func
+
+    def samples(self):
+        result = self.func()
+        if isinstance(result, numbers.Number):
+            yield self.name, None, result
+            return
+        for labels, value in result:
+            yield self.name, labels, value
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """render() --> str
+
+        Render all metrics in Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {0} {1}".format(metric.name, metric.help))
+            lines.append("# TYPE {0} {1}".format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("{0}{1} {2}".format(name,
+                    _format_labels(labels), _format_value(value)))
+        lines.append("")
+        return "\n".join(lines)
+
+class StatsServer(object):
+    """StatsServer(registry, **opts) --> StatsServer object
+
+    Minimal HTTP server which returns rendered metrics for any request.
+
+    Options:
+        address     listening address
+        port        listening port
+        unix        path of Unix socket, used instead of address/port
+    """
+
+    address = "127.0.0.1"
+    port = 9194
+
+    def __init__(self, registry, **opts):
+        self.registry = registry
+        if 'address' in opts:
+            self.address = opts['address']
+        if 'port' in opts:
+            self.port = opts['port']
+        self.unix = opts.get('unix')
+        if self.unix:
+            self.conn = create_unix_listener(self.unix, backlog=16)
+        else:
+            self.conn = create_listener(self.address, self.port, backlog=16)
+        # dictionary of client sockets to their buffers; a buffer is
+        # the request received before the response is generated, and
+        # the remaining response after that
+        self.clients = {}
+        self.responding = set()
+
+    def process(self):
+        """process() --> None
+
+        Accept new clients, read requests and send responses as far as
+        possible without blocking.
+        """
+        for conn, address in accept_all(self.conn):
+            conn.setblocking(0)
+            self.clients[conn] = b""
+        for conn in list(self.clients):
+            try:
+                if conn in self.responding:
+                    self._send(conn)
+                else:
+                    self._recv(conn)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._close(conn)
+
+    def _recv(self, conn):
+        data = conn.recv(4096)
+        if not data:
+            self._close(conn)
+            return
+        request = self.clients[conn] + data
+        if b"\r\n\r\n" not in request and b"\n\n" not in request:
+            if len(request) > MAX_REQUEST_SIZE:
+                self._close(conn)
+            else:
+                self.clients[conn] = request
+            return
+        body = self.registry.render().encode('utf-8')
+        self.clients[conn] = (b"HTTP/1.0 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: " + str(len(body)).encode('ascii') +
+                b"\r\nConnection: close\r\n\r\n" + body)
+        self.responding.add(conn)
+        self._send(conn)
+
+    def _send(self, conn):
+        sent = conn.send(self.clients[conn])
+        self.clients[conn] = self.clients[conn][sent:]
+        if not self.clients[conn]:
+            self._close(conn)
+
+    def _close(self, conn):
+        del self.clients[conn]
+        self.responding.discard(conn)
+        conn.close()
+
+    def close(self):
+        for conn in list(self.clients):
+            self._close(conn)
+        self.conn.close()
+        if self.unix and os.path.exists(self.unix):
+            os.unlink(self.unix)
+
+    def get_rlist(self):
+        return [self.conn.fileno()] + [conn.fileno()
+                for conn in self.clients if conn not in self.responding]
+
+    def get_wlist(self):
+        return [conn.fileno() for conn in self.responding]
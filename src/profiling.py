@@ -0,0 +1,98 @@
+# coding: UTF-8
+
+"""Instrumentation of event loops.
+
+Watchdog measures how long each handler takes in one loop iteration,
+and reports the iterations which take longer than a threshold along
+with the handlers which spent most of the time.
+
+ProfileToggle starts or stops cProfile on demand, typically from a
+signal handler, and dumps the collected statistics to a file when
+profiling is stopped.
+"""
+
+import os
+import time
+import cProfile
+
+DEFAULT_THRESHOLD = 0.1
+DEFAULT_PROFILE_FILE = "usocks-{pid}.prof"
+# number of handlers reported for a slow iteration
+REPORT_HANDLERS = 3
+
+class Watchdog(object):
+    """Watchdog(report, threshold) --> Watchdog object
+
+    report is called with the duration of a slow iteration and a list
+    of (duration, phase, conn) of the slowest handlers in it.
+    """
+
+    def __init__(self, report, threshold=DEFAULT_THRESHOLD):
+        self.report = report
+        self.threshold = threshold
+        self.spans = []
+        self.start = self.mark = 0
+        self.current = None
+
+    def begin(self):
+        """begin() --> None
+
+        Start timing an iteration. It should be called right after
+        select returns.
+        """
+        self.start = self.mark = time.time()
+        self.current = None
+        del self.spans[:]
+
+    def enter(self, phase, conn=None):
+        """enter(phase, conn=None) --> None
+
+        Note that a handler of phase for conn starts, which finishes
+        the previous one.
+        """
+        now = time.time()
+        if self.current is not None:
+            self.spans.append((now - self.mark,) + self.current)
+        self.mark = now
+        self.current = phase, conn
+
+    def end(self):
+        """end() --> None
+
+        Finish the iteration, and report it if it is slow.
+        """
+        self.enter(None)
+        total = self.mark - self.start
+        if total < self.threshold:
+            return
+        spans = sorted(self.spans, key=lambda span: span[0], reverse=True)
+        self.report(total, spans[:REPORT_HANDLERS])
+
+class ProfileToggle(object):
+    """ProfileToggle(filename=None) --> ProfileToggle object
+
+    filename may contain "{pid}", which is replaced by the process id.
+    """
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = DEFAULT_PROFILE_FILE
+        self.filename = filename.format(pid=os.getpid())
+        self.profile = None
+
+    def toggle(self, *args):
+        """toggle(*args) --> bool
+
+        Start profiling if it is stopped, or stop it and dump the
+        statistics otherwise. Return whether profiling is running.
+        Arguments are ignored so that it can be used as a signal
+        handler directly.
+        """
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            return True
+        self.profile.disable()
+        self.profile.dump_stats(self.filename)
+        self.profile = None
+        return False
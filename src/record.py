@@ -59,7 +59,7 @@ Packet Structure:
 
 Packet Types:
 
-    There is five different types of packet, two of them contain data
+    There is seven different types of packet, two of them contain data
     while others is only used for notifying or control the connection
     status. The types are:
 
@@ -79,6 +79,18 @@ Packet Types:
               confuse the traffic analyser. Data Length must be zero
               for packets of "nodata" type.
 
+          4 - ping, packet is sent to check whether the connection is
+              alive and to measure the round trip time. Data of this
+              packet is an opaque 64-bit value, which must be echoed
+              back in a "pong" packet as soon as possible.
+
+          5 - pong, packet is the reply to a "ping" packet. Its Data
+              must be identical to the corresponding "ping".
+
+              Peers which do not support "ping" treat it as an invalid
+              header, so it should only be sent when the counterpart
+              is known to support it.
+
         254 - reset, packet is sent when one detects that there is a
               critical error occurred which might be caused by attack.
               Who receives this packet must immediately close the
@@ -109,7 +121,7 @@ Exceptions:
         * sum of Data Length and Padding Length is not an integer
           multiple of block size,
         * Data Length is not equal to zero for a packet which should
-          not have data,
+          not have data, or not equal to 8 for "ping" and "pong",
         * Packet Type is not a value listed above.
         One should send "reset" to its counterpart for these errors.
 
@@ -122,6 +134,7 @@ Exceptions:
 
 """
 
+import time
 import struct
 import random
 
@@ -133,6 +146,16 @@ block_size = AES.block_size
 header_size = struct.calcsize("!HBB")
 digest_size = 8
 extra_size = header_size + digest_size
+ping_format = "!Q"
+ping_size = struct.calcsize(ping_format)
+# max number of pings waiting for reply
+max_pings = 8
+# weight of new sample in throughput estimation
+rate_alpha = 0.25
+
+# attributes of RecordConnection which are not dumped
+_volatile_slots = ('backend', 'random', 'send_cipher', 'recv_cipher',
+        'cover', 'traces')
 
 def _hash(data):
     return MD5.new(data).digest()[:8]
@@ -141,6 +164,8 @@ class PacketType(object):
     data    = 1
     part    = 2
     nodata  = 3
+    ping    = 4
+    pong    = 5
     reset   = 254
     close   = 255
 
@@ -155,9 +180,23 @@ class ConnectionClosedException(Exception): pass
 
 class RecordConnection(object):
 
+    __slots__ = ('backend', 'random', 'key', 'send_cipher', 'recv_cipher',
+            'send_iv', 'recv_iv', 'cipher_buf', 'plain_buf',
+            'recv_synchornized', 'first_packet_checked', 'header_arrived',
+            'secure_closed', 'closed', 'part_packet', 'data_len',
+            'packet_type',
+            'expected_length', 'bytes_sent', 'bytes_received',
+            'records_sent', 'records_received', 'crypto_time',
+            'last_received', 'cover', 'padding_bytes', 'cover_records',
+            'cover_bytes', 'srtt', 'rttvar', 'ping_seq', 'ping_sent',
+            'send_rate', 'recv_rate', 'rate_updated', 'rate_sent',
+            'rate_received', 'traces')
+
     def __init__(self, key, backend):
         self.backend = backend
-        key = MD5.new(key).digest()
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        self.key = key = MD5.new(key).digest()
         self.random = Random.new()
         # We want to use self-synchronizing feature of CBC, so the IV
         # is trivial in fact, but for security consideration, we
@@ -165,6 +204,9 @@ class RecordConnection(object):
         iv = self.random.read(block_size)
         self.send_cipher = AES.new(key, AES.MODE_CBC, iv)
         self.recv_cipher = AES.new(key, AES.MODE_CBC, iv)
+        # last cipher blocks, which are the IVs to continue the cipher
+        # streams with, see dump()
+        self.send_iv = self.recv_iv = iv
         # initialize record layer buffers
         self.cipher_buf = b""
         self.plain_buf = b""
@@ -175,14 +217,71 @@ class RecordConnection(object):
         self.closed = False
         # part packet buffer
         self.part_packet = b""
+        # statistics
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.records_sent = 0
+        self.records_received = 0
+        self.crypto_time = 0.0
+        self.last_received = time.time()
+        # cover traffic, see CoverTraffic
+        self.cover = None
+        self.padding_bytes = 0
+        self.cover_records = 0
+        self.cover_bytes = 0
+        # round trip time estimation (RFC 6298) in seconds
+        self.srtt = None
+        self.rttvar = None
+        self.ping_seq = 0
+        self.ping_sent = {}
+        # throughput estimation in bytes per second
+        self.send_rate = 0.0
+        self.recv_rate = 0.0
+        self.rate_updated = time.time()
+        self.rate_sent = 0
+        self.rate_received = 0
+        # traces of records which have not been written to the backend,
+        # along with bytes_sent after them
+        self.traces = []
         # The first block must not contain any useful data or it will
         # never be recognized, so we send one block here. However,
         # it is only required to be received before the first data
         # block, so it is not necessary to be sent instantaneously.
         data = self.random.read(block_size)
         data = self.send_cipher.encrypt(data)
+        self.send_iv = data
         backend.send(data, False)
 
+    def dump(self):
+        """dump() --> dict
+
+        Return the state of this connection except its backend, from
+        which restore() can continue it in another process.
+        """
+        state = {}
+        for name in self.__slots__:
+            if name not in _volatile_slots:
+                state[name] = getattr(self, name, None)
+        return state
+
+    @classmethod
+    def restore(cls, state, backend):
+        """restore(state, backend) --> RecordConnection
+
+        Continue a connection dumped by dump() on backend. Nothing is
+        sent by the restored connection.
+        """
+        self = cls.__new__(cls)
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.backend = backend
+        self.random = Random.new()
+        self.send_cipher = AES.new(self.key, AES.MODE_CBC, self.send_iv)
+        self.recv_cipher = AES.new(self.key, AES.MODE_CBC, self.recv_iv)
+        self.cover = None
+        self.traces = []
+        return self
+
     def _send_packet(self, data, padding, packet_type):
         data_len = len(data)
         padding_len = len(padding)
@@ -191,9 +290,21 @@ class RecordConnection(object):
         out_data += data + padding
         out_data += _hash(out_data)
         # encrypt & send data packet
+        start = time.time()
         out_data = self.send_cipher.encrypt(out_data)
+        self.crypto_time += time.time() - start
+        self.send_iv = out_data[-block_size:]
+        self.records_sent += 1
+        self.bytes_sent += len(out_data)
         self.backend.send(out_data, True)
 
+    def _padding(self, data_len):
+        padding_len = data_len + extra_size
+        padding_len = (block_size - padding_len) % block_size
+        if self.cover is not None:
+            padding_len = self.cover.padding(data_len, padding_len)
+        return struct.pack(b"B", padding_len) * padding_len
+
     def _send_reset(self):
         padding_len = (block_size - extra_size) % block_size
         padding = self.random.read(padding_len)
@@ -204,12 +315,72 @@ class RecordConnection(object):
         padding = self.random.read(padding_len)
         self._send_packet(b"", padding, PacketType.close)
 
-    def send_packet(self, data):
-        """send_packet(data) --> None
+    def send_nodata(self, padding_len=None):
+        """send_nodata(padding_len=None) --> None
+
+        Send a nodata packet with padding_len octets of random padding.
+        padding_len + extra_size must be a multiple of block size. The
+        minimum padding is used if padding_len is not given.
+        """
+        if padding_len is None:
+            padding_len = (block_size - extra_size) % block_size
+        self._send_packet(b"", self.random.read(padding_len),
+                PacketType.nodata)
+
+    def send_ping(self):
+        """send_ping() --> None
+
+        Send a ping packet. The round trip time is updated when the
+        corresponding pong arrives.
+        """
+        seq = self.ping_seq
+        self.ping_seq += 1
+        if len(self.ping_sent) >= max_pings:
+            del self.ping_sent[min(self.ping_sent)]
+        self.ping_sent[seq] = time.time()
+        self._send_packet(struct.pack(ping_format, seq),
+                self._padding(ping_size), PacketType.ping)
+
+    def _process_pong(self, data):
+        seq, = struct.unpack(ping_format, data)
+        sent = self.ping_sent.pop(seq, None)
+        if sent is None:
+            return
+        rtt = time.time() - sent
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def update_rates(self, now=None):
+        """update_rates(now=None) --> None
+
+        Update the estimation of throughput with the bytes transferred
+        since last call.
+        """
+        if now is None:
+            now = time.time()
+        elapsed = now - self.rate_updated
+        if elapsed <= 0:
+            return
+        send_rate = (self.bytes_sent - self.rate_sent) / elapsed
+        recv_rate = (self.bytes_received - self.rate_received) / elapsed
+        self.send_rate += rate_alpha * (send_rate - self.send_rate)
+        self.recv_rate += rate_alpha * (recv_rate - self.recv_rate)
+        self.rate_updated = now
+        self.rate_sent = self.bytes_sent
+        self.rate_received = self.bytes_received
+
+    def send_packet(self, data, trace=None):
+        """send_packet(data, trace=None) --> None
 
         Send packet to record layer. Caller must call get_wlist() for
         file descriptors waiting for writing, and call
         continue_sending() when one of them are selected to continue.
+        If trace is given, it is marked when the packet is encrypted
+        and when it is written by the backend.
         """
         data_len = len(data)
         while data_len > 65535:    # the max size a packet can contain
@@ -217,10 +388,10 @@ class RecordConnection(object):
             self._send_packet(data[:new_len], b"", PacketType.part)
             data = data[new_len:]
             data_len -= new_len
-        padding_len = data_len + extra_size
-        padding_len = (block_size - padding_len) % block_size
-        padding = chr(padding_len) * padding_len
-        self._send_packet(data, padding, PacketType.data)
+        self._send_packet(data, self._padding(data_len), PacketType.data)
+        if trace is not None:
+            trace.mark('encrypted')
+            self.traces.append((self.bytes_sent, trace))
 
     def _update_buffer(self):
         length = len(self.cipher_buf)
@@ -232,7 +403,10 @@ class RecordConnection(object):
         if length > 0:
             data = self.cipher_buf[:length]
             self.cipher_buf = self.cipher_buf[length:]
+            start = time.time()
             self.plain_buf += self.recv_cipher.decrypt(data)
+            self.crypto_time += time.time() - start
+            self.recv_iv = data[-block_size:]
 
             # drop first block which is useless
             if not self.recv_synchornized:
@@ -263,6 +437,10 @@ class RecordConnection(object):
                     pass
                 elif self.packet_type == PacketType.part:
                     pass
+                elif self.packet_type == PacketType.ping or \
+                        self.packet_type == PacketType.pong:
+                    if self.data_len != ping_size:
+                        raise InvalidHeaderError()
                 elif self.data_len != 0:
                     # packet whose type is neither data nor part
                     # must not contain any data
@@ -288,11 +466,17 @@ class RecordConnection(object):
             # check hash
             if _hash(packet) != digest:
                 raise HashfailError()
+            self.records_received += 1
             data = packet[header_size:header_size + self.data_len]
             self.first_packet_checked = True
             # return packet
             if self.packet_type == PacketType.nodata:
                 pass
+            elif self.packet_type == PacketType.ping:
+                self._send_packet(data, self._padding(ping_size),
+                        PacketType.pong)
+            elif self.packet_type == PacketType.pong:
+                self._process_pong(data)
             elif self.packet_type == PacketType.reset:
                 raise RemoteResetException()
             elif self.packet_type == PacketType.close:
@@ -305,22 +489,30 @@ class RecordConnection(object):
                     self.part_packet = b""
                 yield data
 
-    def receive_packets(self):
-        """receive_packets() --> packet
+    def receive_packets(self, recv=True):
+        """receive_packets(recv=True) --> packet
 
         It will yield packets if there are any. If backend has been
         closed, this method will raise ConnectionClosedException.
         If the connection seems to be attacked, it will raise 
         different kinds of exceptions.
+
+        Caller may stop iterating at any time, and the remaining
+        packets are kept in buffer. If recv is False, backend is not
+        read, and only the buffered packets are yielded.
         """
-        data = self.backend.recv()
-        if data is None:
-            self.closed = True
-            if not self.secure_closed:
-                raise InsecureClosingError()
-            raise ConnectionClosedException()
-        self.cipher_buf += data
-        if self._update_buffer():
+        if recv:
+            data = self.backend.recv()
+            if data is None:
+                self.closed = True
+                if not self.secure_closed:
+                    raise InsecureClosingError()
+                raise ConnectionClosedException()
+            self.bytes_received += len(data)
+            self.last_received = time.time()
+            self.cipher_buf += data
+        self._update_buffer()
+        if self.plain_buf:
             try:
                 for packet in self._extract_packets():
                     yield packet
@@ -335,6 +527,18 @@ class RecordConnection(object):
                     raise FirstPacketIncorrectError()
                 raise
 
+    def has_pending(self):
+        """has_pending() --> bool
+
+        Whether there might be packets which can be yielded by
+        receive_packets() without reading backend.
+        """
+        if len(self.cipher_buf) >= block_size:
+            return True
+        if not self.header_arrived:
+            return len(self.plain_buf) >= header_size
+        return len(self.plain_buf) >= self.expected_length
+
     def close(self):
         """close() --> None
 
@@ -344,6 +548,7 @@ class RecordConnection(object):
         """
         if not self.closed:
             self._send_close()
+            self.closed = True
 
     def continue_sending(self):
         """continue_sending() --> bool
@@ -351,10 +556,165 @@ class RecordConnection(object):
         The return value means whether the record layer is ready for
         more data to send.
         """
-        return self.backend.send()
+        available = self.backend.send()
+        if self.traces:
+            self._check_traces()
+        return available
+
+    def _check_traces(self):
+        # bytes_sent does not count the first block, so this is never
+        # ahead of the bytes actually written
+        written = self.bytes_sent - self.backend.buffered()
+        while self.traces and self.traces[0][0] <= written:
+            self.traces.pop(0)[1].mark('flushed')
+
+    def buffered(self):
+        return self.backend.buffered()
 
     def get_rlist(self):
         return self.backend.get_rlist()
 
     def get_wlist(self):
         return self.backend.get_wlist()
+
+class Keepalive(object):
+    """Keepalive(timers, record_conn, on_dead, **opts) --> Keepalive
+
+    Send ping through record_conn periodically with timers, and update
+    its throughput estimation. on_dead is called when nothing has been
+    received for timeout seconds. If rtt_warning is given, on_slow is
+    called with the smoothed RTT each time it rises above that value.
+
+    Options:
+        interval        seconds between pings
+        timeout         seconds of silence before the peer is dead
+        rtt_warning     smoothed RTT in seconds considered too slow
+    """
+
+    interval = 15
+    timeout = 45
+    rtt_warning = None
+
+    def __init__(self, timers, record_conn, on_dead, on_slow=None, **opts):
+        if 'interval' in opts:
+            self.interval = opts['interval']
+        if 'timeout' in opts:
+            self.timeout = opts['timeout']
+        if 'rtt_warning' in opts:
+            self.rtt_warning = opts['rtt_warning']
+        self.timers = timers
+        self.record_conn = record_conn
+        self.on_dead = on_dead
+        self.on_slow = on_slow
+        self.slow = False
+        self.timer = timers.schedule(self.interval, self._tick)
+
+    def _tick(self):
+        record_conn = self.record_conn
+        now = time.time()
+        record_conn.update_rates(now)
+        if now - record_conn.last_received >= self.timeout:
+            self.timer = None
+            self.on_dead()
+            return
+        if self.rtt_warning and record_conn.srtt is not None:
+            slow = record_conn.srtt > self.rtt_warning
+            if slow and not self.slow and self.on_slow:
+                self.on_slow(record_conn.srtt)
+            self.slow = slow
+        if not record_conn.closed:
+            record_conn.send_ping()
+        self.timer = self.timers.schedule(self.interval, self._tick)
+
+    def cancel(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+class CoverTraffic(object):
+    """CoverTraffic(timers, record_conn, **opts) --> CoverTraffic
+
+    Pad records of record_conn up to multiples of bucket octets, and
+    send "nodata" packets of random sizes at random intervals while
+    nothing else is being sent. Extra padding is limited to ratio of
+    the data sent, and no nodata packet is sent while the backend has
+    data buffered, so throughput of real data is not reduced. The
+    overhead added is counted in padding_bytes, cover_records and
+    cover_bytes of record_conn.
+
+    Options:
+        bucket              record sizes are rounded up to a multiple
+                            of it, which must be a multiple of 16 and
+                            not larger than 256
+        ratio               max extra padding relative to data sent
+        records_per_second  mean rate of nodata packets when idle,
+                            0 disables them
+    """
+
+    bucket = 128
+    ratio = 0.05
+    records_per_second = 1
+    # max octets of padding budget which may be saved up
+    max_budget = 4096
+
+    def __init__(self, timers, record_conn, **opts):
+        if 'bucket' in opts:
+            self.bucket = opts['bucket']
+        if 'ratio' in opts:
+            self.ratio = opts['ratio']
+        if 'records_per_second' in opts:
+            self.records_per_second = opts['records_per_second']
+        if self.bucket % block_size or not 0 < self.bucket <= 256:
+            raise ValueError("invalid bucket size")
+        self.timers = timers
+        self.record_conn = record_conn
+        # sizes and intervals must not be predictable by observers
+        self.random = random.SystemRandom()
+        self.budget = 0.0
+        self.timer = None
+        self.records_sent = record_conn.records_sent
+        record_conn.cover = self
+        if self.records_per_second:
+            self._schedule()
+
+    def padding(self, data_len, minimum):
+        """padding(data_len, minimum) --> int
+
+        Return the length of padding for a packet with data_len octets
+        of data, which needs at least minimum octets of padding.
+        """
+        self.budget = min(self.budget + self.ratio * data_len,
+                self.max_budget)
+        padding_len = -(data_len + extra_size) % self.bucket
+        extra = padding_len - minimum
+        if padding_len > 255 or extra > self.budget:
+            return minimum
+        self.budget -= extra
+        self.record_conn.padding_bytes += extra
+        return padding_len
+
+    def _schedule(self):
+        delay = self.random.expovariate(self.records_per_second)
+        self.timer = self.timers.schedule(delay, self._tick)
+
+    def _tick(self):
+        record_conn = self.record_conn
+        if record_conn.closed:
+            self.timer = None
+            return
+        if record_conn.records_sent == self.records_sent and \
+                not record_conn.backend.buffered():
+            minimum = (block_size - extra_size) % block_size
+            padding_len = minimum + block_size * \
+                    self.random.randint(0, (255 - minimum) // block_size)
+            record_conn.send_nodata(padding_len)
+            record_conn.cover_records += 1
+            record_conn.cover_bytes += extra_size + padding_len
+        self.records_sent = record_conn.records_sent
+        self._schedule()
+
+    def cancel(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.record_conn.cover = None
@@ -4,6 +4,7 @@
 from __future__ import print_function, unicode_literals
 
 import sys
+import time
 import yaml
 import errno
 import signal
@@ -19,13 +20,26 @@ from functools import partial
 
 import record
 import tunnel
+import upgrade
 
-from util import get_select_list
-from util import ObjectSet, ObjectDict
-from util import import_backend, import_frontend
-from record import RecordConnection
+from util import get_select_list, SignalWaker
+from util import DEFAULT_CLOSE_TIMEOUT, DEFAULT_FLOW_TIMEOUT
+from util import import_backend, import_frontend_class
+from timer import TimerWheel, DEFAULT_TICK
+from metrics import Registry, StatsServer
+from metrics import Counter, Histogram, Callback
+from profiling import Watchdog, ProfileToggle
+from tracing import Trace, Tracer
+from capture import Capture
+from shaping import Shaper
+from admission import Admission
+from record import RecordConnection, Keepalive, CoverTraffic
 from tunnel import TunnelConnection, StatusControl
+from tunnel import UnexpectedCompressionError, InvalidTargetError
+from tunnel import header_size as tunnel_header_size
 from frontend import FrontendUnavailableError
+from frontend.udp import DatagramFrontend
+from compression import CompressionError
 
 def log(level, msg, layer, client):
     if client is None:
@@ -37,21 +51,297 @@ warning  = partial(log, logging.WARNING)
 error    = partial(log, logging.ERROR)
 critical = partial(log, logging.CRITICAL)
 
+class Tunnel(TunnelConnection):
+    """Tunnel with the state maintained by the server."""
+
+    __slots__ = ('address', 'id', 'last_active', 'idle_timer',
+            'handshake_timer', 'close_timer', 'keepalive', 'cover',
+            'bucket', 'flows')
+
+class Stream(object):
+    """Stream(conn_id, tunnel, target=None) --> Stream object
+
+    State of a frontend maintained by the server. target is the name
+    of the target chosen by the client, or None for the default one.
+    """
+
+    __slots__ = ('conn_id', 'tunnel', 'target', 'last_active',
+            'idle_timer', 'bucket', 'shape_timer', 'trace')
+
+    def __init__(self, conn_id, tunnel, target=None):
+        self.conn_id = conn_id
+        self.tunnel = tunnel
+        self.target = target
+        self.last_active = 0
+        self.idle_timer = None
+        self.bucket = None
+        self.shape_timer = None
+        self.trace = None
+
+class Flow(object):
+    """Flow(flow_id, tunnel) --> Flow object
+
+    State of a datagram frontend maintained by the server.
+    """
+
+    __slots__ = ('flow_id', 'tunnel', 'last_active', 'idle_timer')
+
+    def __init__(self, flow_id, tunnel):
+        self.flow_id = flow_id
+        self.tunnel = tunnel
+        self.last_active = 0
+        self.idle_timer = None
+
 class TunnelServer(object):
 
-    def __init__(self, config):
+    # bytes of tunnel packets which may be processed for one tunnel in
+    # each iteration, the remaining packets are kept for next round
+    tunnel_budget = 65536
+    # seconds after which idle streams and tunnels are closed,
+    # None means never
+    idle_timeout = None
+    tunnel_idle_timeout = None
+    # options of keepalive, None means disabled
+    keepalive = None
+    # options of cover traffic, None means disabled
+    cover = None
+    # options of compression, None means disabled
+    compression = None
+    # options of tracing streams traced by clients, None means disabled
+    tracing = None
+    # options of capturing packets of new tunnels, None means disabled
+    capture = None
+    # resolution of timers in seconds
+    timer_tick = DEFAULT_TICK
+    # seconds to wait for remaining data to be sent when closing
+    close_timeout = DEFAULT_CLOSE_TIMEOUT
+    # path of Unix socket to hand over to new processes, None means
+    # upgrading is disabled
+    upgrade_socket = None
+    # options of UDP frontend, None means datagrams are dropped
+    udp = None
+
+    def __init__(self, config, upgrade_from=None):
+        """TunnelServer(config, upgrade_from=None) --> TunnelServer
+
+        If upgrade_from is given, the tunnels are taken over from the
+        server listening on that Unix socket, see upgrade module.
+        """
+        if 'timer_tick' in config:
+            self.timer_tick = config['timer_tick']
+        self.timers = TimerWheel(self.timer_tick)
+        self.now = time.time()
         Backend = import_backend(config).ServerBackend
-        self.backend = Backend(**config['backend'])
-        self.new_frontend = import_frontend(config)
+        if upgrade_from:
+            upgrade_conn, state, sockets = \
+                    upgrade.receive_state(upgrade_from)
+            self.backend = Backend.restore(state['backend'], sockets,
+                    timers=self.timers, **config['backend'])
+        else:
+            self.backend = Backend(timers=self.timers, **config['backend'])
+        # dictionary of names of targets to FrontendServer classes and
+        # their options, in which the default frontend is under None
+        self.targets = {}
+        if 'frontend' in config:
+            self.targets[None] = (import_frontend_class(config['frontend']),
+                    config['frontend'])
+        for name, opts in config.get('targets', {}).items():
+            self.targets[name] = (import_frontend_class(opts), opts)
         self.key = config['key']
         # tunnels dictionary, in which values are dictionaries of the
         # connections belong to it. Those dictionaries' key is the
         # Connection ID and value is the frontend instance.
-        self.tunnels = ObjectDict()
+        self.tunnels = {}
         # dictionary of frontend instances, in which keys are the
-        # frontend instances and values are tuples of their
-        # corresponding Connection IDs and tunnel one belongs to.
-        self.frontends = ObjectDict()
+        # frontend instances and values are their Stream objects.
+        self.frontends = {}
+        # dictionary of datagram frontends to their Flow objects
+        self.flows = {}
+        # set of tunnels which have used up their budgets
+        self.backlogged = set()
+        if 'tunnel_budget' in config:
+            self.tunnel_budget = config['tunnel_budget']
+        if 'idle_timeout' in config:
+            self.idle_timeout = config['idle_timeout']
+        if 'tunnel_idle_timeout' in config:
+            self.tunnel_idle_timeout = config['tunnel_idle_timeout']
+        if 'keepalive' in config:
+            self.keepalive = config['keepalive']
+        if 'cover' in config:
+            self.cover = config['cover']
+        if 'compression' in config:
+            self.compression = config['compression']
+        if 'tracing' in config:
+            self.tracing = config['tracing']
+        if 'capture' in config:
+            self.capture = config['capture']
+        if 'close_timeout' in config:
+            self.close_timeout = config['close_timeout']
+        if 'upgrade_socket' in config:
+            self.upgrade_socket = config['upgrade_socket']
+        if 'udp' in config:
+            self.udp = config['udp']
+            self.flow_timeout = self.udp.get('idle_timeout',
+                    DEFAULT_FLOW_TIMEOUT)
+        self.shaper = None
+        if 'shaping' in config:
+            self.shaper = Shaper(**config['shaping'])
+        self.admission = None
+        if 'admission' in config:
+            self.admission = Admission(**config['admission'])
+        self._init_metrics()
+        if upgrade_from:
+            closing = self._restore(state, sockets)
+            upgrade.finish(upgrade_conn)
+            for tunnel in closing:
+                self._close_tunnel(tunnel)
+            info("upgraded", 'tunnel', None)
+        # sockets of the old process have been released by now
+        self.stats_server = None
+        if 'stats' in config:
+            self.stats_server = StatsServer(self.metrics, **config['stats'])
+        self.upgrade_listener = None
+        if self.upgrade_socket:
+            self.upgrade_listener = \
+                    upgrade.UpgradeListener(self.upgrade_socket)
+        self.upgrade_conn = None
+        self.handed_over = False
+        # loop instrumentation
+        profiling = config.get('profiling', {})
+        self.watchdog = None
+        if 'slow_threshold' in profiling:
+            self.watchdog = Watchdog(self._report_slow,
+                    profiling['slow_threshold'])
+        self.profile_toggle = ProfileToggle(profiling.get('profile_file'))
+        self.tracer = None
+        if self.tracing is not None:
+            self.tracer = Tracer('server', **self.tracing)
+        self.capturer = None
+        if self.capture is not None:
+            self.capturer = Capture(**self.capture)
+        self.signal_waker = SignalWaker()
+
+    def _init_metrics(self):
+        self.metrics = metrics = Registry()
+        # counters of tunnels which have been released
+        self.retired = dict.fromkeys(['bytes_sent', 'bytes_received',
+            'records_sent', 'records_received', 'crypto_time',
+            'padding_bytes', 'cover_records', 'cover_bytes',
+            'packets_sent', 'packets_received',
+            'compressed_input', 'compressed_output'], 0)
+        self.next_tunnel_id = 0
+
+        def record_stat(name):
+            return self.retired[name] + sum(getattr(tunnel.record_conn, name)
+                    for tunnel in self.tunnels)
+        def tunnel_stat(name):
+            return self.retired[name] + sum(getattr(tunnel, name)
+                    for tunnel in self.tunnels)
+        def per_tunnel(func):
+            return lambda: [({'tunnel': tunnel.id, 'client': tunnel.address},
+                func(tunnel)) for tunnel in self.tunnels]
+
+        self.m_iterations = metrics.add(Histogram(
+            'usocks_loop_iteration_seconds',
+            "Time spent processing events in one loop iteration.",
+            [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1]))
+        self.m_accepted = metrics.add(Counter(
+            'usocks_backend_accepted_total',
+            "Number of backend instances accepted."))
+        metrics.add(Callback('usocks_backend_buffered_bytes',
+            "Bytes waiting in send buffers of backends.", 'gauge',
+            per_tunnel(lambda t: t.record_conn.backend.buffered())))
+        metrics.add(Callback('usocks_record_bytes_sent_total',
+            "Bytes sent by record layer.", 'counter',
+            partial(record_stat, 'bytes_sent')))
+        metrics.add(Callback('usocks_record_bytes_received_total',
+            "Bytes received by record layer.", 'counter',
+            partial(record_stat, 'bytes_received')))
+        metrics.add(Callback('usocks_record_records_sent_total',
+            "Records sent by record layer.", 'counter',
+            partial(record_stat, 'records_sent')))
+        metrics.add(Callback('usocks_record_records_received_total',
+            "Records received by record layer.", 'counter',
+            partial(record_stat, 'records_received')))
+        metrics.add(Callback('usocks_record_crypto_seconds_total',
+            "Time spent in encryption and decryption.", 'counter',
+            partial(record_stat, 'crypto_time')))
+        metrics.add(Callback('usocks_cover_padding_bytes_total',
+            "Bytes of padding added by cover traffic to records.",
+            'counter', partial(record_stat, 'padding_bytes')))
+        metrics.add(Callback('usocks_cover_records_total',
+            "Nodata records sent as cover traffic.", 'counter',
+            partial(record_stat, 'cover_records')))
+        metrics.add(Callback('usocks_cover_bytes_total',
+            "Bytes of nodata records sent as cover traffic.", 'counter',
+            partial(record_stat, 'cover_bytes')))
+        self.record_errors = dict.fromkeys(['hashfail', 'invalid_header',
+            'remote_reset', 'insecure_closing', 'first_packet_incorrect',
+            'other'], 0)
+        metrics.add(Callback('usocks_record_errors_total',
+            "Number of tunnels closed by critical errors.", 'counter',
+            lambda: [({'type': name}, count)
+                for name, count in self.record_errors.items()]))
+        metrics.add(Callback('usocks_record_srtt_seconds',
+            "Smoothed round trip time of tunnels.", 'gauge',
+            lambda: [({'tunnel': t.id, 'client': t.address},
+                t.record_conn.srtt) for t in self.tunnels
+                if t.record_conn.srtt is not None]))
+        metrics.add(Callback('usocks_tunnels',
+            "Number of active tunnels.", 'gauge',
+            lambda: len(self.tunnels)))
+        metrics.add(Callback('usocks_tunnel_packets_sent_total',
+            "Packets sent by tunnel layer.", 'counter',
+            partial(tunnel_stat, 'packets_sent')))
+        metrics.add(Callback('usocks_tunnel_packets_received_total',
+            "Packets received by tunnel layer.", 'counter',
+            partial(tunnel_stat, 'packets_received')))
+        metrics.add(Callback('usocks_compression_input_bytes_total',
+            "Bytes of data compressed before compression.", 'counter',
+            partial(tunnel_stat, 'compressed_input')))
+        metrics.add(Callback('usocks_compression_output_bytes_total',
+            "Bytes of data compressed after compression.", 'counter',
+            partial(tunnel_stat, 'compressed_output')))
+        metrics.add(Callback('usocks_tunnel_streams',
+            "Number of active streams in each tunnel.", 'gauge',
+            per_tunnel(lambda t: len(self.tunnels[t]))))
+        metrics.add(Callback('usocks_frontends',
+            "Number of active frontends.", 'gauge',
+            lambda: len(self.frontends)))
+        self.m_frontend_sent = metrics.add(Counter(
+            'usocks_frontend_bytes_sent_total',
+            "Bytes passed to frontends."))
+        self.m_frontend_received = metrics.add(Counter(
+            'usocks_frontend_bytes_received_total',
+            "Bytes received from frontends."))
+        self.m_throttled = metrics.add(Counter(
+            'usocks_shaping_throttled_total',
+            "Number of times frontends are held back by shaping."))
+        self.rejected = dict.fromkeys(['overload', 'max_tunnels',
+            'max_tunnels_per_ip', 'max_streams_per_ip',
+            'handshake_timeout'], 0)
+        metrics.add(Callback('usocks_admission_rejected_total',
+            "Number of tunnels and streams rejected by admission control.",
+            'counter', lambda: [({'reason': reason}, count)
+                for reason, count in self.rejected.items()]))
+        metrics.add(Callback('usocks_loop_lag_seconds',
+            "Smoothed time spent processing one loop iteration.", 'gauge',
+            lambda: self.admission.loop_lag if self.admission else 0))
+        self.m_frontend_errors = metrics.add(Counter(
+            'usocks_frontend_errors_total',
+            "Number of frontends failed to be created or closed by errors."))
+        metrics.add(Callback('usocks_udp_flows',
+            "Number of active datagram flows.", 'gauge',
+            lambda: len(self.flows)))
+        self.m_datagrams_sent = metrics.add(Counter(
+            'usocks_udp_datagrams_sent_total',
+            "Datagrams passed to UDP frontends."))
+        self.m_datagrams_received = metrics.add(Counter(
+            'usocks_udp_datagrams_received_total',
+            "Datagrams received from UDP frontends."))
+        self.m_datagrams_dropped = metrics.add(Counter(
+            'usocks_udp_datagrams_dropped_total',
+            "Datagrams dropped because of full buffers or rejected flows."))
 
     def run(self):
         self.running = True
@@ -66,68 +356,339 @@ class TunnelServer(object):
                         .format(exc_type, str(e), repr(exc_tb))
                 error(msg, 'tunnel', None)
         # close connections
+        self.signal_waker.close()
         self.backend.close()
-        for tunnel in self.tunnels.keys():
+        if self.stats_server:
+            self.stats_server.close()
+        if self.upgrade_listener:
+            self.upgrade_listener.close()
+        if self.handed_over:
+            self._release()
+            if self.tracer:
+                self.tracer.close()
+            if self.capturer:
+                self.capturer.close()
+            return
+        for tunnel in list(self.tunnels):
             self._close_tunnel(tunnel)
+        deadline = time.time() + self.close_timeout
         while True:
-            wlist, wdict = get_select_list(
-                    'get_wlist', self.tunnels.iterkeys())
-            if not wlist:
+            wlist, wdict = get_select_list('get_wlist',
+                    (self._process_tunnel_sending, self.tunnels))
+            timeout = deadline - time.time()
+            if not wlist or timeout <= 0:
                 break
-            _, wlist, _ = select.select([], wlist, [])
+            _, wlist, _ = select.select([], wlist, [], timeout)
             for fileno in wlist:
-                conn = wdict[fileno]
-                if conn in self.tunnels:
-                    self._process_tunnel_sending(conn)
+                handler, conn = wdict[fileno]
+                handler(conn)
+        if self.tracer:
+            self.tracer.close()
+        if self.capturer:
+            self.capturer.close()
 
     def _process(self):
+        # backlogged tunnels are not read until their buffered
+        # packets are processed
+        stats = (self.stats_server,) if self.stats_server else ()
+        upgrade_listener = (self.upgrade_listener,) \
+                if self.upgrade_listener else ()
         rlist, rdict = get_select_list('get_rlist',
-                self.backend, self.tunnels.iterkeys(),
-                (frontend for frontend, (conn_id, tunnel)
-                    in self.frontends.iteritems()
-                    if tunnel.available))
+                (self._process_signal, (self.signal_waker,)),
+                (self._process_backend, (self.backend,)),
+                (self._process_stats, stats),
+                (self._process_upgrade, upgrade_listener),
+                (self._process_tunnel, (tunnel for tunnel in self.tunnels
+                    if tunnel not in self.backlogged)),
+                (self._process_frontend, (frontend for frontend, stream
+                    in self.frontends.items()
+                    if stream.tunnel.available and
+                    stream.shape_timer is None)),
+                (self._process_flow, self.flows))
         wlist, wdict = get_select_list('get_wlist',
-                self.tunnels.iterkeys(), self.frontends.iterkeys())
+                (self._process_stats, stats),
+                (self._process_tunnel_sending, self.tunnels),
+                (self._process_frontend_sending, self.frontends))
+        timeout = 0 if self.backlogged else self.timers.timeout()
         try:
-            rlist, wlist, _ = select.select(rlist, wlist, [])
+            rlist, wlist, _ = select.select(rlist, wlist, [], timeout)
         except select.error as e:
-            if e[0] == errno.EINTR:
+            if e.args[0] == errno.EINTR:
                 return
             raise
+        self.now = start = time.time()
+        watchdog = self.watchdog
+        if watchdog:
+            watchdog.begin()
+            watchdog.enter('timers')
+        self.timers.advance(self.now)
 
+        # continue processing backlogged tunnels
+        backlogged = self.backlogged
+        self.backlogged = set()
+        for tunnel in backlogged:
+            if watchdog:
+                watchdog.enter('backlog', tunnel)
+            self._process_tunnel(tunnel, False)
         for fileno in rlist:
-            conn = rdict[fileno]
-            if conn is self.backend:
-                self._process_backend()
-            elif conn in self.tunnels:
-                self._process_tunnel(conn)
-            elif conn in self.frontends:
-                self._process_frontend(conn)
-        written_conns = ObjectSet()
+            # connections which have been handed over to a new process
+            # must not be touched, as their state has been dumped
+            if self.handed_over:
+                break
+            handler, conn = rdict[fileno]
+            if watchdog:
+                watchdog.enter('read', conn)
+            handler(conn)
+        written_conns = set()
         for fileno in wlist:
-            conn = wdict[fileno]
+            if self.handed_over:
+                break
+            handler, conn = wdict[fileno]
             if conn in written_conns:
                 continue
             written_conns.add(conn)
-            if conn in self.tunnels:
-                self._process_tunnel_sending(conn)
-            else:
-                conn.send()
+            if watchdog:
+                watchdog.enter('write', conn)
+            handler(conn)
+        if watchdog:
+            watchdog.end()
+        duration = time.time() - start
+        self.m_iterations.observe(duration)
+        if self.admission:
+            self.admission.update_lag(duration)
 
-    def _process_backend(self):
-        inst = self.backend.accept()
-        if not inst:
-            return
-        record_conn = RecordConnection(self.key, inst)
-        tunnel = TunnelConnection(record_conn)
-        tunnel.address = inst.address
+    def _describe(self, conn):
+        """_describe(conn) --> (layer, client)"""
+        if conn is None:
+            return 'tunnel', None
+        if conn is self.backend:
+            return 'backend', None
+        if conn is self.stats_server:
+            return 'stats', None
+        if conn is self.upgrade_listener:
+            return 'upgrade', None
+        if conn in self.tunnels:
+            return 'tunnel', conn.address
+        if conn in self.frontends:
+            return 'frontend', self.frontends[conn].tunnel.address
+        if conn in self.flows:
+            return 'udp', self.flows[conn].tunnel.address
+        return 'tunnel', None
+
+    def _report_slow(self, total, spans):
+        for duration, phase, conn in spans:
+            layer, client = self._describe(conn)
+            msg = "slow iteration took {0:.0f}ms, {1:.0f}ms in {2}"\
+                    .format(total * 1000, duration * 1000, phase)
+            warning(msg, layer, client)
+
+    def _process_backend(self, backend):
+        admission = self.admission
+        for inst in backend.accept():
+            if admission:
+                reason = admission.admit_tunnel(inst.address)
+                if reason:
+                    self.rejected[reason] += 1
+                    debug("rejected: " + reason, 'backend', inst.address)
+                    inst.close()
+                    continue
+            record_conn = RecordConnection(self.key, inst)
+            tunnel = Tunnel(record_conn, self.compression)
+            tunnel.address = inst.address
+            tunnel.id = self.next_tunnel_id
+            self.next_tunnel_id += 1
+            if self.capturer:
+                tunnel.capture = self.capturer.tunnel(tunnel.id)
+            self._add_tunnel(tunnel)
+            self.m_accepted.inc()
+            info("connected", 'backend', inst.address)
+
+    def _add_tunnel(self, tunnel):
+        """_add_tunnel(tunnel) --> None
+
+        Start timers of a new tunnel and register it.
+        """
+        record_conn = tunnel.record_conn
+        admission = self.admission
+        tunnel.last_active = self.now
+        tunnel.idle_timer = None
+        if self.tunnel_idle_timeout:
+            tunnel.idle_timer = self.timers.schedule(
+                    self.tunnel_idle_timeout,
+                    self._check_tunnel_idle, tunnel)
+        tunnel.handshake_timer = None
+        tunnel.close_timer = None
+        if admission and admission.handshake_timeout:
+            tunnel.handshake_timer = self.timers.schedule(
+                    admission.handshake_timeout,
+                    self._check_handshake, tunnel)
+        tunnel.keepalive = None
+        if self.keepalive is not None:
+            tunnel.keepalive = Keepalive(self.timers, record_conn,
+                    partial(self._keepalive_dead, tunnel),
+                    partial(self._keepalive_slow, tunnel),
+                    **self.keepalive)
+        tunnel.bucket = None
+        if self.shaper:
+            tunnel.bucket = self.shaper.add_tunnel(tunnel.address)
+        tunnel.cover = None
+        if self.cover is not None:
+            tunnel.cover = CoverTraffic(self.timers, record_conn,
+                    **self.cover)
+        tunnel.flows = {}
         self.tunnels[tunnel] = {}
-        info("connected", 'backend', inst.address)
 
-    def _process_tunnel(self, tunnel):
+    def _process_upgrade(self, upgrade_listener):
+        conn = upgrade_listener.accept()
+        if conn is None:
+            return
+        info("handing over to new process", 'upgrade', None)
         try:
-            for packet in tunnel.receive_packets():
+            if not hasattr(self.backend, 'dump'):
+                raise upgrade.UpgradeError(
+                        "backend does not support upgrading")
+            sockets = []
+            state = self._dump(sockets)
+            handed_over = upgrade.send_state(conn, state, sockets)
+        except (socket.error, upgrade.UpgradeError) as e:
+            error("cannot hand over: " + str(e), 'upgrade', None)
+            handed_over = False
+        if not handed_over:
+            warning("new process failed, resumed", 'upgrade', None)
+            conn.close()
+            return
+        # the connection is closed when the sockets are released
+        self.upgrade_conn = conn
+        self.handed_over = True
+        self.running = False
+
+    def _dump(self, sockets):
+        """_dump(sockets) --> dict
+
+        Return the state of the server for upgrading, in which sockets
+        are referred to by their indices in list sockets. Streams
+        which cannot be passed are reset. Datagram flows are passed
+        along with their tunnels.
+        """
+        tunnels = []
+        for tunnel, frontends in self.tunnels.items():
+            streams = {}
+            targets = {}
+            for conn_id, frontend in list(frontends.items()):
+                stream_state = frontend.dump(sockets)
+                if stream_state is None:
+                    tunnel.reset_connection(conn_id)
+                    self._close_frontend(frontend, True)
+                    continue
+                streams[conn_id] = stream_state
+                target = self.frontends[frontend].target
+                if target is not None:
+                    targets[conn_id] = target
+            flows = dict((flow_id, frontend.dump(sockets))
+                    for flow_id, frontend in tunnel.flows.items())
+            record_conn = tunnel.record_conn
+            tunnels.append({
+                'id': tunnel.id,
+                'backend': record_conn.backend.dump(sockets),
+                'record': record_conn.dump(),
+                'tunnel': tunnel.dump(),
+                'streams': streams,
+                'targets': targets,
+                'flows': flows,
+                })
+        return {
+                'backend': self.backend.dump(sockets),
+                'tunnels': tunnels,
+                'next_tunnel_id': self.next_tunnel_id,
+                }
+
+    def _restore(self, state, sockets):
+        """_restore(state, sockets) --> list of Tunnel
+
+        Rebuild the tunnels dumped by another process without doing
+        any I/O. Return the tunnels which were being closed, which
+        should be closed again once the handoff is finished.
+        """
+        closing = []
+        for tunnel_state in state['tunnels']:
+            inst = self.backend.restore_instance(
+                    tunnel_state['backend'], sockets)
+            record_conn = RecordConnection.restore(
+                    tunnel_state['record'], inst)
+            tunnel = Tunnel.restore(tunnel_state['tunnel'],
+                    record_conn, self.compression)
+            tunnel.address = inst.address
+            tunnel.id = tunnel_state['id']
+            if self.admission:
+                self.admission.add_tunnel(tunnel.address)
+            self._add_tunnel(tunnel)
+            targets = tunnel_state.get('targets', {})
+            for conn_id, stream_state in tunnel_state['streams'].items():
+                target = targets.get(conn_id)
+                frontend_class, opts = self.targets[target]
+                frontend = frontend_class.restore(stream_state, sockets,
+                        **opts)
+                if self.admission:
+                    self.admission.add_stream(tunnel.address)
+                self._add_stream(tunnel, conn_id, frontend, target)
+            for flow_id, flow_state in tunnel_state.get('flows', {}).items():
+                frontend = DatagramFrontend.restore(flow_state, sockets)
+                if self.udp is None:
+                    # the client opens the flow again if it is still
+                    # used, which is then dropped as any other
+                    frontend.close()
+                    continue
+                if self.admission:
+                    self.admission.add_stream(tunnel.address)
+                self._add_flow(tunnel, flow_id, frontend)
+            if record_conn.closed:
+                closing.append(tunnel)
+            elif tunnel.has_pending():
+                self.backlogged.add(tunnel)
+        self.next_tunnel_id = state['next_tunnel_id']
+        info("took over {0} tunnels, {1} streams and {2} flows".format(
+            len(self.tunnels), len(self.frontends), len(self.flows)),
+            'upgrade', None)
+        return closing
+
+    def _release(self):
+        """_release() --> None
+
+        Close sockets which have been handed over to the new process
+        without touching the connections.
+        """
+        for tunnel, frontends in self.tunnels.items():
+            for frontend in frontends.values():
+                frontend.close()
+            tunnel.record_conn.backend.close()
+        for frontend in self.flows:
+            frontend.close()
+        self.tunnels = {}
+        self.frontends = {}
+        self.flows = {}
+        self.upgrade_conn.close()
+        info("handed over to new process", 'upgrade', None)
+
+    def _process_signal(self, signal_waker):
+        signal_waker.clear()
+
+    def _process_stats(self, stats_server):
+        stats_server.process()
+
+    def _process_tunnel(self, tunnel, recv=True):
+        # the tunnel may have been closed earlier in this iteration
+        if tunnel not in self.tunnels:
+            return
+        budget = self.tunnel_budget
+        tunnel.last_active = self.now
+        try:
+            for packet in tunnel.receive_packets(recv):
                 self._process_tunnel_packet(tunnel, *packet)
+                budget -= tunnel_header_size + len(packet[2])
+                if budget <= 0:
+                    break
+            if tunnel.has_pending():
+                self.backlogged.add(tunnel)
         except record.ConnectionClosedException:
             self._close_tunnel(tunnel)
             info("disconnected", 'record', tunnel.address)
@@ -135,22 +696,39 @@ class TunnelServer(object):
             # logging message
             if isinstance(e, record.HashfailError):
                 msg = "detect a wrong hash"
+                name = 'hashfail'
             elif isinstance(e, record.InvalidHeaderError):
                 msg = "detect an invalid header"
+                name = 'invalid_header'
             elif isinstance(e, record.RemoteResetException):
                 msg = "remote host reset the connection"
+                name = 'remote_reset'
             elif isinstance(e, record.InsecureClosingError):
                 msg = "detect an insecure closing"
+                name = 'insecure_closing'
             elif isinstance(e, record.FirstPacketIncorrectError):
                 msg = "first packet is incorrect, protocol incompatible"
+                name = 'first_packet_incorrect'
             else:
                 msg = "detect a critical exception"
+                name = 'other'
             # log the exception
             warning(msg, 'record', tunnel.address)
+            self.record_errors[name] += 1
 
             self._close_tunnel(tunnel)
+        except (CompressionError, UnexpectedCompressionError):
+            warning("detect invalid compressed data", 'tunnel',
+                    tunnel.address)
+            self._close_tunnel(tunnel)
+        except InvalidTargetError:
+            warning("detect an invalid target", 'tunnel', tunnel.address)
+            self._close_tunnel(tunnel)
 
     def _process_tunnel_packet(self, tunnel, conn_id, control, data):
+        if control & StatusControl.dgr:
+            self._process_datagram(tunnel, conn_id, control, data)
+            return
         frontends = self.tunnels[tunnel]
         # RST flag is set
         if control & StatusControl.rst:
@@ -159,66 +737,332 @@ class TunnelServer(object):
         if control & StatusControl.syn:
             if conn_id in frontends:
                 self._close_frontend(frontends[conn_id], True)
+            target = None
+            if control & StatusControl.tgt:
+                target = tunnel.pop_target(conn_id).decode('utf-8',
+                        'replace')
+            if target not in self.targets:
+                warning("unknown target: {0}".format(target), 'frontend',
+                        tunnel.address)
+                self.m_frontend_errors.inc()
+                tunnel.reset_connection(conn_id)
+                return
+            trace = None
+            if control & StatusControl.trc:
+                trace_id = tunnel.pop_trace_id(conn_id)
+                if self.tracer:
+                    trace = Trace(trace_id, tunnel.record_conn.last_received)
+                    trace.mark('syn')
+            if self.admission:
+                reason = self.admission.admit_stream(tunnel.address)
+                if reason:
+                    self.rejected[reason] += 1
+                    debug("rejected: " + reason, 'frontend', tunnel.address)
+                    tunnel.reset_connection(conn_id)
+                    return
+            frontend_class, opts = self.targets[target]
             try:
-                frontend = self.new_frontend()
+                frontend = frontend_class(**opts)
             except FrontendUnavailableError:
                 error("unavailable", 'frontend', tunnel.address)
+                self.m_frontend_errors.inc()
+                if self.admission:
+                    self.admission.remove_stream(tunnel.address)
                 tunnel.reset_connection(conn_id)
+                if trace is not None:
+                    trace.mark('unavailable')
+                    self.tracer.finish(trace)
                 return
-            frontends[conn_id] = frontend
-            self.frontends[frontend] = conn_id, tunnel
+            self._add_stream(tunnel, conn_id, frontend, target)
+            if trace is not None:
+                trace.mark('connected')
+                self.frontends[frontend].trace = trace
         # DAT flag is set
         if control & StatusControl.dat:
-            frontends[conn_id].send(data)
+            frontend = frontends[conn_id]
+            self.frontends[frontend].last_active = self.now
+            self.m_frontend_sent.inc(len(data))
+            frontend.send(data)
         # FIN flag is set
         if control & StatusControl.fin:
             self._close_frontend(frontends[conn_id])
 
+    def _add_stream(self, tunnel, conn_id, frontend, target=None):
+        self.tunnels[tunnel][conn_id] = frontend
+        stream = self.frontends[frontend] = Stream(conn_id, tunnel, target)
+        stream.last_active = self.now
+        if self.idle_timeout:
+            stream.idle_timer = self.timers.schedule(
+                    self.idle_timeout,
+                    self._check_frontend_idle, frontend)
+        if self.shaper:
+            stream.bucket = self.shaper.add_stream(tunnel.bucket)
+
+    def _process_datagram(self, tunnel, flow_id, control, data):
+        frontend = tunnel.flows.get(flow_id)
+        if control & StatusControl.fin:
+            if frontend is not None:
+                self._close_flow(frontend)
+            return
+        if not (control & StatusControl.dat):
+            return
+        if frontend is None:
+            frontend = self._open_flow(tunnel, flow_id)
+            if frontend is None:
+                self.m_datagrams_dropped.inc()
+                return
+        self.flows[frontend].last_active = self.now
+        if frontend.send(data):
+            self.m_datagrams_sent.inc()
+        else:
+            self.m_datagrams_dropped.inc()
+
+    def _open_flow(self, tunnel, flow_id):
+        """_open_flow(tunnel, flow_id) --> DatagramFrontend or None"""
+        if self.udp is None:
+            return None
+        if self.admission:
+            reason = self.admission.admit_stream(tunnel.address)
+            if reason:
+                self.rejected[reason] += 1
+                debug("rejected: " + reason, 'udp', tunnel.address)
+                return None
+        try:
+            frontend = DatagramFrontend(**self.udp)
+        except socket.error as e:
+            error("unavailable: " + str(e), 'udp', tunnel.address)
+            self.m_frontend_errors.inc()
+            if self.admission:
+                self.admission.remove_stream(tunnel.address)
+            return None
+        self._add_flow(tunnel, flow_id, frontend)
+        return frontend
+
+    def _add_flow(self, tunnel, flow_id, frontend):
+        """_add_flow(tunnel, flow_id, frontend) --> None
+
+        Start the idle timer of a new flow and register it.
+        """
+        tunnel.flows[flow_id] = frontend
+        flow = self.flows[frontend] = Flow(flow_id, tunnel)
+        flow.last_active = self.now
+        flow.idle_timer = self.timers.schedule(self.flow_timeout,
+                self._check_flow_idle, frontend)
+
+    def _process_flow(self, frontend):
+        flow = self.flows.get(frontend)
+        if flow is None:
+            return
+        datagrams = frontend.recv()
+        if datagrams:
+            flow.last_active = flow.tunnel.last_active = self.now
+        # datagrams are dropped rather than held while the buckets of
+        # the tunnel are in debt
+        bucket = flow.tunnel.bucket
+        for data in datagrams:
+            self.m_datagrams_received.inc()
+            if bucket is not None and bucket.delay(self.now) > 0:
+                self.m_datagrams_dropped.inc()
+            elif flow.tunnel.send_datagram(flow.flow_id, data):
+                if bucket is not None:
+                    bucket.consume(len(data), self.now)
+            else:
+                self.m_datagrams_dropped.inc()
+
+    def _check_flow_idle(self, frontend):
+        flow = self.flows[frontend]
+        idle = self.now - flow.last_active
+        if idle < self.flow_timeout:
+            flow.idle_timer = self.timers.schedule(
+                    self.flow_timeout - idle,
+                    self._check_flow_idle, frontend)
+            return
+        flow.idle_timer = None
+        self._close_flow(frontend)
+
+    def _close_flow(self, frontend):
+        flow = self.flows.pop(frontend)
+        if flow.idle_timer:
+            flow.idle_timer.cancel()
+        frontend.close()
+        del flow.tunnel.flows[flow.flow_id]
+        if self.admission:
+            self.admission.remove_stream(flow.tunnel.address)
+
     def _process_frontend(self, frontend):
-        conn_id, tunnel = self.frontends[frontend]
+        stream = self.frontends.get(frontend)
+        if stream is None:
+            return
+        conn_id, tunnel = stream.conn_id, stream.tunnel
         try:
             data = frontend.recv()
         except Exception as e:
             msg = "unknown error: " + str(e)
             error(msg, 'frontend', tunnel.address)
+            self.m_frontend_errors.inc()
             tunnel.reset_connection(conn_id)
             self._close_frontend(frontend)
             return
         if data:
-            tunnel.send_packet(conn_id, data)
+            stream.last_active = tunnel.last_active = self.now
+            self.m_frontend_received.inc(len(data))
+            trace = stream.trace
+            if trace is not None and trace.mark('first_upstream'):
+                tunnel.send_packet(conn_id, data, trace)
+            else:
+                tunnel.send_packet(conn_id, data)
+            if stream.bucket is not None:
+                stream.bucket.consume(len(data), self.now)
+                self._check_shaping(frontend)
         elif data is None:
             tunnel.close_connection(conn_id)
             self._close_frontend(frontend)
 
+    def _check_shaping(self, frontend):
+        """_check_shaping(frontend) --> None
+
+        Hold back reading of frontend until its buckets have tokens.
+        """
+        stream = self.frontends.get(frontend)
+        if stream is None:
+            return
+        stream.shape_timer = None
+        delay = stream.bucket.delay()
+        if delay > 0:
+            self.m_throttled.inc()
+            stream.shape_timer = self.timers.schedule(delay,
+                    self._check_shaping, frontend)
+
+    def _process_frontend_sending(self, frontend):
+        if frontend in self.frontends:
+            frontend.send()
+
     def _process_tunnel_sending(self, tunnel):
+        if tunnel not in self.tunnels:
+            return
         tunnel.continue_sending()
         if tunnel.record_conn.closed:
             if not tunnel.get_wlist():
                 tunnel.record_conn.backend.close()
-                del self.tunnels[tunnel]
+                self._remove_tunnel(tunnel)
 
-    def _close_tunnel(self, tunnel):
-        for frontend in self.tunnels[tunnel].values():
-            self._close_frontend(frontend)
-        tunnel.record_conn.close()
+    def _remove_tunnel(self, tunnel):
+        del self.tunnels[tunnel]
+        if tunnel.close_timer:
+            tunnel.close_timer.cancel()
+        if self.admission:
+            self.admission.remove_tunnel(tunnel.address)
+        if self.shaper:
+            self.shaper.remove_tunnel(tunnel.address)
+        record_conn = tunnel.record_conn
+        for name in self.retired:
+            if hasattr(record_conn, name):
+                self.retired[name] += getattr(record_conn, name)
+            else:
+                self.retired[name] += getattr(tunnel, name)
+
+    def _check_tunnel_idle(self, tunnel):
+        idle = self.now - tunnel.last_active
+        if idle < self.tunnel_idle_timeout:
+            tunnel.idle_timer = self.timers.schedule(
+                    self.tunnel_idle_timeout - idle,
+                    self._check_tunnel_idle, tunnel)
+            return
+        info("idle timeout", 'tunnel', tunnel.address)
+        self._close_tunnel(tunnel)
+
+    def _check_handshake(self, tunnel):
+        tunnel.handshake_timer = None
+        if tunnel not in self.tunnels or \
+                tunnel.record_conn.first_packet_checked:
+            return
+        self.rejected['handshake_timeout'] += 1
+        info("handshake timeout", 'record', tunnel.address)
+        self._close_tunnel(tunnel, True)
+
+    def _keepalive_dead(self, tunnel):
+        warning("keepalive timeout", 'record', tunnel.address)
+        self._close_tunnel(tunnel, True)
+
+    def _keepalive_slow(self, tunnel, srtt):
+        msg = "round trip time rises to {0:.0f}ms".format(srtt * 1000)
+        warning(msg, 'record', tunnel.address)
+
+    def _check_frontend_idle(self, frontend):
+        stream = self.frontends[frontend]
+        idle = self.now - stream.last_active
+        if idle < self.idle_timeout:
+            stream.idle_timer = self.timers.schedule(
+                    self.idle_timeout - idle,
+                    self._check_frontend_idle, frontend)
+            return
+        debug("idle timeout", 'frontend', stream.tunnel.address)
+        stream.tunnel.close_connection(stream.conn_id)
+        self._close_frontend(frontend)
+
+    def _close_tunnel(self, tunnel, abort=False):
+        """_close_tunnel(tunnel, abort=False) --> None
+
+        If abort is set, the backend is closed immediately without
+        sending remaining data, which is used when the remote is dead.
+        """
+        self.backlogged.discard(tunnel)
+        if tunnel.idle_timer:
+            tunnel.idle_timer.cancel()
+        if tunnel.handshake_timer:
+            tunnel.handshake_timer.cancel()
+        if tunnel.keepalive:
+            tunnel.keepalive.cancel()
+        if tunnel.cover:
+            tunnel.cover.cancel()
+        for frontend in list(self.tunnels[tunnel].values()):
+            self._close_frontend(frontend, abort)
+        for frontend in list(tunnel.flows.values()):
+            self._close_flow(frontend)
+        if abort:
+            tunnel.record_conn.closed = True
+            tunnel.record_conn.backend.close()
+            self._remove_tunnel(tunnel)
+            return
+        tunnel.close()
         self._process_tunnel_sending(tunnel)
+        # give up remaining data if the remote does not receive it
+        if tunnel in self.tunnels and tunnel.close_timer is None:
+            tunnel.close_timer = self.timers.schedule(self.close_timeout,
+                    self._check_closing, tunnel)
+
+    def _check_closing(self, tunnel):
+        tunnel.close_timer = None
+        if tunnel not in self.tunnels:
+            return
+        info("close timeout", 'record', tunnel.address)
+        tunnel.record_conn.backend.close()
+        self._remove_tunnel(tunnel)
 
     def _close_frontend(self, frontend, reset=False):
+        stream = self.frontends.pop(frontend)
+        if stream.idle_timer:
+            stream.idle_timer.cancel()
+        if stream.shape_timer:
+            stream.shape_timer.cancel()
         if reset:
             frontend.reset()
         else:
             frontend.close()
-        conn_id, tunnel = self.frontends[frontend]
-        del self.frontends[frontend]
-        del self.tunnels[tunnel][conn_id]
+        del self.tunnels[stream.tunnel][stream.conn_id]
+        if self.admission:
+            self.admission.remove_stream(stream.tunnel.address)
+        if stream.trace is not None:
+            stream.trace.mark('close')
+            self.tracer.finish(stream.trace)
 
 def usage():
     pass
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hc:vl:",
-                ["help", "config=", "verbose", "logfile="])
+        opts, args = getopt.getopt(sys.argv[1:], "hc:vl:u",
+                ["help", "config=", "verbose", "logfile=", "upgrade"])
     except getopt.GetoptError as e:
         print(str(e), file=sys.stderr)
         usage()
@@ -228,6 +1072,7 @@ def main():
     config_file = None
     log_file = None
     verbose = False
+    upgrading = False
     for o, a in opts:
         if o in ("-v", "--verbose"):
             verbose = True
@@ -238,6 +1083,8 @@ def main():
             config_file = a
         elif o in ("-l", "--logfile"):
             log_file = a
+        elif o in ("-u", "--upgrade"):
+            upgrading = True
         else:
             assert False, "unhandled option"
 
@@ -255,7 +1102,7 @@ def main():
         else:
             print("cannot find config file", file=sys.stderr)
             sys.exit(2)
-    config = yaml.load(open(config_file, "r"))
+    config = yaml.safe_load(open(config_file, "r"))
     if 'server' not in config:
         print("cannot find client config", file=sys.stderr)
         sys.exit(1)
@@ -273,12 +1120,25 @@ def main():
             stream=log_stream)
 
     # initialize server
-    server = TunnelServer(config['server'])
+    upgrade_from = None
+    if upgrading:
+        upgrade_from = config['server'].get('upgrade_socket')
+        if not upgrade_from:
+            print("upgrade_socket is not configured", file=sys.stderr)
+            sys.exit(1)
+    server = TunnelServer(config['server'], upgrade_from)
     # set signal handler
     def stop_handler(signum, frame):
         server.running = False
     signal.signal(signal.SIGINT, stop_handler)
     signal.signal(signal.SIGTERM, stop_handler)
+    def profile_handler(signum, frame):
+        if server.profile_toggle.toggle():
+            info("profiling started", 'tunnel', None)
+        else:
+            msg = "profile dumped to " + server.profile_toggle.filename
+            info(msg, 'tunnel', None)
+    signal.signal(signal.SIGUSR1, profile_handler)
     # start server
     server.run()
     
@@ -0,0 +1,117 @@
+# coding: UTF-8
+
+"""Hierarchical token bucket shaping.
+
+Each stream may have a bucket, whose parent is the bucket of its
+tunnel, whose parent is in turn the bucket shared by all tunnels from
+the same client address. Data taken by a stream is charged to all
+buckets along the chain, and the stream has to wait until every one
+of them has tokens again. Buckets are allowed to go into debt, so data
+which has been read is never dropped. Datagrams are charged to the
+buckets of their tunnels, and dropped while those are in debt.
+"""
+
+from __future__ import division
+
+import time
+
+class TokenBucket(object):
+    """TokenBucket(rate, burst=None, parent=None) --> TokenBucket object
+
+    rate is in bytes per second, and burst is the max number of
+    tokens, which is one second of rate by default.
+    """
+
+    def __init__(self, rate, burst=None, parent=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.parent = parent
+        self.updated = time.time()
+
+    def _refill(self, now):
+        tokens = self.tokens + (now - self.updated) * self.rate
+        self.tokens = min(tokens, self.burst)
+        self.updated = now
+
+    def consume(self, amount, now=None):
+        """consume(amount, now=None) --> None
+
+        Take amount tokens from this bucket and all its ancestors.
+        """
+        if now is None:
+            now = time.time()
+        bucket = self
+        while bucket is not None:
+            bucket._refill(now)
+            bucket.tokens -= amount
+            bucket = bucket.parent
+
+    def delay(self, now=None):
+        """delay(now=None) --> float
+
+        Seconds to wait until this bucket and all its ancestors are
+        out of debt.
+        """
+        if now is None:
+            now = time.time()
+        delay = 0
+        bucket = self
+        while bucket is not None:
+            bucket._refill(now)
+            if bucket.tokens < 0:
+                delay = max(delay, -bucket.tokens / bucket.rate)
+            bucket = bucket.parent
+        return delay
+
+class Shaper(object):
+    """Shaper(**opts) --> Shaper object
+
+    Options:
+        client      rate and burst shared by tunnels from one address
+        tunnel      rate and burst of each tunnel
+        stream      rate and burst of each stream
+
+    Levels which are not given are not limited.
+    """
+
+    def __init__(self, **opts):
+        self.client = opts.get('client')
+        self.tunnel = opts.get('tunnel')
+        self.stream = opts.get('stream')
+        # dictionary of client addresses to their buckets and number
+        # of tunnels using them
+        self.clients = {}
+
+    def add_tunnel(self, address):
+        """add_tunnel(address) --> TokenBucket or None
+
+        Return the bucket chain for a new tunnel from address.
+        """
+        parent = None
+        if self.client is not None:
+            entry = self.clients.get(address)
+            if entry is None:
+                entry = self.clients[address] = \
+                        [TokenBucket(**self.client), 0]
+            entry[1] += 1
+            parent = entry[0]
+        if self.tunnel is not None:
+            return TokenBucket(parent=parent, **self.tunnel)
+        return parent
+
+    def remove_tunnel(self, address):
+        if self.client is not None:
+            entry = self.clients[address]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.clients[address]
+
+    def add_stream(self, tunnel_bucket):
+        """add_stream(tunnel_bucket) --> TokenBucket or None
+
+        Return the bucket chain for a new stream in the tunnel.
+        """
+        if self.stream is not None:
+            return TokenBucket(parent=tunnel_bucket, **self.stream)
+        return tunnel_bucket
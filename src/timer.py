@@ -0,0 +1,159 @@
+# coding: UTF-8
+
+"""Hierarchical timer wheel.
+
+Timers are kept in slots of several wheels. The first wheel has one
+slot per tick; each slot of the wheel on the next level covers a full
+rotation of the previous one. When the first wheel finishes a
+rotation, timers in the due slot of the next level are cascaded down.
+Scheduling and cancellation are O(1), and advancing costs O(1) per
+tick plus the expired timers.
+
+The event loop is expected to use timeout() as the timeout of select,
+and call advance() after select returns.
+"""
+
+import time
+
+from collections import deque
+
+DEFAULT_TICK = 0.1
+DEFAULT_SLOTS = 256
+DEFAULT_LEVELS = 4
+
+class Timer(object):
+
+    def __init__(self, wheel, expire, callback, args):
+        self.wheel = wheel
+        self.expire = expire
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+    def cancel(self):
+        """cancel() --> None
+
+        Cancel the timer. It is safe to cancel a timer which has been
+        fired or cancelled, including one which has expired in the
+        same advance() but whose callback has not been called yet.
+        """
+        self.callback = None
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+
+    @property
+    def active(self):
+        return self.slot is not None
+
+class TimerWheel(object):
+    """TimerWheel(tick, slots, levels) --> TimerWheel object
+
+    tick is the resolution in seconds. Timers up to
+    tick * slots ** levels seconds ahead are kept precisely, and
+    later ones are parked in the last slot and cascaded again.
+    """
+
+    def __init__(self, tick=DEFAULT_TICK,
+            slots=DEFAULT_SLOTS, levels=DEFAULT_LEVELS):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[set() for i in range(slots)] for j in range(levels)]
+        self.start = time.time()
+        # number of ticks elapsed since start
+        self.current = 0
+        # number of pending timers
+        self.count = 0
+        # fired timers whose callbacks have not been called
+        self.expired = deque()
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay, callback, *args):
+        """schedule(delay, callback, *args) --> Timer
+
+        Call callback(*args) after delay seconds.
+        """
+        expire = int((time.time() + delay - self.start) / self.tick) + 1
+        timer = Timer(self, max(expire, self.current + 1), callback, args)
+        self._insert(timer)
+        self.count += 1
+        return timer
+
+    def _insert(self, timer):
+        delta = timer.expire - self.current
+        span = 1
+        for level in range(self.levels):
+            if delta < span * self.slots:
+                index = (timer.expire // span) % self.slots
+                break
+            span *= self.slots
+        else:
+            # too far, park it in the slot which is cascaded last
+            span //= self.slots
+            index = (self.current // span - 1) % self.slots
+        timer.slot = self.wheels[level][index]
+        timer.slot.add(timer)
+
+    def _step(self):
+        self.current += 1
+        # cascade timers from upper levels, the highest level first
+        for level in range(self.levels - 1, 0, -1):
+            span = self.slots ** level
+            if self.current % span:
+                continue
+            slot = self.wheels[level][(self.current // span) % self.slots]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._insert(timer)
+        slot = self.wheels[0][self.current % self.slots]
+        for timer in slot:
+            timer.slot = None
+            self.expired.append(timer)
+        self.count -= len(slot)
+        slot.clear()
+
+    def advance(self, now=None):
+        """advance(now=None) --> None
+
+        Move the wheel to now and call callbacks of expired timers.
+        """
+        if now is None:
+            now = time.time()
+        target = int((now - self.start) / self.tick)
+        while self.current < target:
+            if not self.count:
+                self.current = target
+                break
+            self._step()
+        while self.expired:
+            timer = self.expired.popleft()
+            # it may have been cancelled by an earlier callback
+            if timer.callback is not None:
+                timer.callback(*timer.args)
+
+    def timeout(self, now=None):
+        """timeout(now=None) --> float or None
+
+        Seconds until next tick which may have expired timers, or None
+        if there is no timer at all.
+        """
+        if self.expired:
+            return 0
+        if not self.count:
+            return None
+        if now is None:
+            now = time.time()
+        wheel = self.wheels[0]
+        for i in range(1, self.slots):
+            if wheel[(self.current + i) % self.slots]:
+                ticks = i
+                break
+        else:
+            # wake up at next cascading
+            ticks = self.slots - self.current % self.slots
+        return max(0, self.start + (self.current + ticks) * self.tick - now)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# coding: UTF-8
+
+"""Sampled latency tracing of streams.
+
+The client samples a fraction of new streams. A sampled stream gets a
+random 8-byte trace ID, which is sent along with its SYN so that the
+server traces it as well if it supports that, see the Tracing section
+of the tunnel module. Each side records when the stream goes through
+its layers, and writes one JSON line per stream to its trace file
+when it is closed:
+
+    {"trace": "<hex ID>", "side": "client", "start": <unix time>,
+     "events": {"<event>": <seconds since start>, ...}}
+
+Only the first occurrence of each event is recorded. Events of the
+client, starting from accepting the local connection:
+
+    first_read      first data read from the local connection
+    encrypted       record carrying the SYN is encrypted
+    queued          SYN is held in the tunnel layer before that
+    flushed         record carrying the SYN is written to the socket
+    first_response  first data received from the server
+    close           stream is closed
+
+Events of the server, starting from reading the record carrying the
+SYN from the backend:
+
+    syn             SYN is decrypted and processed
+    connected       frontend is created, e.g. connected to the target
+    unavailable     frontend cannot be created
+    first_upstream  first data received from the frontend
+    queued, encrypted, flushed
+                    as above, for the record carrying that data
+    close           stream is closed
+
+Clocks of the two sides are not synchronized, so the events should
+only be compared with those of the same side. Run this module with
+trace files to summarize them.
+
+Usage:
+    tracing.py file...
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import time
+import random
+import binascii
+
+from collections import defaultdict
+
+DEFAULT_SAMPLE_RATE = 0.01
+TRACE_ID_SIZE = 8
+
+class Trace(object):
+    """Trace(trace_id, start=None) --> Trace object
+
+    start is the time of the first event, now by default.
+    """
+
+    __slots__ = ('trace_id', 'start', 'events')
+
+    def __init__(self, trace_id, start=None):
+        self.trace_id = trace_id
+        self.start = time.time() if start is None else start
+        self.events = {}
+
+    def mark(self, event):
+        """mark(event) --> bool
+
+        Record event now, and return whether it is its first
+        occurrence.
+        """
+        if event in self.events:
+            return False
+        self.events[event] = time.time() - self.start
+        return True
+
+class Tracer(object):
+    """Tracer(side, **opts) --> Tracer object
+
+    Options:
+        file            path of the trace file, which is appended to
+        sample_rate     fraction of streams sampled by the client
+    """
+
+    sample_rate = DEFAULT_SAMPLE_RATE
+
+    def __init__(self, side, **opts):
+        self.side = side
+        if 'sample_rate' in opts:
+            self.sample_rate = opts['sample_rate']
+        # line buffered, so that traces are not lost when killed
+        self.file = open(opts['file'], 'a', 1)
+        self.random = random.Random()
+
+    def sample(self):
+        """sample() --> Trace or None
+
+        Start a trace with a new ID for a fraction of calls.
+        """
+        if self.random.random() >= self.sample_rate:
+            return None
+        return Trace(os.urandom(TRACE_ID_SIZE))
+
+    def finish(self, trace):
+        """finish(trace) --> None
+
+        Write trace to the trace file.
+        """
+        self.file.write(json.dumps({
+            'trace': binascii.hexlify(trace.trace_id).decode('ascii'),
+            'side': self.side,
+            'start': trace.start,
+            'events': trace.events,
+            }, sort_keys=True) + "\n")
+
+    def close(self):
+        self.file.close()
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+def summarize(lines):
+    """summarize(lines) --> list of str
+
+    Return a table of milliseconds from the start to each event, by
+    side, of the traces in JSON lines.
+    """
+    offsets = defaultdict(lambda: defaultdict(list))
+    sides = defaultdict(set)
+    for line in lines:
+        if not line.strip():
+            continue
+        trace = json.loads(line)
+        sides[trace['trace']].add(trace['side'])
+        for event, offset in trace['events'].items():
+            offsets[trace['side']][event].append(offset)
+    joined = sum(1 for found in sides.values() if len(found) > 1)
+    table = ["{0} traces, {1} of them found on both sides"
+            .format(len(sides), joined)]
+    for side in sorted(offsets):
+        table.append("")
+        table.append("{0:16} {1:>7} {2:>9} {3:>9} {4:>9}".format(
+            side, "count", "p50 ms", "p90 ms", "p99 ms"))
+        events = offsets[side]
+        for event in sorted(events,
+                key=lambda event: percentile(events[event], 50)):
+            values = events[event]
+            table.append("{0:16} {1:>7} {2:>9.1f} {3:>9.1f} {4:>9.1f}"
+                    .format(event, len(values),
+                        *[percentile(values, p) * 1000
+                            for p in (50, 90, 99)]))
+    return table
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+        print(__doc__, file=sys.stderr)
+        sys.exit(2)
+    lines = []
+    for filename in sys.argv[1:]:
+        with open(filename) as f:
+            lines.extend(f)
+    for line in summarize(lines):
+        print(line)
+
+if __name__ == '__main__':
+    main()
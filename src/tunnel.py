@@ -12,16 +12,22 @@ Packet Structure:
      0                   1                   2                   3
      0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
-    |               |       |R|F|D|S|                               |
-    |    Version    |       |S|I|A|Y|         Connection ID         |
-    |               |       |T|N|T|N|                               |
+    |               |T|T|D|C|R|F|D|S|                               |
+    |    Version    |G|R|G|M|S|I|A|Y|         Connection ID         |
+    |               |T|C|R|P|T|N|T|N|                               |
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
     Version         8-bit version number = 1.
 
     Control bits    4-bit flags. See Connection Procedure.
 
-    Reserved        4 bits reserved for future use. Must be zero.
+    CMP             Body is compressed. See Compression.
+
+    DGR             Body is a datagram. See Datagrams.
+
+    TRC             Connection is traced. See Tracing.
+
+    TGT             Target of connection is named. See Targets.
 
     Connection ID   16-bit Connection ID which is used for identifying
                     connections. This id must be unique for each
@@ -65,24 +71,104 @@ Connection Procedure:
     FIN flag, receiver must reply a RST packet, and all connection
     resources are released only after a packet with RST is received.
 
+Control Channel:
+
+    Connection ID 0 is never allocated for connections. Packets with
+    it carry options of the tunnel itself.
+
+Compression:
+
+    Compression is negotiated through the control channel. Client
+    half sends a packet with SYN set and a comma-separated list of
+    codec names it supports in order of preference as body. Server
+    half replies with SYN set and the name of the chosen codec, or an
+    empty string if compression is not used, followed by the names of
+    the optional features of the protocol it supports, all separated
+    by commas. Either half may set CMP on packets with DAT after the
+    negotiation; the body of such packets is compressed by the chosen
+    codec, independently of others.
+
+    A server half which does not know the control channel treats the
+    request as a new connection, so it should only be sent when the
+    server is known to support it. Older server halves reply with the
+    codec alone, i.e. without any features.
+
+Datagrams:
+
+    Packets with DGR set carry datagrams, e.g. of UDP, which belong to
+    flows rather than connections, and the Connection ID field holds
+    the Flow ID. Flow IDs are allocated by client half independently
+    of Connection IDs. A packet with DGR and DAT carries one datagram,
+    and server half creates the flow when a datagram of an unknown
+    flow arrives. Client half sends DGR and FIN when it discards a
+    flow, after which the Flow ID may be reused, while server half
+    discards flows silently. Datagrams are never compressed, and may
+    be dropped.
+
+    Packets of connections are held in the tunnel layer while the
+    backend has much data buffered, but datagrams are passed to the
+    record layer at once, so that they overtake bulk data.
+
+Tracing:
+
+    Client half may set TRC on the packet with SYN of a connection it
+    traces, once the server half has listed the "trace" feature in its
+    reply on the control channel. The body of such packet starts with
+    an 8-byte trace ID, followed by the data, which is compressed alone
+    if CMP is set.
+
+Targets:
+
+    Client half may set TGT on the packet with SYN to choose what the
+    server half connects the connection to, once the server half has
+    listed the "target" feature in its reply on the control channel.
+    The body of such packet starts with an 8-bit length and the name
+    of the target in UTF-8, after the trace ID if TRC is set as well.
+    Without TGT, the default target of the server half is used. Server
+    half should reset connections to targets it does not know.
+
 """
 
 VERSION_CODE = 1
 
 import struct
 
+from collections import deque
+
+from compression import Compressor, available as available_codecs
+from tracing import TRACE_ID_SIZE
+
 class UnsupportVersionError(Exception): pass
 class NoIDAvailableError(Exception): pass
+class UnexpectedCompressionError(Exception): pass
+class InvalidTargetError(Exception): pass
 
 header_format = "!BBH"
 header_size = struct.calcsize(header_format)
 max_conn_id = 65535
+control_conn_id = 0
+# max bytes of the name of a target
+max_target_size = 255
+# optional features of the protocol supported, see Control Channel
+features = ("trace", "target")
+# max bytes of data in one packet of connections, which fits in one
+# record
+max_data_size = 65535 - header_size
+# bytes buffered in the backend above which packets of connections
+# are held in the tunnel layer
+queue_threshold = 16384
+# bytes buffered in the backend above which datagrams are dropped
+datagram_limit = 262144
 
 class StatusControl(object):
     syn = 1 # first packet, means connection is started
     dat = 2 # data transmission
     fin = 4 # connection is closed
     rst = 8 # connection is resetted
+    cmp = 16 # body is compressed
+    dgr = 32 # body is a datagram of a flow
+    trc = 64 # body starts with a trace ID
+    tgt = 128 # body starts with a target name
 
 class ConnectionStatus(object):
     new         = 0 # connection is created, but SYN has not been sent
@@ -114,57 +200,301 @@ class IDAllocator(object):
             self.recycled.remove(self.next_id)
 
 class TunnelConnection(object):
+    """TunnelConnection(record_conn, compression=None) --> object
+
+    compression is a dictionary of options of Compressor, plus
+    "codecs", a list of names of codecs allowed. If it is None,
+    compression is never used.
+
+    If capture is set to a TunnelCapture of capture module, all packets
+    sent and received are written to it.
+    """
 
-    def __init__(self, record_conn):
+    __slots__ = ('record_conn', 'id_allocator', 'conn_states',
+            'flow_allocator', 'send_queue', 'available', 'compression',
+            'compressor', 'hello_sent', 'packets_sent',
+            'packets_received', 'compressed_input', 'compressed_output',
+            'datagrams_dropped', 'trace_ids', 'targets', 'capture',
+            'features')
+
+    def __init__(self, record_conn, compression=None):
         self.record_conn = record_conn
         self.id_allocator = IDAllocator(1, max_conn_id)
         self.conn_states = {}
+        self.flow_allocator = IDAllocator(1, max_conn_id)
+        # packets of connections waiting for the backend, along with
+        # their traces
+        self.send_queue = deque()
         # is tunnel available for writing?
         self.available = True
-
-    def new_connection(self):
+        self.compression = compression
+        self.compressor = None
+        self.hello_sent = False
+        # statistics
+        self.packets_sent = 0
+        self.packets_received = 0
+        self.compressed_input = 0
+        self.compressed_output = 0
+        self.datagrams_dropped = 0
+        # trace IDs of received SYN packets, see pop_trace_id()
+        self.trace_ids = {}
+        # targets of connections whose SYN has not been sent, or which
+        # have been received with SYN, see pop_target()
+        self.targets = {}
+        self.capture = None
+        # features supported by the server half, None until its reply
+        # on the control channel arrives
+        self.features = None
+
+    def dump(self):
+        """dump() --> dict
+
+        Return the state of this connection except its record layer
+        connection, from which restore() can continue it.
+        """
+        allocator = self.id_allocator
+        compressor = self.compressor
+        return {
+                'next_id': allocator.next_id,
+                'recycled': allocator.recycled,
+                'conn_states': self.conn_states,
+                'flow_next_id': self.flow_allocator.next_id,
+                'flow_recycled': self.flow_allocator.recycled,
+                'send_queue': [packet for packet, _ in self.send_queue],
+                'available': self.available,
+                'hello_sent': self.hello_sent,
+                'features': self.features,
+                'codec': compressor.codec.name if compressor else None,
+                'codec_streams': compressor.streams if compressor else None,
+                'stats': [self.packets_sent, self.packets_received,
+                    self.compressed_input, self.compressed_output,
+                    self.datagrams_dropped],
+                }
+
+    @classmethod
+    def restore(cls, state, record_conn, compression=None):
+        """restore(state, record_conn, compression=None) --> object
+
+        Continue a connection dumped by dump() on record_conn. The
+        negotiated codec is kept, while its options are taken from
+        compression.
+        """
+        self = cls(record_conn, compression)
+        self.id_allocator.next_id = state['next_id']
+        self.id_allocator.recycled = state['recycled']
+        self.conn_states = state['conn_states']
+        self.flow_allocator.next_id = state['flow_next_id']
+        self.flow_allocator.recycled = state['flow_recycled']
+        self.send_queue = deque((packet, None)
+                for packet in state['send_queue'])
+        self.available = state['available']
+        self.hello_sent = state['hello_sent']
+        self.features = state.get('features')
+        if state['codec']:
+            options = dict(compression or {})
+            options.pop('codecs', None)
+            self.compressor = Compressor(state['codec'], **options)
+            self.compressor.streams = state['codec_streams']
+        self.packets_sent, self.packets_received, \
+                self.compressed_input, self.compressed_output, \
+                self.datagrams_dropped = state['stats']
+        return self
+
+    def _codecs(self):
+        if self.compression is None:
+            return []
+        codecs = available_codecs()
+        allowed = self.compression.get('codecs')
+        if allowed is not None:
+            codecs = [codec for codec in codecs if codec in allowed]
+        return codecs
+
+    def send_hello(self, features=False):
+        """send_hello(features=False) --> None
+
+        Start negotiation of compression. If features is set, it is
+        started even without any codec to learn the features the server
+        half supports. It should only be called by the client half.
+        """
+        codecs = self._codecs()
+        if codecs or features:
+            self.hello_sent = True
+            self._send_packet(control_conn_id, StatusControl.syn,
+                    ",".join(codecs).encode('ascii'))
+
+    def _process_control(self, control, data):
+        if not (control & StatusControl.syn):
+            return
+        try:
+            names = data.decode('ascii').split(",") if data else []
+        except UnicodeError:
+            raise UnexpectedCompressionError()
+        if self.hello_sent:
+            # reply from server
+            chosen = names[0] if names else None
+            if chosen and chosen not in self._codecs():
+                raise UnexpectedCompressionError()
+            self.features = frozenset(names[1:])
+        else:
+            codecs = self._codecs()
+            chosen = next((name for name in names if name in codecs),
+                    None)
+            self._send_packet(control_conn_id, StatusControl.syn,
+                    ",".join((chosen or "",) + features).encode('ascii'))
+        if chosen:
+            options = dict(self.compression)
+            options.pop('codecs', None)
+            self.compressor = Compressor(chosen, **options)
+
+    def new_connection(self, target=None):
+        """new_connection(target=None) --> int
+
+        Allocate a Connection ID. If target is given, it is sent along
+        with SYN as the name of the target, in bytes, which requires
+        the server half to support it.
+        """
+        if target is not None and not (self.features and
+                "target" in self.features):
+            raise ValueError("server does not support targets")
         conn_id = self.id_allocator.allocate()
         self.conn_states[conn_id] = ConnectionStatus.new
+        if target is not None:
+            self.targets[conn_id] = target
         return conn_id
 
     def reset_connection(self, conn_id):
         if self.conn_states[conn_id] == ConnectionStatus.connected:
             self._send_packet(conn_id, StatusControl.rst)
+        elif self.targets:
+            self.targets.pop(conn_id, None)
         self.conn_states[conn_id] = ConnectionStatus.resetting
 
     def close_connection(self, conn_id):
         if self.conn_states[conn_id] == ConnectionStatus.connected:
             self._send_packet(conn_id, StatusControl.fin)
+        elif self.targets:
+            self.targets.pop(conn_id, None)
         self.conn_states[conn_id] = ConnectionStatus.closing
 
-    def send_packet(self, conn_id, data):
-        if not data:
-            return
+    def send_packet(self, conn_id, data, trace=None):
+        """send_packet(conn_id, data, trace=None) --> None
+
+        If trace is given, the events of the first packet carrying
+        data are recorded, and the trace ID is sent along with SYN if
+        the server half supports it.
+        """
+        if len(data) > max_data_size:
+            # split so that datagrams can be sent between the pieces
+            for start in range(0, len(data), max_data_size):
+                self._send_data(conn_id, data[start:start + max_data_size],
+                        trace)
+                trace = None
+        elif data:
+            self._send_data(conn_id, data, trace)
+
+    def _send_data(self, conn_id, data, trace=None):
         control = StatusControl.dat
-        if self.conn_states[conn_id] == ConnectionStatus.new:
+        syn = self.conn_states[conn_id] == ConnectionStatus.new
+        if syn:
             control |= StatusControl.syn
             self.conn_states[conn_id] = ConnectionStatus.connected
-        self._send_packet(conn_id, control, data)
+        if self.compressor is not None:
+            compressed = self.compressor.compress(conn_id, data)
+            if compressed is not None:
+                self.compressed_input += len(data)
+                self.compressed_output += len(compressed)
+                control |= StatusControl.cmp
+                data = compressed
+        if syn and self.targets and conn_id in self.targets:
+            target = self.targets.pop(conn_id)
+            control |= StatusControl.tgt
+            data = struct.pack("!B", len(target)) + target + data
+        if syn and trace is not None and self.features and \
+                "trace" in self.features:
+            control |= StatusControl.trc
+            data = trace.trace_id + data
+        self._send_packet(conn_id, control, data, trace)
+
+    def new_flow(self):
+        """new_flow() --> int
+
+        Allocate a Flow ID. It should only be called by the client half.
+        """
+        return self.flow_allocator.allocate()
+
+    def close_flow(self, flow_id):
+        self._send_datagram_packet(flow_id,
+                StatusControl.dgr | StatusControl.fin)
+        self.flow_allocator.recycle(flow_id)
+
+    def send_datagram(self, flow_id, data):
+        """send_datagram(flow_id, data) --> bool
+
+        Send a datagram ahead of the queued packets of connections.
+        It is dropped and False is returned if the backend has too
+        much data buffered.
+        """
+        if self.record_conn.buffered() >= datagram_limit:
+            self.datagrams_dropped += 1
+            return False
+        self._send_datagram_packet(flow_id,
+                StatusControl.dgr | StatusControl.dat, data)
+        return True
+
+    def _send_datagram_packet(self, flow_id, control, data=b""):
+        self.packets_sent += 1
+        if self.capture is not None:
+            self.capture.sent(control, flow_id, data)
+        header = struct.pack(header_format, VERSION_CODE, control, flow_id)
+        self.record_conn.send_packet(header + data)
 
-    def receive_packets(self):
-        for packet in self.record_conn.receive_packets():
+    def receive_packets(self, recv=True):
+        for packet in self.record_conn.receive_packets(recv):
             packet = self._process_packet(packet)
             if packet:
                 yield packet
 
+    def has_pending(self):
+        return self.record_conn.has_pending()
+
     def _process_packet(self, packet):
+        self.packets_received += 1
         ver, control, conn_id = \
                 struct.unpack(header_format, packet[:header_size])
         if ver != VERSION_CODE:
             raise UnsupportVersionError()
         data = packet[header_size:]
+        if self.capture is not None:
+            self.capture.received(control, conn_id, data)
+        if control & StatusControl.dgr:
+            return conn_id, control, data
+        if conn_id == control_conn_id:
+            self._process_control(control, data)
+            return None
+        if control & StatusControl.trc:
+            self.trace_ids[conn_id] = data[:TRACE_ID_SIZE]
+            data = data[TRACE_ID_SIZE:]
+        if control & StatusControl.tgt:
+            if not data:
+                raise InvalidTargetError()
+            end = 1 + struct.unpack("!B", data[:1])[0]
+            if len(data) < end:
+                raise InvalidTargetError()
+            self.targets[conn_id] = data[1:end]
+            data = data[end:]
+        if control & StatusControl.cmp:
+            if self.compressor is None:
+                raise UnexpectedCompressionError()
+            control &= ~StatusControl.cmp
+            if control & StatusControl.dat:
+                data = self.compressor.decompress(data)
 
         # RST flag is set
         if control & StatusControl.rst:
             old_state = self.conn_states[conn_id]
             self.reset_connection(conn_id)
             self.conn_states[conn_id] = ConnectionStatus.closed
-            self.id_allocator.recycle(conn_id)
+            self._recycle(conn_id)
             if old_state != ConnectionStatus.connected:
                 return None
             return conn_id, StatusControl.rst, b""
@@ -182,19 +512,66 @@ class TunnelConnection(object):
             old_state = self.conn_states[conn_id]
             self.close_connection(conn_id)
             self.conn_states[conn_id] = ConnectionStatus.closed
-            self.id_allocator.recycle(conn_id)
+            self._recycle(conn_id)
             if old_state != ConnectionStatus.connected:
                 return None
         if not control:
             return None
         return conn_id, control, data
 
-    def _send_packet(self, conn_id, control, data=b""):
+    def pop_trace_id(self, conn_id):
+        """pop_trace_id(conn_id) --> bytes or None
+
+        Return the trace ID received with SYN of conn_id, if TRC was
+        set on it.
+        """
+        return self.trace_ids.pop(conn_id, None)
+
+    def pop_target(self, conn_id):
+        """pop_target(conn_id) --> bytes or None
+
+        Return the name of the target received with SYN of conn_id, if
+        TGT was set on it.
+        """
+        return self.targets.pop(conn_id, None)
+
+    def _recycle(self, conn_id):
+        self.id_allocator.recycle(conn_id)
+        if self.trace_ids:
+            self.trace_ids.pop(conn_id, None)
+        if self.targets:
+            self.targets.pop(conn_id, None)
+        if self.compressor is not None:
+            self.compressor.forget(conn_id)
+
+    def _send_packet(self, conn_id, control, data=b"", trace=None):
+        self.packets_sent += 1
+        if self.capture is not None:
+            self.capture.sent(control, conn_id, data)
         header = struct.pack(header_format, VERSION_CODE, control, conn_id)
-        self.record_conn.send_packet(header + data)
+        if self.send_queue or \
+                self.record_conn.buffered() >= queue_threshold:
+            self.send_queue.append((header + data, trace))
+            if trace is not None:
+                trace.mark('queued')
+        else:
+            self.record_conn.send_packet(header + data, trace)
 
     def continue_sending(self):
-        self.available = self.record_conn.continue_sending()
+        available = self.record_conn.continue_sending()
+        queue = self.send_queue
+        while queue and self.record_conn.buffered() < queue_threshold:
+            self.record_conn.send_packet(*queue.popleft())
+        self.available = available and not queue
+
+    def close(self):
+        """close() --> None
+
+        Pass all queued packets to the record layer and close it.
+        """
+        while self.send_queue:
+            self.record_conn.send_packet(*self.send_queue.popleft())
+        self.record_conn.close()
 
     def get_rlist(self):
         return self.record_conn.get_rlist()
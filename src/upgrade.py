@@ -0,0 +1,163 @@
+# coding: UTF-8
+
+"""Handoff of a running server to a new process.
+
+If upgrade_socket is set, the server listens on that Unix socket. A
+new server started with --upgrade connects to it, and the running
+server passes over it the listening socket, the sockets of all
+tunnels, streams and UDP flows, and the state of their record and
+tunnel layers, so that clients do not notice the restart.
+
+Messages sent by the old process:
+
+    "F"                 one byte carrying up to MAX_FDS sockets as
+                        SCM_RIGHTS ancillary data, repeated as needed
+    "S" length state    pickled state, 32-bit length in network byte
+                        order, in which sockets are referred to by
+                        their indices in the order they were passed
+
+The new process rebuilds the tunnels without any I/O on the sockets,
+and replies "OK". Only then does the old process stop and close its
+copies of the sockets, so it carries on if the new process fails
+before. The new process waits for the end of the connection before
+binding its own sockets, e.g. the stats port.
+
+Passing sockets requires socket.sendmsg(), which is only available in
+Python 3.
+"""
+
+import os
+import array
+import pickle
+import socket
+import struct
+
+# max number of file descriptors passed in one message
+MAX_FDS = 200
+# seconds to wait for the other process
+TIMEOUT = 30
+
+_fd_size = array.array('i').itemsize
+
+class UpgradeError(Exception): pass
+
+def _check_supported():
+    if not hasattr(socket.socket, 'sendmsg'):
+        raise UpgradeError("upgrading requires Python 3")
+
+def _recv_exactly(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise UpgradeError("connection closed by the other process")
+        data += chunk
+    return data
+
+class UpgradeListener(object):
+    """UpgradeListener(path) --> UpgradeListener object
+
+    Non-blocking Unix socket which is only accessible by the owner.
+    """
+
+    def __init__(self, path):
+        _check_supported()
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            self.conn.bind(path)
+        finally:
+            os.umask(umask)
+        self.conn.listen(1)
+        self.conn.setblocking(0)
+
+    def accept(self):
+        """accept() --> socket or None"""
+        try:
+            conn, _ = self.conn.accept()
+        except socket.error:
+            return None
+        conn.settimeout(TIMEOUT)
+        return conn
+
+    def close(self):
+        self.conn.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def get_rlist(self):
+        return [self.conn.fileno()]
+
+def send_state(conn, state, sockets):
+    """send_state(conn, state, sockets) --> bool
+
+    Pass sockets and state to the new process connected by conn, and
+    return whether it has taken them over.
+    """
+    fds = [sock.fileno() for sock in sockets]
+    for i in range(0, len(fds), MAX_FDS):
+        fds_data = array.array('i', fds[i:i + MAX_FDS])
+        conn.sendmsg([b"F"],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds_data)])
+    data = pickle.dumps({
+        'sockets': [(sock.family, sock.type, sock.proto)
+            for sock in sockets],
+        'state': state,
+        }, 2)
+    conn.sendall(b"S" + struct.pack("!I", len(data)) + data)
+    try:
+        return _recv_exactly(conn, 2) == b"OK"
+    except (socket.error, UpgradeError):
+        return False
+
+def receive_state(path):
+    """receive_state(path) --> (conn, state, sockets)
+
+    Connect to the old process listening on path, and receive its
+    state and non-blocking sockets. finish() must be called with conn
+    once the state has been restored.
+    """
+    _check_supported()
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(TIMEOUT)
+    conn.connect(path)
+    fds = array.array('i')
+    while True:
+        kind, ancdata, flags, _ = conn.recvmsg(1,
+                socket.CMSG_SPACE(MAX_FDS * _fd_size))
+        for level, cmsg_type, data in ancdata:
+            if level == socket.SOL_SOCKET and \
+                    cmsg_type == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - len(data) % _fd_size])
+        if flags & socket.MSG_CTRUNC:
+            raise UpgradeError("file descriptors are truncated")
+        if kind == b"S":
+            break
+        if kind != b"F":
+            raise UpgradeError("unexpected message")
+    length, = struct.unpack("!I", _recv_exactly(conn, 4))
+    message = pickle.loads(_recv_exactly(conn, length))
+    if len(message['sockets']) != len(fds):
+        raise UpgradeError("number of file descriptors mismatches")
+    sockets = []
+    for fd, (family, socktype, proto) in zip(fds, message['sockets']):
+        sock = socket.socket(family, socktype, proto, fd)
+        sock.setblocking(0)
+        sockets.append(sock)
+    return conn, message['state'], sockets
+
+def finish(conn):
+    """finish(conn) --> None
+
+    Tell the old process that its state has been taken over, and wait
+    until it has released its listening sockets.
+    """
+    conn.sendall(b"OK")
+    try:
+        conn.recv(1)
+    except socket.error:
+        pass
+    conn.close()
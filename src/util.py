@@ -1,168 +1,317 @@
 # coding: UTF-8
 
-class ObjectSet(object):
-    """ObjectSet(iterable) --> ObjectSet object
-
-    Build a set of arbitrary objects.
+import os
+import sys
+import errno
+import fcntl
+import signal
+import socket
+
+DEFAULT_BACKLOG = 128
+DEFAULT_ACCEPT_BATCH = 32
+# bytes of the first read of a reader
+DEFAULT_READ_SIZE = 4096
+# max bytes of one read
+DEFAULT_MAX_READ_SIZE = 65536
+# max bytes read from one socket in one iteration of the loop
+DEFAULT_READ_BUDGET = 262144
+# seconds to wait for outgoing connections to be established
+DEFAULT_CONNECT_TIMEOUT = 10
+# seconds to wait for remaining data to be sent when closing
+DEFAULT_CLOSE_TIMEOUT = 10
+# max datagrams received from one socket in one iteration of the loop
+DEFAULT_DATAGRAM_BATCH = 64
+# max size of UDP datagrams
+MAX_DATAGRAM_SIZE = 65535
+# seconds after which idle datagram flows are discarded
+DEFAULT_FLOW_TIMEOUT = 60
+# option limiting unsent data in the kernel, which Python 2 does not
+# define, available since Linux 3.12
+TCP_NOTSENT_LOWAT = getattr(socket, 'TCP_NOTSENT_LOWAT',
+        25 if sys.platform.startswith('linux') else None)
+
+def get_select_list(m, *groups):
+    """get_select_list(m, *groups) --> (list, dict)
+
+    Each group is a tuple of a handler and an iterable of objects.
+    Collect file numbers returned by method m of all objects, and
+    build a dispatch table mapping each of them to its handler and
+    object.
     """
-    def __init__(self, iterable=None):
-        self._dict = {}
-        if iterable:
-            for elem in iterable:
-                self.add(elem)
-
-    def __len__(self):
-        return len(self._dict)
-
-    def __iter__(self):
-        return self._dict.itervalues()
-
-    def __repr__(self):
-        return 'ObjectSet(' + repr(self._dict.values()) + ')'
-
-    def __contains__(self, elem):
-        return id(elem) in self._dict
-
-    def union(self, *others):
-        new_set = self.copy()
-        new_set.update(*others)
-        return new_set
-    __or__ = union
-
-    def copy(self):
-        new_set = ObjectSet()
-        new_set._dict = self._dict.copy()
-        return new_set
-
-    def update(self, *others):
-        for other in others:
-            for elem in other:
-                self.add(elem)
-        return self
-    __ior__ = update
-
-    def difference_update(self, *others):
-        for other in others:
-            for elem in other:
-                self.discard(elem)
-        return self
-    __isub__ = difference_update
-
-    def add(self, elem):
-        self._dict[id(elem)] = elem
-
-    def remove(self, elem):
-        del self._dict[id(elem)]
-
-    def discard(self, elem):
-        if elem in self:
-            self.remove(elem)
-
-    def pop(self):
-        _, elem = self._dict.popitem()
-        return elem
-
-    def clear(self):
-        self._dict.clear()
+    mlist = []
+    mdict = {}
+    for handler, objs in groups:
+        for obj in objs:
+            flist = getattr(obj, m)()
+            if not flist:
+                continue
+            mlist += flist
+            entry = (handler, obj)
+            for fno in flist:
+                mdict[fno] = entry
+    return mlist, mdict
 
-class ObjectDict(object):
-    """ObjectDict() --> ObjectDict object
+class SignalWaker(object):
+    """SignalWaker() --> SignalWaker object
 
-    Build a dictionary whose key can be any object.
+    Pipe which becomes readable when a signal arrives. Python 3 retries
+    select() interrupted by signals (PEP 475), so the loop has to watch
+    it to notice changes made by signal handlers.
     """
-    def __init__(self):
-        self._keys = {}
-        self._values = {}
-
-    def __len__(self):
-        return len(self._keys)
-
-    def __getitem__(self, key):
-        return self._values[id(key)]
 
-    def __setitem__(self, key, value):
-        self._keys[id(key)] = key
-        self._values[id(key)] = value
-
-    def __delitem__(self, key):
-        del self._keys[id(key)]
-        del self._values[id(key)]
-
-    def __contains__(self, key):
-        return id(key) in self._keys
-    
-    def __iter__(self):
-        return self._keys.itervalues()
+    def __init__(self):
+        self._rfd, self._wfd = os.pipe()
+        for fd in (self._rfd, self._wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.set_wakeup_fd(self._wfd)
 
     def clear(self):
-        self._keys.clear()
-        self._values.clear()
-
-    def get(self, key, default=None):
-        return self._values.get(id(key), default)
+        try:
+            while os.read(self._rfd, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
 
-    def has_key(self, key):
-        return id(key) in self._keys
+    def close(self):
+        signal.set_wakeup_fd(-1)
+        os.close(self._rfd)
+        os.close(self._wfd)
 
-    def items(self):
-        return list(self.iteritems())
+    def get_rlist(self):
+        return [self._rfd]
 
-    def keys(self):
-        return self._keys.values()
+# buffer shared by all readers, since reading is only done in the
+# thread of the event loop and data is copied out at once
+_read_buffer = bytearray()
 
-    def values(self):
-        return self._values.values()
+def read_buffer(size):
+    """read_buffer(size) --> memoryview
 
-    def iteritems(self):
-        for k in self._keys.iterkeys():
-            yield self._keys[k], self._values[k]
-
-    def iterkeys(self):
-        return self._keys.itervalues()
-
-    def itervalues(self):
-        return self._values.itervalues()
+    Return a shared buffer of at least size bytes for recv_into.
+    """
+    global _read_buffer
+    if len(_read_buffer) < size:
+        _read_buffer = bytearray(size)
+    return memoryview(_read_buffer)
+
+class Reader(object):
+    """Reader(**opts) --> Reader object
+
+    Reader of a non-blocking socket. The size of each read starts at
+    read_size, doubles while reads fill it up to max_read_size, and
+    halves when they come back much shorter. A socket is read until
+    it has nothing left or read_budget bytes have been read, so that
+    other sockets are not starved.
+
+    Options:
+        read_size       bytes of the first read
+        max_read_size   max bytes of one read
+        read_budget     max bytes returned by one call of read()
+    """
 
-    def popitem(self):
-        key_id, key = self._keys.popitem()
-        value = self._values.pop(key_id)
-        return key, value
+    __slots__ = ('size', 'min_size', 'max_size', 'budget')
+
+    def __init__(self, **opts):
+        self.size = self.min_size = opts.get('read_size', DEFAULT_READ_SIZE)
+        self.max_size = opts.get('max_read_size', DEFAULT_MAX_READ_SIZE)
+        self.budget = max(opts.get('read_budget', DEFAULT_READ_BUDGET),
+                self.max_size)
+
+    def read(self, conn):
+        """read(conn) --> bytes or None
+
+        Return data read from conn, which is empty if there is nothing
+        to read, or None if the peer has closed the connection and
+        there is nothing left.
+        """
+        budget = self.budget
+        view = read_buffer(budget)
+        total = 0
+        while total < budget:
+            size = min(self.size, budget - total)
+            try:
+                n = conn.recv_into(view[total:], size)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not n:
+                if not total:
+                    return None
+                break
+            total += n
+            if n == size:
+                self.size = min(self.size * 2, self.max_size)
+                continue
+            if n * 4 < size:
+                self.size = max(self.size // 2, self.min_size)
+            # a short read means the socket has been drained
+            break
+        return view[:total].tobytes()
+
+def create_listener(address, port, family=socket.AF_INET,
+        backlog=DEFAULT_BACKLOG, reuseport=False):
+    """create_listener(address, port, ...) --> socket
+
+    Create a non-blocking listening socket. If reuseport is set and
+    the platform supports it, SO_REUSEPORT is enabled so that several
+    processes can share the port.
+    """
+    conn = socket.socket(family)
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport and hasattr(socket, 'SO_REUSEPORT'):
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    conn.bind((address, port))
+    conn.listen(backlog)
+    conn.setblocking(0)
+    return conn
+
+def create_unix_listener(path, backlog=DEFAULT_BACKLOG):
+    """create_unix_listener(path, backlog) --> socket
+
+    Create a non-blocking listening Unix socket at path. The file left
+    at path by a previous process is removed first.
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.bind(path)
+    conn.listen(backlog)
+    conn.setblocking(0)
+    return conn
+
+def set_notsent_lowat(conn, size):
+    """set_notsent_lowat(conn, size) --> None
+
+    Keep at most about size bytes of unsent data in the kernel buffer
+    of a TCP socket, so that data waiting in user space can still be
+    reordered, e.g. datagrams of the tunnel layer put ahead. It does
+    nothing if size is None or the platform does not support it.
+    """
+    if size is None or TCP_NOTSENT_LOWAT is None or \
+            conn.family == socket.AF_UNIX:
+        return
+    try:
+        conn.setsockopt(socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT, size)
+    except socket.error as e:
+        if e.errno not in (errno.ENOPROTOOPT, errno.EINVAL):
+            raise
 
-    def setdefault(self, key, default=None):
-        if key not in self:
-            self[key] = default
-        return self[key]
+def start_connect(address, port):
+    """start_connect(address, port) --> socket
 
-def flatten(obj):
+    Create a non-blocking socket and start connecting it to the first
+    address address resolves to. Use check_connected() to learn when
+    the connection is established.
+    """
+    family, socktype, proto, _, sockaddr = socket.getaddrinfo(
+            address, port, 0, socket.SOCK_STREAM)[0]
+    conn = socket.socket(family, socktype, proto)
+    conn.setblocking(0)
+    err = conn.connect_ex(sockaddr)
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+        conn.close()
+        raise socket.error(err, os.strerror(err))
+    return conn
+
+def start_connect_unix(path):
+    """start_connect_unix(path) --> socket
+
+    Create a non-blocking Unix socket and start connecting it to path,
+    see start_connect().
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.setblocking(0)
+    err = conn.connect_ex(path)
+    # EAGAIN means the backlog of the listener is full
+    if err not in (0, errno.EINPROGRESS):
+        conn.close()
+        raise socket.error(err, os.strerror(err))
+    return conn
+
+def check_connected(conn):
+    """check_connected(conn) --> bool
+
+    Whether the connection started by start_connect() is established.
+    socket.error is raised if connecting has failed.
+    """
+    err = conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err:
+        raise socket.error(err, os.strerror(err))
     try:
-        for subobj in obj:
-            for item in flatten(subobj):
-                if not hasattr(item, 'get_rlist'):
-                    print repr(item), repr(subobj), repr(obj)
-                yield item
-    except TypeError:
-        yield obj
-
-def get_select_list(m, *args):
-    mlist = []
-    mdict = {}
-    for conn in flatten(args):
-        flist = getattr(conn, m)()
-        if not flist:
-            continue
-        mlist += flist
-        for fno in flist:
-            mdict[fno] = conn
-    return mlist, mdict
+        conn.getpeername()
+    except socket.error as e:
+        if e.errno == errno.ENOTCONN:
+            return False
+        raise
+    return True
+
+def accept_all(conn, limit=DEFAULT_ACCEPT_BATCH):
+    """accept_all(conn, limit) --> iterator of (conn, address)
+
+    Accept pending connections from a non-blocking listening socket
+    until there is none left or limit is reached.
+    """
+    for i in range(limit):
+        try:
+            yield conn.accept()
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK,
+                    errno.ECONNABORTED, errno.EINTR):
+                return
+            raise
+
+def recv_datagrams(conn, limit=DEFAULT_DATAGRAM_BATCH):
+    """recv_datagrams(conn, limit) --> list of (data, address)
+
+    Receive pending datagrams from a non-blocking UDP socket until
+    there is none left or limit is reached.
+    """
+    datagrams = []
+    for i in range(limit):
+        try:
+            datagrams.append(conn.recvfrom(MAX_DATAGRAM_SIZE))
+        except socket.error as e:
+            # ECONNREFUSED is reported by connected sockets when the
+            # peer has sent ICMP port unreachable
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK,
+                    errno.ECONNREFUSED, errno.EINTR):
+                break
+            raise
+    return datagrams
+
+def send_datagram(conn, data, address=None):
+    """send_datagram(conn, data, address=None) --> bool
+
+    Send a datagram through a non-blocking UDP socket. It is dropped
+    and False is returned if the socket buffer is full or the peer
+    cannot be reached.
+    """
+    try:
+        if address is None:
+            conn.send(data)
+        else:
+            conn.sendto(data, address)
+    except socket.error as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS,
+                errno.ECONNREFUSED, errno.EMSGSIZE):
+            return False
+        raise
+    return True
 
 def import_backend(config):
     fromlist = ['ServerBackend', 'ClientBackend']
     package = 'backend.' + config['backend']['type']
     return __import__(package, fromlist=fromlist)
 
-def import_frontend(config):
+def import_frontend_class(opts):
+    """import_frontend_class(opts) --> class
+
+    Import FrontendServer of the type given in frontend options opts.
+    """
     fromlist = ['FrontendServer']
-    package = 'frontend.' + config['frontend']['type']
+    package = 'frontend.' + opts['type']
     package = __import__(package, fromlist=fromlist)
-    FrontendServer = package.FrontendServer
-    return lambda: FrontendServer(**config['frontend'])
+    return package.FrontendServer